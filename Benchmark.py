@@ -0,0 +1,426 @@
+import argparse
+import json
+import os
+import platform
+import random
+import struct
+import subprocess
+import sys
+import tempfile
+import time
+
+import Bus
+import Cartridge
+
+# Throughput benchmarks for the emulator. Runs headless on small synthetic ROMs
+# (and any ROM files given on the command line) and writes the results as json
+# so runs on different commits can be compared with --compare.
+
+# Synthetic NROM program, assembled by hand and loaded at $C000:
+#   waits two vblanks, writes the palette and fills name table 0, enables nmi
+#   and writes MASK, then loops forever on zero page arithmetic and ram
+#   stores. The nmi handler scrolls the screen by one pixel per frame.
+PROGRAM = bytes([
+    0x78,                   # C000  SEI
+    0xD8,                   # C001  CLD
+    0xA2, 0xFF,             # C002  LDX #$FF
+    0x9A,                   # C004  TXS
+    0x2C, 0x02, 0x20,       # C005  BIT $2002
+    0x10, 0xFB,             # C008  BPL $C005
+    0x2C, 0x02, 0x20,       # C00A  BIT $2002
+    0x10, 0xFB,             # C00D  BPL $C00A
+    0xA9, 0x3F,             # C00F  LDA #$3F
+    0x8D, 0x06, 0x20,       # C011  STA $2006
+    0xA9, 0x00,             # C014  LDA #$00
+    0x8D, 0x06, 0x20,       # C016  STA $2006
+    0xA2, 0x00,             # C019  LDX #$00
+    0x8A,                   # C01B  TXA
+    0x8D, 0x07, 0x20,       # C01C  STA $2007
+    0xE8,                   # C01F  INX
+    0xE0, 0x20,             # C020  CPX #$20
+    0xD0, 0xF7,             # C022  BNE $C01B
+    0xA9, 0x20,             # C024  LDA #$20
+    0x8D, 0x06, 0x20,       # C026  STA $2006
+    0xA9, 0x00,             # C029  LDA #$00
+    0x8D, 0x06, 0x20,       # C02B  STA $2006
+    0xA2, 0x04,             # C02E  LDX #$04
+    0xA0, 0x00,             # C030  LDY #$00
+    0x98,                   # C032  TYA
+    0x8D, 0x07, 0x20,       # C033  STA $2007
+    0xC8,                   # C036  INY
+    0xD0, 0xF9,             # C037  BNE $C032
+    0xCA,                   # C039  DEX
+    0xD0, 0xF6,             # C03A  BNE $C032
+    0xA9, 0x00,             # C03C  LDA #$00
+    0x8D, 0x05, 0x20,       # C03E  STA $2005
+    0x8D, 0x05, 0x20,       # C041  STA $2005
+    0xA9, 0x80,             # C044  LDA #$80
+    0x8D, 0x00, 0x20,       # C046  STA $2000
+    0xA9, 0x00,             # C049  LDA #mask (patched in by SyntheticRom)
+    0x8D, 0x01, 0x20,       # C04B  STA $2001
+    0xE6, 0x00,             # C04E  INC $00
+    0xA5, 0x00,             # C050  LDA $00
+    0x65, 0x01,             # C052  ADC $01
+    0x85, 0x01,             # C054  STA $01
+    0xA6, 0x00,             # C056  LDX $00
+    0x9D, 0x00, 0x03,       # C058  STA $0300,X
+    0x4C, 0x4E, 0xC0,       # C05B  JMP $C04E
+    0x48,                   # C05E  PHA           (nmi)
+    0xE6, 0x02,             # C05F  INC $02
+    0xA5, 0x02,             # C061  LDA $02
+    0x8D, 0x05, 0x20,       # C063  STA $2005
+    0x8D, 0x05, 0x20,       # C066  STA $2005
+    0x68,                   # C069  PLA
+    0x40,                   # C06A  RTI           (irq)
+])
+PROGRAM_MASK = 0x4A
+PROGRAM_CTRL = 0x45
+# the page count and the TYA of the name table fill, for filling all four
+# name tables with a tile per page instead
+PROGRAM_FILL_PAGES = 0x2F
+PROGRAM_FILL_TILE = 0x32
+# the main loop, replaced by a jump to itself for the idle rom
+PROGRAM_MAIN = 0x4E
+PROGRAM_NMI = 0xC05E
+PROGRAM_RESET = 0xC000
+PROGRAM_IRQ = 0xC06A
+# where the variants below hook in: the LDA #$00 / STA $2005 before nmi is
+# enabled becomes JSR $C100 / NOP / NOP, and the INC $02 / LDA $02 of the nmi
+# handler becomes JSR $C180 / NOP
+PROGRAM_SETUP = 0x3C
+PROGRAM_NMI_HOOK = 0x5F
+SETUP_HOOK = bytes([0x20, 0x00, 0xC1, 0xEA, 0xEA])
+NMI_HOOK = bytes([0x20, 0x80, 0xC1, 0xEA])
+# tails of the $C100 and $C180 routines, doing what the hooks replaced
+SETUP_END = bytes([0xA9, 0x00, 0x8D, 0x05, 0x20, 0x60])    # LDA #$00, STA $2005, RTS
+NMI_START = bytes([0xE6, 0x02])                             # INC $02
+NMI_END = bytes([0xA5, 0x02, 0x60])                         # LDA $02, RTS
+
+# Sprites: oam is filled from a table at $C300 at start up and copied with
+# oam dma in every nmi. The main loop waits for sprite 0 to hit, changes the
+# scroll mid-frame and moves one byte of oam a frame.
+SPRITE_SETUP = bytes([
+    0xA2, 0x00,             # C100  LDX #$00
+    0xBD, 0x00, 0xC3,       # C102  LDA $C300,X
+    0x9D, 0x00, 0x02,       # C105  STA $0200,X
+    0xE8,                   # C108  INX
+    0xD0, 0xF7,             # C109  BNE $C102
+])
+SPRITE_NMI = bytes([
+    0xA9, 0x02,             # C182  LDA #$02
+    0x8D, 0x14, 0x40,       # C184  STA $4014
+])
+SPRITE_MAIN = bytes([
+    0x2C, 0x02, 0x20,       # C200  BIT $2002
+    0x70, 0xFB,             # C203  BVS $C200     wait for the hit flag to clear
+    0x2C, 0x02, 0x20,       # C205  BIT $2002
+    0x50, 0xFB,             # C208  BVC $C205     and for sprite 0 to hit
+    0xA5, 0x00,             # C20A  LDA $00
+    0x8D, 0x05, 0x20,       # C20C  STA $2005
+    0x8D, 0x05, 0x20,       # C20F  STA $2005
+    0xE6, 0x00,             # C212  INC $00
+    0xA6, 0x00,             # C214  LDX $00
+    0xFE, 0x00, 0x02,       # C216  INC $0200,X
+    0x4C, 0x00, 0xC2,       # C219  JMP $C200
+])
+SPRITE_MAIN_ADDRESS = 0xC200
+
+# MMC3: switches to horizontal mirroring at start up and has the scanline
+# counter raise an irq every 21 lines. The irq handler re-arms it and switches
+# the 2KB chr bank the background is drawn from, the nmi handler switches
+# back to bank 0.
+MMC3_SETUP = bytes([
+    0xA9, 0x40,             # C100  LDA #$40
+    0x8D, 0x17, 0x40,       # C102  STA $4017     no apu frame irq
+    0xA9, 0x01,             # C105  LDA #$01
+    0x8D, 0x00, 0xA0,       # C107  STA $A000     horizontal mirroring
+    0xA9, 0x14,             # C10A  LDA #$14
+    0x8D, 0x00, 0xC0,       # C10C  STA $C000     irq latch 20
+    0x8D, 0x01, 0xC0,       # C10F  STA $C001     reload
+    0x8D, 0x01, 0xE0,       # C112  STA $E001     enable the irq
+    0x58,                   # C115  CLI
+])
+MMC3_NMI = bytes([
+    0xA9, 0x00,             # C182  LDA #$00
+    0x8D, 0x00, 0x80,       # C184  STA $8000     select R0
+    0x8D, 0x01, 0x80,       # C187  STA $8001     chr bank 0 at $0000
+])
+MMC3_IRQ = bytes([
+    0x48,                   # C280  PHA
+    0x8D, 0x00, 0xE0,       # C281  STA $E000     acknowledge
+    0x8D, 0x01, 0xE0,       # C284  STA $E001     and enable again
+    0xA9, 0x00,             # C287  LDA #$00
+    0x8D, 0x00, 0x80,       # C289  STA $8000
+    0xE6, 0x03,             # C28C  INC $03
+    0xA5, 0x03,             # C28E  LDA $03
+    0x29, 0x06,             # C290  AND #$06
+    0x8D, 0x01, 0x80,       # C292  STA $8001
+    0x68,                   # C295  PLA
+    0x40,                   # C296  RTI
+])
+MMC3_IRQ_ADDRESS = 0xC280
+
+def SpriteTable():
+    # sprite 0 over the background, 16 sprites on the same few lines so some
+    # lines overflow, and the rest anywhere with any attributes
+    rnd = random.Random(2102)
+    table = bytearray([40, 0x11, 0x00, 60])
+    for i in range(1, 64):
+        y = rnd.randrange(100, 106) if i <= 16 else rnd.randrange(240)
+        table += bytes([y, rnd.randrange(256), rnd.randrange(256) & 0xE3, rnd.randrange(256)])
+    return table
+
+# the synthetic roms, by name, with the keyword arguments of SyntheticRom
+SYNTHETIC_ROMS = {
+    "synthetic-render": dict(mask=0x0A),                # background on
+    "synthetic-blank": dict(mask=0x00),                 # rendering off, cpu bound
+    "synthetic-idle": dict(mask=0x0A, idle=True),       # background on, all work in the nmi handler
+    "synthetic-sprites": dict(mask=0x1E, sprites=8),    # 8x8 sprites, sprite 0 polling
+    "synthetic-sprites16": dict(mask=0x1E, sprites=16), # the same with 8x16 sprites
+    "synthetic-mmc3": dict(mask=0x0A, mmc3=True),       # mmc3 scanline irqs and chr bank switches
+    "synthetic-mmc3-idle": dict(mask=0x0A, idle=True, mmc3=True),
+    "synthetic-horizontal": dict(mask=0x0A, mirroring=0x00),   # horizontal mirroring, all name tables filled
+    "synthetic-fourscreen": dict(mask=0x0A, mirroring=0x08),   # four-screen vram
+}
+
+def SyntheticRom(mask, idle=False, sprites=None, mmc3=False, mirroring=0x01):
+    # mask: value written to MASK ($2001); idle: the main loop only waits for
+    # nmi; sprites: None, or 8 or 16 for sprites of that height; mmc3: an MMC3
+    # board instead of NROM; mirroring: the header's mirroring bits, anything
+    # but vertical also fills $2000-$2FFF so the four name tables differ
+    prg = bytearray(0x4000)
+    prg[0:len(PROGRAM)] = PROGRAM
+    prg[PROGRAM_MASK] = mask
+    if idle:
+        prg[PROGRAM_MAIN:PROGRAM_MAIN + 3] = bytes([0x4C, PROGRAM_MAIN, 0xC0])   # JMP $C04E
+    if mirroring != 0x01:
+        prg[PROGRAM_FILL_PAGES] = 0x10
+        prg[PROGRAM_FILL_TILE] = 0x8A   # TXA
+    if sprites is not None:
+        # nmi on, sprites at $1000, 8x16 sprites take their table from the tile
+        prg[PROGRAM_CTRL] = 0xA0 if sprites == 16 else 0x88
+        prg[PROGRAM_SETUP:PROGRAM_SETUP + len(SETUP_HOOK)] = SETUP_HOOK
+        prg[PROGRAM_NMI_HOOK:PROGRAM_NMI_HOOK + len(NMI_HOOK)] = NMI_HOOK
+        setup = SPRITE_SETUP + SETUP_END
+        nmi = NMI_START + SPRITE_NMI + NMI_END
+        prg[0x100:0x100 + len(setup)] = setup
+        prg[0x180:0x180 + len(nmi)] = nmi
+        prg[0x200:0x200 + len(SPRITE_MAIN)] = SPRITE_MAIN
+        prg[0x300:0x400] = SpriteTable()
+        struct.pack_into('<BH', prg, PROGRAM_MAIN, 0x4C, SPRITE_MAIN_ADDRESS)  # JMP $C200
+    irq = PROGRAM_IRQ
+    if mmc3:
+        # nmi on, background at $0000 and sprites at $1000 as the counter expects
+        prg[PROGRAM_CTRL] = 0x88
+        prg[PROGRAM_SETUP:PROGRAM_SETUP + len(SETUP_HOOK)] = SETUP_HOOK
+        prg[PROGRAM_NMI_HOOK:PROGRAM_NMI_HOOK + len(NMI_HOOK)] = NMI_HOOK
+        setup = MMC3_SETUP + SETUP_END
+        nmi = NMI_START + MMC3_NMI + NMI_END
+        prg[0x100:0x100 + len(setup)] = setup
+        prg[0x180:0x180 + len(nmi)] = nmi
+        prg[0x280:0x280 + len(MMC3_IRQ)] = MMC3_IRQ
+        irq = MMC3_IRQ_ADDRESS
+    struct.pack_into('<HHH', prg, 0x3FFA, PROGRAM_NMI, PROGRAM_RESET, irq)
+    rnd = random.Random(6502)
+    chrData = bytes(rnd.randrange(256) for i in range(0x2000))
+    # 16KB of prg are two 8KB banks on MMC3, the program is in the one fixed at $C000
+    flags6 = (0x40 if mmc3 else 0x00) | mirroring
+    header = b'NES\x1a' + bytes([1, 1, flags6, 0x00]) + bytes(8)
+    return header + bytes(prg) + chrData
+
+def LoadBus(filename, scanline_render=False, block_cache=False):
+    nes = Bus.Bus()
+    nes.ppu.scanline_render = scanline_render
+    nes.insertCartridge(Cartridge.Cartridge(filename))
+    nes.reset()
+    nes.useBlockCache(block_cache)
+    return nes
+
+def Best(fn, repeat):
+    # best wall time of several runs, the least disturbed by the rest of the machine
+    best = None
+    for i in range(repeat):
+        start = time.perf_counter()
+        fn()
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+def CountInstructions(filename, frames):
+    # instructions in the frames BenchFrames times, stepped one at a time
+    nes = LoadBus(filename, True)
+    nes.skipIdleLoops = False
+    for j in range(2):
+        nes.runFrame()
+    instructions = 0
+    for j in range(frames):
+        while not nes.ppu.frame_complete:
+            nes.step()
+            instructions += 1
+        nes.ppu.frame_complete = False
+    return instructions
+
+def BenchFrames(filename, frames, scanline_render, repeat, instructions, block_cache=False):
+    # frames/s and cpu instructions/s running whole frames with the step
+    # scheduler. A step can cover many instructions (blocks, skipped idle
+    # loops), the instruction count comes from CountInstructions.
+    best = None
+    for i in range(repeat):
+        nes = LoadBus(filename, scanline_render, block_cache)
+        # skip the boot sequence, it is not representative
+        for j in range(2):
+            nes.runFrame()
+        step = nes.step
+        ppu = nes.ppu
+        start = time.perf_counter()
+        for j in range(frames):
+            while not ppu.frame_complete:
+                step()
+            ppu.frame_complete = False
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return {
+        "frames_per_second": frames / best,
+        "instructions_per_second": instructions / best,
+        "instructions": instructions,
+        "frames": frames,
+        "seconds": best,
+    }
+
+def BenchMicro(filename, iterations, repeat):
+    # calls per second of individual hot functions
+    nes = LoadBus(filename)
+    nes.runFrame()
+    results = {}
+
+    def bus_clock():
+        clock = nes.clock
+        for i in range(iterations):
+            clock()
+    results["Bus.clock"] = iterations / Best(bus_clock, repeat)
+
+    def cpu_clock():
+        clock = nes.cpu.clock
+        for i in range(iterations):
+            clock()
+    results["Nes6502.clock"] = iterations / Best(cpu_clock, repeat)
+
+    def ppu_clock():
+        clock = nes.ppu.clock
+        for i in range(iterations):
+            clock()
+    results["Nes2C02.clock"] = iterations / Best(ppu_clock, repeat)
+
+    # zero page, stack, ram mirror and prg rom, read without side effects
+    addrs = [0x0000, 0x0100, 0x0812, 0x1FFF, 0x8000, 0xC04E, 0xFFFC, 0x0300] * (iterations // 8)
+    def bus_read():
+        read = nes.cpuRead
+        for addr in addrs:
+            read(addr, True)
+    results["Bus.cpuRead"] = len(addrs) / Best(bus_read, repeat)
+
+    # the surface variant needs pygame, the buffer variant does the same work
+    tables = max(1, iterations // 1000)
+    def pattern_table():
+        ppu = nes.ppu
+        for i in range(tables):
+            # a chr write invalidates the cache, as a game updating chr ram would
+            ppu.InvalidateTiles()
+            ppu.GetPatternTableBuffer(i & 1, i & 7)
+    results["Nes2C02.GetPatternTableBuffer"] = tables / Best(pattern_table, repeat)
+    try:
+        import pygame
+    except ImportError:
+        pass
+    else:
+        def pattern_surface():
+            ppu = nes.ppu
+            for i in range(tables):
+                ppu.InvalidateTiles()
+                ppu.GetPatternTable(i & 1, i & 7)
+        results["Nes2C02.GetPatternTable"] = tables / Best(pattern_surface, repeat)
+
+    # instructions disassembled per second over the prg rom
+    lines = {}
+    def disassemble():
+        lines['count'] = len(nes.cpu.disassemble(0x8000, 0xFFFF))
+    elapsed = Best(disassemble, repeat)
+    results["Nes6502.disassemble"] = lines['count'] / elapsed
+    return results
+
+def Revision():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def RunSuite(roms, frames, iterations, repeat):
+    results = {
+        "revision": Revision(),
+        "python": platform.python_version(),
+        "implementation": platform.python_implementation(),
+        "frames": {},
+        "micro": {},
+    }
+    with tempfile.TemporaryDirectory() as tmp:
+        files = {}
+        for name, settings in SYNTHETIC_ROMS.items():
+            files[name] = os.path.join(tmp, name + ".nes")
+            with open(files[name], 'wb') as f:
+                f.write(SyntheticRom(**settings))
+        for rom in roms:
+            files[os.path.basename(rom)] = rom
+
+        for name, filename in files.items():
+            instructions = CountInstructions(filename, frames)
+            for mode, scanline_render, block_cache in (("dot", False, False), ("scanline", True, False),
+                    ("scanline+blocks", True, True)):
+                results["frames"]["%s/%s" % (name, mode)] = BenchFrames(filename, frames, scanline_render, repeat,
+                    instructions, block_cache)
+        results["micro"] = BenchMicro(files["synthetic-render"], iterations, repeat)
+    return results
+
+def Compare(base, current):
+    # ratio current/base for every number both runs have, higher is faster
+    lines = []
+    for name, values in current["frames"].items():
+        if name in base["frames"]:
+            for key in ("frames_per_second", "instructions_per_second"):
+                lines.append("%-40s %-24s %12.1f %12.1f  x%.2f" % (name, key, base["frames"][name][key], values[key],
+                    values[key] / base["frames"][name][key]))
+    for name, value in current["micro"].items():
+        if name in base["micro"]:
+            lines.append("%-40s %-24s %12.1f %12.1f  x%.2f" % (name, "calls_per_second", base["micro"][name], value,
+                value / base["micro"][name]))
+    return lines
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Measure emulator throughput")
+    parser.add_argument("roms", nargs="*", help="extra iNES ROM files to benchmark (e.g. nestest.nes)")
+    parser.add_argument("--frames", type=int, default=30, help="frames per frame benchmark (default 30)")
+    parser.add_argument("--iterations", type=int, default=100000, help="calls per micro benchmark (default 100000)")
+    parser.add_argument("--repeat", type=int, default=3, help="runs per benchmark, the best is kept (default 3)")
+    parser.add_argument("--quick", action="store_true", help="short run for a smoke test")
+    parser.add_argument("--output", metavar="FILE", help="write the json results to FILE instead of stdout")
+    parser.add_argument("--compare", metavar="FILE", help="print the speedup against an earlier json result")
+    args = parser.parse_args()
+
+    if args.quick:
+        args.frames, args.iterations, args.repeat = 3, 10000, 1
+
+    results = RunSuite(args.roms, args.frames, args.iterations, args.repeat)
+    text = json.dumps(results, indent=2, sort_keys=True)
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+
+    if args.compare is not None:
+        with open(args.compare) as f:
+            base = json.load(f)
+        print("\n".join(Compare(base, results)), file=sys.stderr if args.output is None else sys.stdout)
@@ -1,56 +1,404 @@
+import struct
+
 import Nes6502
+import Nes6502Blocks
 import Nes2C02
+import Nes2A03
 import Cartridge
 
 class Bus:
+    # save state header: magic, format version, and the cartridge layout the
+    # state belongs to (mapper id, prg banks, chr banks)
+    STATE_MAGIC = b'PNES'
+    STATE_VERSION = 6
+    STATE_HEADER = struct.Struct('<4sHBBB')
+    STATE_BUS = struct.Struct('<QBBBBB')
+    # apuIrqClock when the apu has no irq coming
+    NO_EVENT = 1 << 62
+
     def __init__(self):
         self.cpu = Nes6502.Nes6502()
         self.ppu = Nes2C02.Nes2C02()
-        #self.cpuRam = [0 for i in range(2048)]
-        self.cpuRam = [0 for i in range(0xFFFF)]
+        self.apu = Nes2A03.Nes2A03()
+        # 2KB of ram, mirrored four times over $0000-$1FFF by the page tables
+        self.cpuRam = bytearray(2048)
         self.cart = None
 
+        # controller ports: the buttons held on each pad (see Input), set once
+        # per frame by the frontend or an input script, and the shift registers
+        # the cpu reads them out of through $4016/$4017
+        self.controller = [0x00, 0x00]
+        self.controllerShift = [0x00, 0x00]
+        self.controllerStrobe = 0
+
         self.systemClockCounter = 0
+        # The ppu runs lazily behind the cpu: ppuClock is the master clock it
+        # has been run up to, ppuEventClock when it next does something the cpu
+        # can see without touching a register (vertical blank, nmi, the frame
+        # ending, sprite flags). step() only catches it up at that point or
+        # right before a register access.
+        self.ppuClock = 0
+        self.ppuEventClock = 0
+        # the apu is run at the end of each frame and on $4015 reads; it is
+        # also an event source, apuIrqClock being when it next raises an irq
+        self.apuIrqClock = self.NO_EVENT
+        # set by useBlockCache, step() then runs translated blocks of prg rom
+        # code instead of single instructions where it can
+        self.blockCache = None
+
+        # idle loop skipping: pcs at the start of the last two steps, loops
+        # found by pc, and the machine state and cpu clock when a candidate
+        # loop was last entered
+        self.skipIdleLoops = True
+        self.recentPc = None
+        self.olderPc = None
+        self.idleLoops = {}
+        self.idleLoopsVersion = 0
+        self.idleState = None
+        self.idleClock = 0
+        # cpu cycles skipped so far, for checking the skipping is in use
+        self.idleCyclesSkipped = 0
+
+        # cpu memory map, one entry per 256 byte page. Pages backed by memory
+        # hold (memory, offset) so an access is a single index into a list;
+        # pages with side effects hold (None, 0) and go through a handler.
+        # The extra page past $FFFF catches tools such as the disassembler
+        # reading off the end of the address space, which reads back 0.
+        self.cpuReadMap = [(None, 0)] * 257
+        self.cpuWriteMap = [(None, 0)] * 257
+        self.cpuReadHandler = [self.cartRead] * 257
+        self.cpuWriteHandler = [self.cartWrite] * 257
+        # pages of prg rom, as the cartridge declares them: what the block
+        # cache may translate and idle loops found there may be remembered
+        self.cpuRomPages = [False] * 257
+        # bumped whenever the page tables change, so tools caching what the cpu
+        # sees (the disassembler) know to start over
+        self.mapVersion = 0
+        self.updateMemoryMap()
 
         self.cpu.ConnectBus(self)
+        self.apu.ConnectBus(self)
+
+    def updateMemoryMap(self, first=0x00, last=0xFF):
+        # Rebuilds the page tables for pages first..last. Called for all of
+        # them when a cartridge is inserted, and by the mapper for the pages
+        # whose banks it switched.
+        for page in range(first, last + 1):
+            readPage = self.cart.cpuReadPage(page) if self.cart is not None else None
+            writePage = self.cart.cpuWritePage(page) if self.cart is not None else None
+
+            if readPage is not None:
+                self.cpuReadMap[page] = readPage
+            elif page <= 0x1F:
+                self.cpuReadMap[page] = (self.cpuRam, (page & 0x07) << 8)
+            else:
+                self.cpuReadMap[page] = (None, 0)
+                self.cpuReadHandler[page] = self.ppuRegisterRead if page <= 0x3F else self.ioRead if page == 0x40 else self.cartRead
+
+            self.cpuRomPages[page] = self.cart is not None and self.cart.cpuRomPage(page)
+
+            if writePage is not None:
+                self.cpuWriteMap[page] = writePage
+            elif page <= 0x1F:
+                self.cpuWriteMap[page] = (self.cpuRam, (page & 0x07) << 8)
+            else:
+                self.cpuWriteMap[page] = (None, 0)
+                self.cpuWriteHandler[page] = self.ppuRegisterWrite if page <= 0x3F else self.ioWrite if page == 0x40 else self.cartWrite
+        self.mapVersion += 1
+        if self.blockCache is not None:
+            self.blockCache.InvalidatePages(first, last)
+
+    def SyncPpu(self):
+        # runs the ppu up to the current master clock
+        self.ppu.run_dots(self.systemClockCounter - self.ppuClock)
+        self.ppuClock = self.systemClockCounter
+        self.ppuEventClock = self.systemClockCounter + self.ppu.DotsUntilEvent()
+        if self.systemClockCounter >= self.apuIrqClock:
+            self.UpdateApuIrq()
+        elif self.apuIrqClock < self.ppuEventClock:
+            self.ppuEventClock = self.apuIrqClock
+
+    def UpdateApuIrq(self):
+        # runs the apu up to the cpu, which raises any irq that is due, and
+        # works out when the next one comes
+        self.apu.Run(self.cpu.clock_count)
+        cycles = self.apu.IrqCycles()
+        self.apuIrqClock = self.systemClockCounter + cycles * 3 if cycles is not None else self.NO_EVENT
+        if self.apuIrqClock < self.ppuEventClock:
+            self.ppuEventClock = self.apuIrqClock
+
+    def ppuRegisterRead(self, addr, readonly):
+        if self.ppuClock != self.systemClockCounter:
+            self.SyncPpu()
+        return self.ppu.cpuRead(addr & 0x0007, readonly)
+
+    def ppuRegisterWrite(self, addr, data):
+        if self.ppuClock != self.systemClockCounter:
+            self.SyncPpu()
+        self.ppu.cpuWrite(addr & 0x0007, data)
+        # the mask, sprite size and oam decide when sprite flags can be set
+        self.ppuEventClock = min(self.systemClockCounter + self.ppu.DotsUntilEvent(), self.apuIrqClock)
+
+    def ioRead(self, addr, readonly):
+        if addr == 0x4016 or addr == 0x4017:
+            # buttons come out one per read, A first, then 1s
+            port = addr & 0x0001
+            if self.controllerStrobe:
+                self.controllerShift[port] = self.controller[port]
+            data = (self.controllerShift[port] & 0x80) >> 7
+            if not readonly:
+                self.controllerShift[port] = ((self.controllerShift[port] << 1) | 0x01) & 0xFF
+            return data
+        if addr == 0x4015:
+            data = self.apu.cpuRead(addr, self.cpu.clock_count, readonly)
+            if not readonly:
+                # acknowledging the frame irq lets the next one come
+                self.UpdateApuIrq()
+            return data
+        return self.cartRead(addr, readonly)
+
+    def ioWrite(self, addr, data):
+        if addr == 0x4014:
+            self.OamDma(data)
+        elif addr == 0x4016:
+            # the pads are latched while the strobe is high
+            if self.controllerStrobe or (data & 0x01):
+                self.controllerShift[0] = self.controller[0]
+                self.controllerShift[1] = self.controller[1]
+            self.controllerStrobe = data & 0x01
+        elif addr <= 0x4017:
+            self.apu.cpuWrite(addr, data, self.cpu.clock_count)
+            if addr in self.apu.IMMEDIATE:
+                self.UpdateApuIrq()
+        else:
+            self.cartWrite(addr, data)
+
+    def OamDma(self, page):
+        # Copies cpu page $XX00-$XXFF to oam in one go. The cpu is stalled for
+        # 513 cycles, 514 when the dma starts on an odd cycle; they are owed
+        # through cpu.cycles and added to the cycles of the writing instruction.
+        if self.ppuClock != self.systemClockCounter:
+            self.SyncPpu()
+        memory, offset = self.cpuReadMap[page]
+        if memory is not None:
+            data = memory[offset:offset + 256]
+        else:
+            data = bytes(self.cpuRead((page << 8) | i) for i in range(256))
+        self.ppu.WriteOam(data)
+        self.cpu.cycles += 513 + (self.cpu.clock_count & 1)
+        self.ppuEventClock = min(self.systemClockCounter + self.ppu.DotsUntilEvent(), self.apuIrqClock)
+
+    def cartRead(self, addr, readonly):
+        if self.cart is not None:
+            data = self.cart.cpuRead(addr)
+            if data is not None:
+                return data
+        return 0x00
+
+    def cartWrite(self, addr, data):
+        # a mapper may switch the banks or mirroring the ppu is reading from,
+        # the dots before this one are drawn with the old ones
+        if self.ppuClock != self.systemClockCounter:
+            self.SyncPpu()
+        if self.cart is not None:
+            self.ppu.CatchUp()
+            self.cart.cpuWrite(addr, data)
+            if self.cart.mapper.countsScanlines:
+                # the scanline irq may have been set up or acknowledged
+                self.ppuEventClock = min(self.systemClockCounter + self.ppu.DotsUntilEvent(), self.apuIrqClock)
 
     def cpuWrite(self, addr, data):
-        if self.cart.cpuWrite(addr, data):
-            pass
-        elif addr >= 0x0000 and addr <= 0x1FFF:
-            self.cpuRam[addr & 0x07FF] = data
-        elif addr >= 0x2000 and addr <= 0x3FFF:
-            self.ppu.cpuWrite(addr & 0x0007, data)
+        memory, offset = self.cpuWriteMap[addr >> 8]
+        if memory is not None:
+            memory[offset + (addr & 0x00FF)] = data
+        else:
+            self.cpuWriteHandler[addr >> 8](addr, data)
 
     def cpuRead(self, addr, readonly=False):
-        data = 0x00
-        #print("reading from 0x%04X" % (addr))
-        cartData = self.cart.cpuRead(addr)
-        #print("  (CPU) cart handled)" if cartData is not None else "  (CPU) (cart did not handle)")
-        if cartData:
-            data = cartData
-        elif addr >= 0x0000 and addr <= 0x1FFF:
-            data = self.cpuRam[addr & 0x07FF]
-        elif addr >= 0x2000 and addr <=0x3FFF:
-            data = self.ppu.cpuRead(addr & 0x0007, readonly)
-            # print("  (BUS) data is 0x%02X" % (data))
-        #print("  (CPU) returning %02X" % data)
-        return data
+        memory, offset = self.cpuReadMap[addr >> 8]
+        if memory is not None:
+            return memory[offset + (addr & 0x00FF)]
+        return self.cpuReadHandler[addr >> 8](addr, readonly)
 
     def insertCartridge(self, cartridge):
         self.cart = cartridge
         self.ppu.ConnectCartridge(cartridge)
+        cartridge.ConnectBus(self)
+        self.updateMemoryMap()
+
+    def save_state(self):
+        # Snapshot of the whole machine as a compact binary blob, cheap enough
+        # to take every frame. Write it to a file or keep it in memory.
+        self.SyncPpu()
+        self.apu.Run(self.cpu.clock_count)
+        cart = self.cart
+        return b''.join([
+            self.STATE_HEADER.pack(self.STATE_MAGIC, self.STATE_VERSION,
+                cart.mapperID if cart is not None else 0,
+                cart.prgBanks if cart is not None else 0,
+                cart.chrBanks if cart is not None else 0),
+            self.STATE_BUS.pack(self.systemClockCounter, self.controller[0], self.controller[1],
+                self.controllerShift[0], self.controllerShift[1], self.controllerStrobe),
+            bytes(self.cpuRam),
+            self.cpu.save_state(),
+            self.ppu.save_state(),
+            self.apu.save_state(),
+            cart.save_state() if cart is not None else b''])
+
+    def load_state(self, data):
+        # Restores a snapshot taken by save_state with the same cartridge inserted
+        cart = self.cart
+        magic, version, mapperID, prgBanks, chrBanks = self.STATE_HEADER.unpack_from(data, 0)
+        if magic != self.STATE_MAGIC:
+            raise ValueError("not a save state")
+        if version != self.STATE_VERSION:
+            raise ValueError("unsupported save state version %d" % version)
+        if cart is not None and (mapperID, prgBanks, chrBanks) != (cart.mapperID, cart.prgBanks, cart.chrBanks):
+            raise ValueError("save state is for a different cartridge")
+        offset = self.STATE_HEADER.size
+
+        (self.systemClockCounter, self.controller[0], self.controller[1],
+            self.controllerShift[0], self.controllerShift[1], self.controllerStrobe) = self.STATE_BUS.unpack_from(data, offset)
+        self.ppuClock = self.ppuEventClock = self.systemClockCounter
+        offset += self.STATE_BUS.size
+        # ram is updated in place, the page tables hold references to it
+        self.cpuRam[:] = data[offset:offset + len(self.cpuRam)]
+        offset += len(self.cpuRam)
+        offset = self.cpu.load_state(data, offset)
+        offset = self.ppu.load_state(data, offset)
+        offset = self.apu.load_state(data, offset)
+        if cart is not None:
+            offset = cart.load_state(data, offset)
+        # the mapper registers may select different banks
+        self.updateMemoryMap()
+        self.idleState = None
+        self.UpdateApuIrq()
 
     def reset(self):
+        self.SyncPpu()
         self.cpu.reset()
+        self.apu.Reset(self.cpu.clock_count)
         self.systemClockCounter = 0
+        self.ppuClock = self.ppuEventClock = 0
+        self.UpdateApuIrq()
+
+    def FindIdleLoop(self, pc):
+        # Cycles per iteration if the code at pc is a loop that can only end
+        # through an interrupt or a ppu event: a jump to itself, or a load or
+        # BIT of ram or the ppu status register followed by a branch back to
+        # it. Returns (cycles, may be cached).
+        read = lambda addr: self.cpuRead(addr & 0xFFFF, True)
+        rom = self.cpuRomPages[pc >> 8] and (pc & 0xFF) <= 0xFA
+        opcode = read(pc)
+        if opcode == 0x4C:
+            return (3 if read(pc + 1) | (read(pc + 2) << 8) == pc else None), rom
+
+        # LDA/LDX/LDY/BIT, zero page or absolute
+        if opcode in (0xA5, 0xA6, 0xA4, 0x24):
+            addr = read(pc + 1)
+            size = 2
+        elif opcode in (0xAD, 0xAE, 0xAC, 0x2C):
+            addr = read(pc + 1) | (read(pc + 2) << 8)
+            size = 3
+        else:
+            return None, rom
+        if not (addr <= 0x1FFF or (addr <= 0x3FFF and (addr & 0x0007) == 0x0002)):
+            return None, rom
+        branch = read(pc + size)
+        following = pc + size + 2
+        offset = read(pc + size + 1)
+        target = following + (offset - 256 if offset & 0x80 else offset)
+        if branch not in (0x10, 0x30, 0x50, 0x70, 0x90, 0xB0, 0xD0, 0xF0) or target != pc:
+            return None, rom
+        return size + 1 + 3 + (1 if (target & 0xFF00) != (following & 0xFF00) else 0), rom
+
+    def SkipIdleLoop(self, pc):
+        # Called when a step starts where one of the last two began. Once an
+        # idle loop has gone round exactly once (nothing else, such as an nmi
+        # handler, ran) without changing the registers or the ppu status, every
+        # further iteration until the next ppu event is the same, so they are
+        # run all at once. Returns the cycles skipped.
+        if self.idleLoopsVersion != self.mapVersion:
+            self.idleLoops.clear()
+            self.idleLoopsVersion = self.mapVersion
+        cycles = self.idleLoops.get(pc, 0)
+        if cycles == 0:
+            cycles, cache = self.FindIdleLoop(pc)
+            if cache or cycles is None:
+                # a loop in ram is looked at again, the code may change
+                self.idleLoops[pc] = cycles
+        if cycles is None:
+            return 0
+
+        cpu = self.cpu
+        state = (pc, cpu.a, cpu.x, cpu.y, cpu.status, cpu.stkp, self.ppu.status)
+        if state != self.idleState or cpu.clock_count - self.idleClock != cycles or cpu.cycles > 0:
+            self.idleState = state
+            self.idleClock = cpu.clock_count
+            return 0
+        skipped = ((self.ppuEventClock - self.systemClockCounter) // (cycles * 3)) * cycles
+        cpu.clock_count += skipped
+        self.systemClockCounter += skipped * 3
+        self.idleCyclesSkipped += skipped
+        return skipped
+
+    def useBlockCache(self, enabled=True):
+        self.blockCache = Nes6502Blocks.BlockCache(self) if enabled else None
+
+    def useAudio(self, enabled=True, sampleRate=Nes2A03.SAMPLE_RATE):
+        # synthesize samples into apu.samples; without it only what the cpu
+        # can see of the apu is run
+        self.apu.Run(self.cpu.clock_count)
+        self.apu.SetAudio(enabled, sampleRate)
+
+    def step(self):
+        # Catch-up scheduler: runs one whole cpu instruction and moves the
+        # master clock on by the 3 dots per cpu cycle it took. The ppu is only
+        # run once the clock passes its next event, or on a register access,
+        # so it advances in large batches. Interrupts are taken on instruction
+        # boundaries. With the block cache a step may run several instructions.
+        if self.ppu.nmi:
+            self.ppu.nmi = False
+            self.cpu.nmi()
+        elif (self.apu.irq or (self.cart is not None and self.cart.mapper.irq)) and not (self.cpu.status & self.cpu.FLAGS6502_I):
+            self.cpu.irq()
+
+        if self.skipIdleLoops:
+            pc = self.cpu.pc
+            if pc == self.recentPc or pc == self.olderPc:
+                skipped = self.SkipIdleLoop(pc)
+                if skipped > 0:
+                    return skipped
+            self.olderPc = self.recentPc
+            self.recentPc = pc
+
+        cycles = self.cpu.step() if self.blockCache is None else self.blockCache.step()
+        self.systemClockCounter += cycles * 3
+        if self.systemClockCounter > self.ppuEventClock:
+            self.SyncPpu()
+        return cycles
+
+    def runFrame(self):
+        while not self.ppu.frame_complete:
+            self.step()
+        self.ppu.frame_complete = False
+        # a frame of audio at a time
+        self.apu.Run(self.cpu.clock_count)
 
     def clock(self):
+        # dot by dot, the ppu is never behind
+        if self.ppuClock != self.systemClockCounter:
+            self.SyncPpu()
+        if self.systemClockCounter >= self.apuIrqClock:
+            self.UpdateApuIrq()
         self.ppu.clock()
         if self.systemClockCounter % 3 == 0:
+            if (self.apu.irq or (self.cart is not None and self.cart.mapper.irq)) and self.cpu.cycles == 0:
+                self.cpu.irq()
             self.cpu.clock()
 
         if self.ppu.nmi:
             self.ppu.nmi = False
             self.cpu.nmi()
         self.systemClockCounter += 1
+        self.ppuClock = self.ppuEventClock = self.systemClockCounter
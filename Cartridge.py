@@ -1,5 +1,24 @@
 import struct
+
+import RomImage
+import Mapper
 from Mapper_000 import Mapper_000
+from Mapper_001 import Mapper_001
+from Mapper_002 import Mapper_002
+from Mapper_003 import Mapper_003
+from Mapper_004 import Mapper_004
+
+# mapper id -> Mapper subclass, extended with RegisterMapper
+MAPPERS = {
+    0: Mapper_000,
+    1: Mapper_001,
+    2: Mapper_002,
+    3: Mapper_003,
+    4: Mapper_004,
+}
+
+def RegisterMapper(mapperID, mapperClass):
+    MAPPERS[mapperID] = mapperClass
 
 # from ctypes import *
 # class CARTHEADER(Structure):
@@ -16,68 +35,140 @@ from Mapper_000 import Mapper_000
 #     ]
 
 class Cartridge:
-    MIRROR_HORIZONTAL   = 0
-    MIRROR_VERTICAL     = 1
-    MIRROR_ONESCREEN_LO = 2
-    MIRROR_ONESCREEN_HI = 3
+    MIRROR_HORIZONTAL   = Mapper.MIRROR_HORIZONTAL
+    MIRROR_VERTICAL     = Mapper.MIRROR_VERTICAL
+    MIRROR_ONESCREEN_LO = Mapper.MIRROR_ONESCREEN_LO
+    MIRROR_ONESCREEN_HI = Mapper.MIRROR_ONESCREEN_HI
+    MIRROR_FOURSCREEN   = Mapper.MIRROR_FOURSCREEN
 
     def __init__(self, filename):
-        def readFile(filename):
-            try:
-                f = open(filename, 'rb')
-            except:
-                return
-            headerData = f.read(16)
-            header = struct.unpack('>4sBBBBBBB5s', headerData)
-
-            if header[3] & 0x04 > 0:
-                f.read(512)
-
-            self.mapperID = ((header[4] >> 4) << 4) | (header[3] >> 4)
-            self.mirror = self.MIRROR_VERTICAL if (header[3] & 0x01) > 0 else self.MIRROR_HORIZONTAL
-
-            fileType = 1    # assume filetype 1 for now
-
-            if fileType == 0:
-                pass
-            elif fileType == 1:
-                self.prgBanks = header[1]
-                self.prgMemory = list(f.read(self.prgBanks * 16384))
-                self.chrBanks = header[2]
-                self.chrMemory = list(f.read(self.chrBanks * 8192))
-            elif fileType == 2:
-                pass
-
-            f.close()
-
-
-        self.prgMemory = []
-        self.chrMemory = []
-
-        self.mapperID = 0
-        self.prgBanks = 0
-        self.chrBanks = 0
-
-        readFile(filename)
-
-        self.mapper = None
-        if self.mapperID == 0:
-            self.mapper = Mapper_000(self.prgBanks, self.chrBanks)
+        # the rom image is shared with every other cartridge loaded from the
+        # same rom, prg and chr rom are its read-only bytes
+        self.image = RomImage.Load(filename)
+
+        self.mapperID = self.image.mapperID
+        if self.image.fourScreen:
+            self.headerMirror = self.MIRROR_FOURSCREEN
+        else:
+            self.headerMirror = self.MIRROR_VERTICAL if self.image.verticalMirror else self.MIRROR_HORIZONTAL
+        # the extra 2KB of vram of four-screen boards, nametables 2 and 3
+        self.nameRam = [bytearray(1024), bytearray(1024)] if self.image.fourScreen else None
+        self.ppu = None
+        self.prgBanks = self.image.prgBanks
+        self.chrBanks = self.image.chrBanks
+        self.prgMemory = self.image.prg
+        if self.chrBanks == 0:
+            # no chr rom, the board has 8KB of chr ram instead
+            self.chrMemory = bytearray(8192)
+        else:
+            self.chrMemory = self.image.chr
+
+        mapperClass = MAPPERS.get(self.mapperID)
+        if mapperClass is None:
+            raise ValueError("%s: mapper %d is not supported" % (filename, self.mapperID))
+        self.mapper = mapperClass(self.prgBanks, self.chrBanks)
+        self.prgRam = bytearray(8192) if self.mapper.hasPrgRam else None
+        self.mirror = self.headerMirror
+        self.mapper.onMirrorChanged = self.SetMirror
+        self.SetMirror(self.mapper.mirror)
+
+        # Chr rom tiles decoded by the ppu, by their offset in chr rom / 16, so
+        # a bank that is switched out and back in is not decoded again
+        self.chrTiles = {}
+
+    def ConnectBus(self, bus):
+        # bank switches update just the affected cpu pages, and drop the ppu's
+        # decoded tiles for just the affected chr slots
+        self.mapper.onPrgChanged = bus.updateMemoryMap
+        self.mapper.onChrChanged = bus.ppu.InvalidateTiles
+        self.ppu = bus.ppu
+
+    def SetMirror(self, mirror):
+        # four-screen boards wire up all four nametables whatever the mapper
+        # selects; the ppu rebuilds its nametable map from this
+        if mirror is None or self.headerMirror == self.MIRROR_FOURSCREEN:
+            self.mirror = self.headerMirror
+        else:
+            self.mirror = mirror
+        if self.ppu is not None:
+            self.ppu.UpdateNametables()
+
+    def ChrTileKey(self, index):
+        # key of pattern table tile `index` (0-511) in chrTiles, None for chr ram
+        if self.chrBanks == 0:
+            return None
+        return self.mapper.ppuMapRead(index << 4) >> 4
+
+    def save_state(self):
+        # chr memory is only saved when it is ram, prg rom comes from the rom file
+        chrRam = bytes(self.chrMemory) if self.chrBanks == 0 else b''
+        prgRam = bytes(self.prgRam) if self.prgRam is not None else b''
+        nameRam = b''.join(self.nameRam) if self.nameRam is not None else b''
+        return b''.join([self.mapper.save_state(), struct.pack('<I', len(chrRam)), chrRam,
+            struct.pack('<I', len(prgRam)), prgRam, struct.pack('<I', len(nameRam)), nameRam])
+
+    def load_state(self, data, offset):
+        offset = self.mapper.load_state(data, offset)
+        size, = struct.unpack_from('<I', data, offset)
+        offset += 4
+        if size > 0:
+            self.chrMemory[:] = data[offset:offset + size]
+        offset += size
+        size, = struct.unpack_from('<I', data, offset)
+        offset += 4
+        if size > 0:
+            # in place, the bus page tables hold references to it
+            self.prgRam[:] = data[offset:offset + size]
+        offset += size
+        size, = struct.unpack_from('<I', data, offset)
+        offset += 4
+        if size > 0:
+            # in place, the ppu's nametable map holds references to them
+            self.nameRam[0][:] = data[offset:offset + 1024]
+            self.nameRam[1][:] = data[offset + 1024:offset + 2048]
+        return offset + size
 
     def cpuRead(self, addr):
         mapped_addr = self.mapper.cpuMapRead(addr)
         if mapped_addr is not None:
             data = self.prgMemory[mapped_addr]
             return data
+        if addr >= 0x6000 and addr <= 0x7FFF and self.mapper.prgRam:
+            return self.prgRam[addr & 0x1FFF]
         return None
 
     def cpuWrite(self, addr, data):
-        mapped_addr = self.mapper.cpuMapWrite(addr)
+        if addr >= 0x6000 and addr <= 0x7FFF and self.mapper.prgRam:
+            self.prgRam[addr & 0x1FFF] = data
+            return data
+        mapped_addr = self.mapper.cpuMapWrite(addr, data)
         if mapped_addr is not None:
-            self.prgMemory[mapped_addr] = data
             return data
         return None
 
+    def cpuReadPage(self, page):
+        if page >= 0x60 and page <= 0x7F and self.mapper.prgRam:
+            return (self.prgRam, (page & 0x1F) << 8)
+        offset = self.mapper.cpuMapReadPage(page)
+        if offset is not None:
+            return (self.prgMemory, offset)
+        return None
+
+    def cpuRomPage(self, page):
+        # whether the cpu page reads prg rom: code and data there can only
+        # change through a bank switch
+        if page >= 0x60 and page <= 0x7F and self.mapper.prgRam:
+            return False
+        return self.mapper.cpuMapReadPage(page) is not None and self.mapper.cpuMapWritePage(page) is None
+
+    def cpuWritePage(self, page):
+        if page >= 0x60 and page <= 0x7F and self.mapper.prgRam:
+            return (self.prgRam, (page & 0x1F) << 8)
+        offset = self.mapper.cpuMapWritePage(page)
+        if offset is not None:
+            return (self.prgMemory, offset)
+        return None
+
     def ppuRead(self, addr):
         mapped_addr = self.mapper.ppuMapRead(addr)
         if mapped_addr is not None:
@@ -0,0 +1,76 @@
+# Decodes instructions on demand around an address for the code view, instead
+# of disassembling the whole address space up front. Decoded lines are cached
+# by address along with the bytes they were decoded from; a line whose bytes
+# have since been written over is decoded again the next time it is asked for,
+# and a bank switch (a new bus map version) drops the whole cache.
+class Disassembler:
+    def __init__(self, bus):
+        self.bus = bus
+        self.cpu = bus.cpu
+        self.mapVersion = bus.mapVersion
+        self.lines = {}     # address -> (text, next address, instruction bytes)
+        self.prevLine = {}  # address -> address of a decoded line ending there
+
+    def Invalidate(self, start=0x0000, stop=0xFFFF):
+        # Drops decoded lines overlapping start..stop, for tools that change
+        # memory behind the cpu's back.
+        for addr in [a for a, line in self.lines.items() if a <= stop and line[1] > start]:
+            del self.lines[addr]
+
+    def GetLine(self, addr):
+        # (text, next address) of the instruction at addr
+        if self.mapVersion != self.bus.mapVersion:
+            self.mapVersion = self.bus.mapVersion
+            self.lines = {}
+            self.prevLine = {}
+
+        read = self.bus.cpuRead
+        line = self.lines.get(addr)
+        if line is not None:
+            text, nextAddr, data = line
+            if all(read(addr + i, True) == data[i] for i in range(len(data))):
+                return text, nextAddr
+
+        text, nextAddr = self.cpu.disassembleInstruction(addr)
+        self.lines[addr] = (text, nextAddr, [read(a, True) for a in range(addr, nextAddr)])
+        return text, nextAddr
+
+    def GetLinesAfter(self, addr, count):
+        # up to count (address, text) lines starting with the one at addr
+        result = []
+        while len(result) < count and addr <= 0xFFFF:
+            text, nextAddr = self.GetLine(addr)
+            result.append((addr, text))
+            self.prevLine[nextAddr] = addr
+            addr = nextAddr
+        return result
+
+    def GetLinesBefore(self, addr, count):
+        # up to count (address, text) lines leading up to addr, in address order
+        result = []
+        while len(result) < count and addr > 0x0000:
+            prev = self.prevLine.get(addr)
+            if prev is None or self.GetLine(prev)[1] != addr:
+                prev = self.FindLineBefore(addr, count - len(result))
+                if prev is None:
+                    break
+            result.append((prev, self.GetLine(prev)[0]))
+            addr = prev
+        result.reverse()
+        return result
+
+    def FindLineBefore(self, addr, count):
+        # Instruction boundaries are ambiguous going backwards, so decode
+        # forward from far enough back to cover count lines and take the first
+        # start whose run of instructions lands exactly on addr.
+        for start in range(max(0x0000, addr - 3 * count), addr):
+            chain = []
+            a = start
+            while a < addr:
+                chain.append(a)
+                a = self.GetLine(a)[1]
+            if a == addr:
+                for prev, nextAddr in zip(chain, chain[1:] + [addr]):
+                    self.prevLine[nextAddr] = prev
+                return chain[-1]
+        return None
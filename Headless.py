@@ -0,0 +1,129 @@
+import argparse
+import time
+import wave
+
+import Bus
+import Cartridge
+import Input
+import Nes2A03
+import Nes6502Profiler
+
+# Runs the emulator without any display, font or event polling. Used for batch
+# regression and throughput jobs on machines without a display (or pygame).
+class Headless:
+    def __init__(self, filename, scanline_render=False, dot_clock=False, block_cache=False, inputs=None, audio=None):
+        self.nes = Bus.Bus()
+        self.nes.ppu.scanline_render = scanline_render
+        # run the bus one ppu dot at a time instead of instruction at a time
+        self.dot_clock = dot_clock
+        self.cartridge = Cartridge.Cartridge(filename)
+        self.nes.insertCartridge(self.cartridge)
+        self.nes.reset()
+        # run prg rom code as translated blocks (see Nes6502Blocks)
+        self.nes.useBlockCache(block_cache)
+        # per frame controller states (Input.InputScript or InputQueue)
+        self.inputs = inputs
+        # audio is only synthesized when there is somewhere for it to go, an
+        # open wave file written to after every frame
+        self.audio = audio
+        if audio is not None:
+            self.nes.useAudio(True)
+
+        self.frame_count = 0
+
+    def write_audio(self):
+        if self.audio is not None:
+            self.nes.apu.Run(self.nes.cpu.clock_count)
+            self.audio.writeframes(self.nes.apu.samples.Read().tobytes())
+
+    def run_frames(self, frames):
+        for i in range(frames):
+            if self.inputs is not None:
+                self.inputs.Apply(self.nes, self.frame_count)
+            if self.dot_clock:
+                self.nes.clock()
+                while not self.nes.ppu.frame_complete:
+                    self.nes.clock()
+                self.nes.ppu.frame_complete = False
+            else:
+                self.nes.runFrame()
+            self.write_audio()
+            self.frame_count += 1
+
+    def run_cycles(self, cycles):
+        # cycles are cpu cycles, the bus clock runs three times as fast
+        step = self.nes.clock if self.dot_clock else self.nes.step
+        target = self.nes.cpu.clock_count + cycles
+        if self.inputs is not None:
+            self.inputs.Apply(self.nes, self.frame_count)
+        while self.nes.cpu.clock_count < target:
+            step()
+            if self.nes.ppu.frame_complete:
+                self.nes.ppu.frame_complete = False
+                self.write_audio()
+                self.frame_count += 1
+                if self.inputs is not None:
+                    self.inputs.Apply(self.nes, self.frame_count)
+        self.write_audio()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run a ROM without a display")
+    parser.add_argument("rom", help="iNES ROM file to load")
+    group = parser.add_mutually_exclusive_group()
+    group.add_argument("--frames", type=int, default=60, help="number of frames to run (default 60)")
+    group.add_argument("--cycles", type=int, help="number of cpu cycles to run instead of frames")
+    parser.add_argument("--scanline", action="store_true", help="render whole scanlines at once instead of dot by dot")
+    parser.add_argument("--dot-clock", action="store_true", help="clock the bus one ppu dot at a time (original timing, slower)")
+    parser.add_argument("--blocks", action="store_true", help="run prg rom code as translated basic blocks")
+    parser.add_argument("--inputs", metavar="FILE", help="replay controller input: one byte per frame and pad (bit 7 A ... bit 0 Right)")
+    parser.add_argument("--input-ports", type=int, choices=(1, 2), default=1, help="pads per frame in the --inputs file (default 1)")
+    parser.add_argument("--audio", metavar="FILE", help="synthesize the apu output into a 16-bit mono wave file")
+    parser.add_argument("--load-state", metavar="FILE", help="resume from a save state before running")
+    parser.add_argument("--save-state", metavar="FILE", help="write a save state after running")
+    parser.add_argument("--profile", metavar="FILE", help="write a per-pc cycle profile of the guest code as csv")
+    parser.add_argument("--profile-by", choices=("pc", "opcode", "mode"), default="pc", help="rows of the --profile report (default pc)")
+    parser.add_argument("--flamegraph", metavar="FILE", help="write guest call stacks in collapsed flamegraph format")
+    args = parser.parse_args()
+
+    inputs = Input.InputScript.Load(args.inputs, args.input_ports) if args.inputs is not None else None
+    audio = None
+    if args.audio is not None:
+        audio = wave.open(args.audio, 'wb')
+        audio.setnchannels(1)
+        audio.setsampwidth(2)
+        audio.setframerate(Nes2A03.SAMPLE_RATE)
+    headless = Headless(args.rom, args.scanline, args.dot_clock, args.blocks, inputs, audio)
+    if args.load_state is not None:
+        with open(args.load_state, 'rb') as f:
+            headless.nes.load_state(f.read())
+    profiler = None
+    if args.profile is not None or args.flamegraph is not None:
+        profiler = Nes6502Profiler.Profiler(headless.nes.cpu)
+        profiler.Start()
+    start = time.perf_counter()
+    if args.cycles is not None:
+        headless.run_cycles(args.cycles)
+    else:
+        headless.run_frames(args.frames)
+    elapsed = time.perf_counter() - start
+    if profiler is not None:
+        profiler.Stop()
+        if args.profile is not None:
+            with open(args.profile, 'w') as f:
+                profiler.WriteReport(f, args.profile_by)
+        if args.flamegraph is not None:
+            with open(args.flamegraph, 'w') as f:
+                profiler.WriteCollapsed(f)
+    if args.save_state is not None:
+        with open(args.save_state, 'wb') as f:
+            f.write(headless.nes.save_state())
+    if audio is not None:
+        audio.close()
+
+    cpu = headless.nes.cpu
+    print("frames: %d  cpu cycles: %d  elapsed: %.3fs  (%.2f fps)" % (
+        headless.frame_count, cpu.clock_count, elapsed,
+        headless.frame_count / elapsed if elapsed > 0 else 0.0))
+    print("PC: $%04X  A: $%02X  X: $%02X  Y: $%02X  P: $%02X  SP: $%02X" % (
+        cpu.pc, cpu.a, cpu.x, cpu.y, cpu.status, cpu.stkp))
@@ -0,0 +1,65 @@
+import collections
+
+# Controller input. A pad's state is one byte, in the order the cpu shifts the
+# buttons out of $4016/$4017: bit 7 is A, then B, Select, Start, Up, Down,
+# Left, and bit 0 is Right. The bus holds the state of each pad in
+# Bus.controller; these feed it once per frame, so nothing is done per poll.
+BUTTON_A      = 0x80
+BUTTON_B      = 0x40
+BUTTON_SELECT = 0x20
+BUTTON_START  = 0x10
+BUTTON_UP     = 0x08
+BUTTON_DOWN   = 0x04
+BUTTON_LEFT   = 0x02
+BUTTON_RIGHT  = 0x01
+
+class InputScript:
+    # Pre-recorded input (a movie): `ports` bytes per frame, pad 1 first. After
+    # the last frame the pads are released.
+    def __init__(self, data, ports=1):
+        self.data = bytes(data)
+        self.ports = ports
+
+    @classmethod
+    def Load(cls, filename, ports=1):
+        with open(filename, 'rb') as f:
+            return cls(f.read(), ports)
+
+    @classmethod
+    def FromList(cls, states):
+        # a list with one entry per frame, either a pad 1 state or a list of
+        # states for pads 1 and 2
+        if any(isinstance(state, (list, tuple)) for state in states):
+            data = bytearray()
+            for state in states:
+                state = state if isinstance(state, (list, tuple)) else [state]
+                data += bytes((list(state) + [0, 0])[:2])
+            return cls(data, 2)
+        return cls(bytes(states), 1)
+
+    def __len__(self):
+        return len(self.data) // self.ports
+
+    def Apply(self, bus, frame):
+        offset = frame * self.ports
+        for port in range(self.ports):
+            bus.controller[port] = self.data[offset + port] if offset + port < len(self.data) else 0x00
+
+class InputQueue:
+    # Live input from a frontend, possibly on another thread: states are pushed
+    # as they come and one is taken per frame. deque appends and pops are
+    # atomic, so neither side takes a lock. When nothing new has been pushed
+    # the pads keep their last state.
+    def __init__(self):
+        self.queue = collections.deque()
+
+    def Push(self, *states):
+        self.queue.append(states)
+
+    def Apply(self, bus, frame):
+        try:
+            states = self.queue.popleft()
+        except IndexError:
+            return
+        for port, state in enumerate(states[:2]):
+            bus.controller[port] = state
@@ -1,17 +1,129 @@
+# nametable mirroring, as selected by the rom header or the mapper
+MIRROR_HORIZONTAL   = 0
+MIRROR_VERTICAL     = 1
+MIRROR_ONESCREEN_LO = 2
+MIRROR_ONESCREEN_HI = 3
+# 2KB of extra vram on the board, nametables are not mirrored
+MIRROR_FOURSCREEN   = 4
+
 class Mapper:
+    # Mappers clocked by the ppu once per rendered scanline (MMC3), see Scanline
+    countsScanlines = False
+    # boards with 8KB of prg ram at $6000-$7FFF
+    hasPrgRam = False
+
     def __init__(self, prgBanks, chrBanks):
         self.prgBanks = prgBanks
         self.chrBanks = chrBanks
-        pass
+        self.prgSize = max(prgBanks, 1) * 0x4000
+        # boards without chr rom have 8KB of chr ram
+        self.chrSize = max(chrBanks, 1) * 0x2000
+
+        # The current bank layout: the offset into prg memory of each 8KB slot
+        # of $8000-$FFFF, and into chr memory of each 1KB slot of the ppu's
+        # $0000-$1FFF. Only MapPrg/MapChr change them.
+        self.prgMap = [(slot * 0x2000) % self.prgSize for slot in range(4)]
+        self.chrMap = [(slot * 0x0400) % self.chrSize for slot in range(8)]
+        # whether prg ram is enabled, the mirroring the mapper has selected
+        # (None keeps the header's), and the mapper's irq line
+        self.prgRam = self.hasPrgRam
+        self.mirror = None
+        self.irq = False
+
+        # Called when the layout changes: onPrgChanged(first page, last page)
+        # with the 256 byte cpu pages that now map elsewhere, onChrChanged(first
+        # slot, last slot) with the 1KB chr slots, onMirrorChanged(mirror).
+        # The cartridge and bus hook these up to update the page tables and
+        # drop cached tiles and translated code for just those parts.
+        self.onPrgChanged = None
+        self.onChrChanged = None
+        self.onMirrorChanged = None
+
+    def MapPrg(self, slot, size, bank):
+        # maps bank number `bank` of `size` KB (8, 16 or 32) at 8KB slot `slot`
+        offset = (bank * size * 0x400) % self.prgSize
+        slots = size // 8
+        first = None
+        for i in range(slots):
+            if self.prgMap[slot + i] != offset + i * 0x2000:
+                self.prgMap[slot + i] = offset + i * 0x2000
+                first = slot + i if first is None else first
+                last = slot + i
+        if first is not None and self.onPrgChanged is not None:
+            self.onPrgChanged(0x80 + first * 0x20, 0x80 + last * 0x20 + 0x1F)
+
+    def MapChr(self, slot, size, bank):
+        # maps bank number `bank` of `size` KB (1, 2, 4 or 8) at 1KB slot `slot`
+        offset = (bank * size * 0x400) % self.chrSize
+        first = None
+        for i in range(size):
+            if self.chrMap[slot + i] != offset + i * 0x400:
+                self.chrMap[slot + i] = offset + i * 0x400
+                first = slot + i if first is None else first
+                last = slot + i
+        if first is not None and self.onChrChanged is not None:
+            self.onChrChanged(first, last)
+
+    def SetPrgRam(self, enabled):
+        if enabled != self.prgRam:
+            self.prgRam = enabled
+            if self.onPrgChanged is not None:
+                self.onPrgChanged(0x60, 0x7F)
 
+    def SetMirror(self, mirror):
+        if mirror != self.mirror:
+            self.mirror = mirror
+            if self.onMirrorChanged is not None:
+                self.onMirrorChanged(mirror)
+
+    # Offset into prg memory of a cpu address, or None when the cartridge does
+    # not answer. $6000-$7FFF is prg ram, which the cartridge handles itself.
     def cpuMapRead(self, addr):
-        raise NotImplementedError()
+        if addr >= 0x8000:
+            return self.prgMap[(addr >> 13) & 0x03] + (addr & 0x1FFF)
+        return None
+
+    # Mapper registers are written here. Returns the offset into prg memory the
+    # write is claimed for, which is read only.
+    def cpuMapWrite(self, addr, data):
+        return None
+
+    # Offset into prg memory that a whole 256 byte cpu page maps to, or None
+    # if accesses to that page have to go through cpuMapRead/cpuMapWrite.
+    # The bus caches these in its page table until the next bank switch.
+    def cpuMapReadPage(self, page):
+        if page >= 0x80:
+            return self.prgMap[(page >> 5) & 0x03] + ((page & 0x1F) << 8)
+        return None
+
+    def cpuMapWritePage(self, page):
+        # prg is rom and register writes have to reach cpuMapWrite
+        return None
 
-    def cpuMapWrite(self, addr):
-        raise NotImplementedError()
+    # Bank registers and any other internal state, for save states. Mappers
+    # without registers have nothing to save.
+    def save_state(self):
+        return b''
+
+    def load_state(self, data, offset):
+        return offset
 
     def ppuMapRead(self, addr):
-        raise NotImplementedError()
+        if addr <= 0x1FFF:
+            return self.chrMap[addr >> 10] + (addr & 0x03FF)
+        return None
 
     def ppuMapWrite(self, addr):
-        raise NotImplementedError()
+        if addr <= 0x1FFF and self.chrBanks == 0:
+            return self.chrMap[addr >> 10] + (addr & 0x03FF)
+        return None
+
+    # Clocked by the ppu at dot 260 of the pre-render and visible scanlines
+    # while rendering, for mappers with countsScanlines
+    def Scanline(self):
+        pass
+
+    # How many more Scanline clocks until the mapper raises its irq, None if
+    # it will not. The bus schedules a ppu event for it.
+    def ScanlinesUntilIrq(self):
+        return None
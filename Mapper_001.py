@@ -0,0 +1,80 @@
+import struct
+
+import Mapper
+
+# MMC1 (SxROM). Registers are loaded one bit at a time through a 5 bit shift
+# register: five writes to $8000-$FFFF, bit 0 first, and the fifth picks the
+# register by its address. A write with bit 7 set resets the shift register
+# and switches to the mode with the last prg bank fixed.
+#   $8000 control: mirroring, prg mode, chr mode
+#   $A000 chr bank for $0000 (all 8KB in 8KB mode)
+#   $C000 chr bank for $1000
+#   $E000 prg bank, bit 4 disables prg ram
+class Mapper_001(Mapper.Mapper):
+    hasPrgRam = True
+    # shift register, control, chr bank 0, chr bank 1, prg bank
+    STATE = struct.Struct('<BBBBB')
+    MIRRORING = (Mapper.MIRROR_ONESCREEN_LO, Mapper.MIRROR_ONESCREEN_HI,
+                 Mapper.MIRROR_VERTICAL, Mapper.MIRROR_HORIZONTAL)
+
+    def __init__(self, prgBanks, chrBanks):
+        super().__init__(prgBanks, chrBanks)
+        # the marker bit reaches bit 0 once four bits have been shifted in
+        self.shift = 0x10
+        self.control = 0x0C
+        self.chrBank0 = 0
+        self.chrBank1 = 0
+        self.prgBank = 0
+        self.UpdateBanks()
+
+    def UpdateBanks(self):
+        self.SetMirror(self.MIRRORING[self.control & 0x03])
+        prgMode = (self.control >> 2) & 0x03
+        bank = self.prgBank & 0x0F
+        if prgMode <= 1:
+            self.MapPrg(0, 32, bank >> 1)
+        elif prgMode == 2:
+            self.MapPrg(0, 16, 0)
+            self.MapPrg(2, 16, bank)
+        else:
+            self.MapPrg(0, 16, bank)
+            self.MapPrg(2, 16, self.prgBanks - 1)
+        if self.control & 0x10:
+            self.MapChr(0, 4, self.chrBank0)
+            self.MapChr(4, 4, self.chrBank1)
+        else:
+            self.MapChr(0, 8, self.chrBank0 >> 1)
+        self.SetPrgRam(not (self.prgBank & 0x10))
+
+    def cpuMapWrite(self, addr, data):
+        if addr < 0x8000:
+            return None
+        if data & 0x80:
+            self.shift = 0x10
+            self.control |= 0x0C
+            self.UpdateBanks()
+            return None
+        full = self.shift & 0x01
+        self.shift = (self.shift >> 1) | ((data & 0x01) << 4)
+        if full:
+            value = self.shift
+            self.shift = 0x10
+            register = (addr >> 13) & 0x03
+            if register == 0:
+                self.control = value
+            elif register == 1:
+                self.chrBank0 = value
+            elif register == 2:
+                self.chrBank1 = value
+            else:
+                self.prgBank = value
+            self.UpdateBanks()
+        return None
+
+    def save_state(self):
+        return self.STATE.pack(self.shift, self.control, self.chrBank0, self.chrBank1, self.prgBank)
+
+    def load_state(self, data, offset):
+        self.shift, self.control, self.chrBank0, self.chrBank1, self.prgBank = self.STATE.unpack_from(data, offset)
+        self.UpdateBanks()
+        return offset + self.STATE.size
@@ -0,0 +1,31 @@
+import struct
+
+import Mapper
+
+# UxROM: a switchable 16KB prg bank at $8000 and the last one fixed at $C000,
+# selected by any write to $8000-$FFFF. Chr is usually 8KB of ram.
+class Mapper_002(Mapper.Mapper):
+    STATE = struct.Struct('<B')
+
+    def __init__(self, prgBanks, chrBanks):
+        super().__init__(prgBanks, chrBanks)
+        self.bank = 0
+        self.UpdateBanks()
+
+    def UpdateBanks(self):
+        self.MapPrg(0, 16, self.bank)
+        self.MapPrg(2, 16, self.prgBanks - 1)
+
+    def cpuMapWrite(self, addr, data):
+        if addr >= 0x8000:
+            self.bank = data
+            self.UpdateBanks()
+        return None
+
+    def save_state(self):
+        return self.STATE.pack(self.bank)
+
+    def load_state(self, data, offset):
+        self.bank, = self.STATE.unpack_from(data, offset)
+        self.UpdateBanks()
+        return offset + self.STATE.size
@@ -0,0 +1,29 @@
+import struct
+
+import Mapper
+
+# CNROM: 16 or 32KB of fixed prg rom and a switchable 8KB chr bank, selected
+# by any write to $8000-$FFFF.
+class Mapper_003(Mapper.Mapper):
+    STATE = struct.Struct('<B')
+
+    def __init__(self, prgBanks, chrBanks):
+        super().__init__(prgBanks, chrBanks)
+        self.bank = 0
+
+    def UpdateBanks(self):
+        self.MapChr(0, 8, self.bank)
+
+    def cpuMapWrite(self, addr, data):
+        if addr >= 0x8000:
+            self.bank = data
+            self.UpdateBanks()
+        return None
+
+    def save_state(self):
+        return self.STATE.pack(self.bank)
+
+    def load_state(self, data, offset):
+        self.bank, = self.STATE.unpack_from(data, offset)
+        self.UpdateBanks()
+        return offset + self.STATE.size
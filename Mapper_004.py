@@ -0,0 +1,113 @@
+import struct
+
+import Mapper
+
+# MMC3 (TxROM): 8KB prg banks, 1 and 2KB chr banks and a scanline counter.
+#   $8000 even: bank select (register, prg mode, chr inversion), odd: bank data
+#   $A000 even: mirroring, odd: prg ram enable
+#   $C000 even: irq latch, odd: reload the counter on the next scanline
+#   $E000 even: disable and acknowledge the irq, odd: enable it
+# The counter is clocked once per rendered scanline at dot 260, which is where
+# the rising edge of ppu A12 comes with background tiles at $0000 and sprites
+# at $1000, the layout nearly every MMC3 game uses.
+class Mapper_004(Mapper.Mapper):
+    countsScanlines = True
+    hasPrgRam = True
+    # bank select, R0-R7, mirroring (0xFF until written), ram enable, irq
+    # latch, counter, reload, enabled, irq
+    STATE = struct.Struct('<B8sBBBB???')
+
+    def __init__(self, prgBanks, chrBanks):
+        super().__init__(prgBanks, chrBanks)
+        self.bankSelect = 0
+        self.registers = bytearray([0, 2, 4, 5, 6, 7, 0, 1])
+        self.mirroring = 0xFF
+        self.ramEnable = 0x80
+        self.irqLatch = 0
+        self.irqCounter = 0
+        self.irqReload = False
+        self.irqEnabled = False
+        self.UpdateBanks()
+
+    def UpdateBanks(self):
+        r = self.registers
+        last = self.prgSize // 0x2000 - 1
+        if self.bankSelect & 0x40:
+            self.MapPrg(0, 8, last - 1)
+            self.MapPrg(2, 8, r[6])
+        else:
+            self.MapPrg(0, 8, r[6])
+            self.MapPrg(2, 8, last - 1)
+        self.MapPrg(1, 8, r[7])
+        self.MapPrg(3, 8, last)
+        # chr inversion swaps the 2KB banks into $1000-$1FFF
+        invert = 4 if self.bankSelect & 0x80 else 0
+        self.MapChr(0 ^ invert, 2, r[0] >> 1)
+        self.MapChr(2 ^ invert, 2, r[1] >> 1)
+        self.MapChr(4 ^ invert, 1, r[2])
+        self.MapChr(5 ^ invert, 1, r[3])
+        self.MapChr(6 ^ invert, 1, r[4])
+        self.MapChr(7 ^ invert, 1, r[5])
+        if self.mirroring == 0xFF:
+            self.SetMirror(None)
+        else:
+            self.SetMirror(Mapper.MIRROR_HORIZONTAL if self.mirroring & 0x01 else Mapper.MIRROR_VERTICAL)
+        self.SetPrgRam(bool(self.ramEnable & 0x80))
+
+    def cpuMapWrite(self, addr, data):
+        if addr < 0x8000:
+            return None
+        odd = addr & 0x01
+        region = addr & 0xE000
+        if region == 0x8000:
+            if odd:
+                self.registers[self.bankSelect & 0x07] = data
+            else:
+                self.bankSelect = data
+            self.UpdateBanks()
+        elif region == 0xA000:
+            if odd:
+                self.ramEnable = data
+            else:
+                self.mirroring = data & 0x01
+            self.UpdateBanks()
+        elif region == 0xC000:
+            if odd:
+                self.irqCounter = 0
+                self.irqReload = True
+            else:
+                self.irqLatch = data
+        else:
+            if odd:
+                self.irqEnabled = True
+            else:
+                self.irqEnabled = False
+                self.irq = False
+        return None
+
+    def Scanline(self):
+        if self.irqCounter == 0 or self.irqReload:
+            self.irqCounter = self.irqLatch
+            self.irqReload = False
+        else:
+            self.irqCounter -= 1
+        if self.irqCounter == 0 and self.irqEnabled:
+            self.irq = True
+
+    def ScanlinesUntilIrq(self):
+        if not self.irqEnabled or self.irq:
+            return None
+        if self.irqCounter == 0 or self.irqReload:
+            return 1 + self.irqLatch
+        return self.irqCounter
+
+    def save_state(self):
+        return self.STATE.pack(self.bankSelect, bytes(self.registers), self.mirroring, self.ramEnable,
+            self.irqLatch, self.irqCounter, self.irqReload, self.irqEnabled, self.irq)
+
+    def load_state(self, data, offset):
+        (self.bankSelect, registers, self.mirroring, self.ramEnable, self.irqLatch, self.irqCounter,
+            self.irqReload, self.irqEnabled, self.irq) = self.STATE.unpack_from(data, offset)
+        self.registers[:] = registers
+        self.UpdateBanks()
+        return offset + self.STATE.size
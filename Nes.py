@@ -2,6 +2,8 @@ import GameEngine
 import Nes6502
 import Bus
 import Cartridge
+import Disassembler
+import Input
 import sys
 import time
 import pygame
@@ -27,23 +29,31 @@ class Nes(GameEngine.GameEngine):
         self.cartridge = Cartridge.Cartridge('nestest.nes')
         self.nes.insertCartridge(self.cartridge)
 
-        self.mapAsm = self.cpu.disassemble(0x0000, 0xFFFF)
+        self.disassembler = Disassembler.Disassembler(self.nes)
 
         self.cpu.reset()
 
     def user_update(self, elapsed_time):
         self.screen.fill((0, 7, 122))
 
+        # pad 1 from the keys held down: X A, Z B, A Select, S Start, arrows
+        keys = pygame.key.get_pressed()
+        self.nes.controller[0] = ((Input.BUTTON_A if keys[pygame.K_x] else 0)
+            | (Input.BUTTON_B if keys[pygame.K_z] else 0)
+            | (Input.BUTTON_SELECT if keys[pygame.K_a] else 0)
+            | (Input.BUTTON_START if keys[pygame.K_s] else 0)
+            | (Input.BUTTON_UP if keys[pygame.K_UP] else 0)
+            | (Input.BUTTON_DOWN if keys[pygame.K_DOWN] else 0)
+            | (Input.BUTTON_LEFT if keys[pygame.K_LEFT] else 0)
+            | (Input.BUTTON_RIGHT if keys[pygame.K_RIGHT] else 0))
+
         completed_frame = False
         if self.emulationRun:
             if self.residualTime > 0.0:
                 self.residualTime -= elapsed_time
             else:
                 self.residualTime += (1.0/60.0) - elapsed_time
-                self.nes.clock()
-                while not self.nes.ppu.frame_complete:
-                    self.nes.clock()
-                self.nes.ppu.frame_complete = False
+                self.nes.runFrame()
                 completed_frame = True
         else:
             if self.keypressed == 'c':
@@ -116,12 +126,14 @@ class Nes(GameEngine.GameEngine):
         self.draw_string(x , y + 50, "Stack P: $" + hex(self.nes.cpu.stkp, 4));
 
     def draw_code(self, x, y, lines):
-        keys = list(self.mapAsm.keys())
-        pc_i = keys.index(self.nes.cpu.pc)
-
-        for i in range(lines):
-            self.draw_string(x, i*10 + y, self.mapAsm[keys[int(pc_i+(i-lines/2))]], self.COLOR_CYAN if (i==lines/2) else self.COLOR_WHITE)
-
+        # the line at pc is drawn in the middle, highlighted
+        middle = lines // 2
+        before = self.disassembler.GetLinesBefore(self.nes.cpu.pc, middle)
+        after = self.disassembler.GetLinesAfter(self.nes.cpu.pc, lines - middle)
+
+        for i, (addr, text) in enumerate(before + after):
+            row = middle - len(before) + i
+            self.draw_string(x, row*10 + y, text, self.COLOR_CYAN if (row==middle) else self.COLOR_WHITE)
 
 if __name__ == "__main__":
     nes = Nes()
@@ -0,0 +1,692 @@
+import array
+import math
+import struct
+
+# The audio processing unit of the 2A03: two pulse channels, a triangle, noise
+# and the delta modulation channel, driven by the frame counter.
+#
+# Nothing is clocked per cpu cycle. Register writes are queued with the cpu
+# cycle they happened on and applied when the apu is run (Run), at the end of
+# every frame or when the cpu reads $4015. Between two changes - a register
+# write or a frame counter step - every channel plays a fixed waveform, so the
+# samples of that whole stretch are computed at once from the waveform
+# position. With audio off (the default) only the parts the cpu can observe
+# are run: length counters, the frame counter and dmc irqs, and the dmc
+# reading its sample.
+#
+# The next irq is known in advance (IrqCycles), the bus stops there to run
+# the apu and raise it.
+
+CPU_CLOCK = 1789773
+SAMPLE_RATE = 44100
+RING_SIZE = 16384
+
+LENGTH_TABLE = [10, 254, 20, 2, 40, 4, 80, 6, 160, 8, 60, 10, 14, 12, 26, 14,
+                12, 16, 24, 18, 48, 20, 96, 22, 192, 24, 72, 26, 16, 28, 32, 30]
+DUTY_TABLE = [(0, 1, 0, 0, 0, 0, 0, 0), (0, 1, 1, 0, 0, 0, 0, 0),
+              (0, 1, 1, 1, 1, 0, 0, 0), (1, 0, 0, 1, 1, 1, 1, 1)]
+TRIANGLE_TABLE = list(range(15, -1, -1)) + list(range(16))
+NOISE_PERIODS = [4, 8, 16, 32, 64, 96, 128, 160, 202, 254, 380, 508, 762, 1016, 2034, 4068]
+DMC_RATES = [428, 380, 340, 320, 286, 254, 226, 214, 190, 160, 142, 128, 106, 84, 72, 54]
+
+# frame counter steps, in cpu cycles after a $4017 write: (cycle, quarter
+# frame, half frame, irq). The last entry starts the sequence over.
+FRAME_STEPS = [
+    [(7457, True, False, False), (14913, True, True, False), (22371, True, False, False),
+     (29829, True, True, True), (29830, False, False, False)],
+    [(7457, True, False, False), (14913, True, True, False), (22371, True, False, False),
+     (37281, True, True, False), (37282, False, False, False)]]
+FRAME_IRQ_CYCLE = 29829
+FRAME_PERIOD = 29830
+
+# non-linear mixer, scaled to signed 16-bit samples
+PULSE_MIX = [0 if n == 0 else int(95.52 / (8128.0 / n + 100) * 65000) for n in range(31)]
+TND_MIX = [0 if n == 0 else int(163.67 / (24329.0 / n + 100) * 65000) for n in range(203)]
+
+# The noise shift register in long mode runs through all 32767 non-zero
+# states; with the sequence in a table any later state is a single index.
+# Built the first time audio needs it.
+noiseStates = None
+noiseIndex = None
+
+def NoiseSequence():
+    global noiseStates, noiseIndex
+    if noiseStates is None:
+        states = array.array('H', bytes(2 * 32767))
+        lfsr = 1
+        for i in range(32767):
+            states[i] = lfsr
+            lfsr = (lfsr >> 1) | (((lfsr ^ (lfsr >> 1)) & 0x01) << 14)
+        noiseStates = states
+        noiseIndex = {state: i for i, state in enumerate(states)}
+    return noiseStates, noiseIndex
+
+class RingBuffer:
+    # Fixed size buffer of signed 16-bit samples. When the reader falls behind
+    # the oldest samples are overwritten.
+    def __init__(self, size=RING_SIZE):
+        self.buffer = array.array('h', bytes(2 * size))
+        self.size = size
+        self.start = 0
+        self.count = 0
+
+    def Write(self, samples):
+        size = self.size
+        if len(samples) > size:
+            samples = samples[-size:]
+        n = len(samples)
+        end = (self.start + self.count) % size
+        first = min(n, size - end)
+        self.buffer[end:end + first] = samples[:first]
+        self.buffer[:n - first] = samples[first:]
+        self.count += n
+        if self.count > size:
+            self.start = (self.start + self.count - size) % size
+            self.count = size
+
+    def Read(self, maximum=None):
+        n = self.count if maximum is None else min(maximum, self.count)
+        start = self.start
+        samples = self.buffer[start:start + n]
+        if len(samples) < n:
+            samples += self.buffer[:n - len(samples)]
+        self.start = (start + n) % self.size
+        self.count -= n
+        return samples
+
+    def Clear(self):
+        self.start = 0
+        self.count = 0
+
+class Envelope:
+    # loop (also the length counter halt), constant, start, volume, divider, decay
+    STATE = struct.Struct('<???BBB')
+
+    def __init__(self):
+        self.loop = False
+        self.constant = False
+        self.start = False
+        self.volume = 0
+        self.divider = 0
+        self.decay = 0
+
+    def Write(self, data):
+        self.loop = bool(data & 0x20)
+        self.constant = bool(data & 0x10)
+        self.volume = data & 0x0F
+
+    def Clock(self):
+        if self.start:
+            self.start = False
+            self.decay = 15
+            self.divider = self.volume
+        elif self.divider == 0:
+            self.divider = self.volume
+            if self.decay > 0:
+                self.decay -= 1
+            elif self.loop:
+                self.decay = 15
+        else:
+            self.divider -= 1
+
+    def Output(self):
+        return self.volume if self.constant else self.decay
+
+    def save_state(self):
+        return self.STATE.pack(self.loop, self.constant, self.start, self.volume, self.divider, self.decay)
+
+    def load_state(self, data, offset):
+        (self.loop, self.constant, self.start, self.volume, self.divider,
+            self.decay) = self.STATE.unpack_from(data, offset)
+        return offset + self.STATE.size
+
+class Pulse:
+    # enabled, duty, sweep (enabled, period, negate, shift, reload, divider),
+    # timer, length, phase
+    STATE = struct.Struct('<?B?B?B?BHBI')
+
+    def __init__(self, channel):
+        # pulse 1 negates its sweep with one's complement, pulse 2 with two's
+        self.channel = channel
+        self.envelope = Envelope()
+        self.enabled = False
+        self.duty = 0
+        self.sweep_enabled = False
+        self.sweep_period = 0
+        self.sweep_negate = False
+        self.sweep_shift = 0
+        self.sweep_reload = False
+        self.sweep_divider = 0
+        self.timer = 0
+        self.length = 0
+        # cpu cycles into the 8 step sequence
+        self.phase = 0
+
+    def Write(self, register, data):
+        if register == 0:
+            self.duty = data >> 6
+            self.envelope.Write(data)
+        elif register == 1:
+            self.sweep_enabled = bool(data & 0x80)
+            self.sweep_period = (data >> 4) & 0x07
+            self.sweep_negate = bool(data & 0x08)
+            self.sweep_shift = data & 0x07
+            self.sweep_reload = True
+        elif register == 2:
+            self.SetTimer((self.timer & 0x0700) | data)
+        else:
+            self.SetTimer((self.timer & 0x00FF) | ((data & 0x07) << 8))
+            if self.enabled:
+                self.length = LENGTH_TABLE[data >> 3]
+            self.envelope.start = True
+            self.phase = 0
+
+    def SetTimer(self, timer):
+        # keeps the sequencer on the same step
+        period = (self.timer + 1) * 2
+        step, within = divmod(self.phase, period)
+        self.timer = timer
+        period = (timer + 1) * 2
+        self.phase = step * period + min(within, period - 1)
+
+    def Target(self):
+        change = self.timer >> self.sweep_shift
+        if not self.sweep_negate:
+            return self.timer + change
+        return max(0, self.timer - change - (1 if self.channel == 0 else 0))
+
+    def Muted(self):
+        return self.timer < 8 or self.Target() > 0x07FF
+
+    def QuarterFrame(self):
+        self.envelope.Clock()
+
+    def HalfFrame(self):
+        if self.length > 0 and not self.envelope.loop:
+            self.length -= 1
+        if self.sweep_divider == 0 and self.sweep_enabled and self.sweep_shift > 0 and not self.Muted():
+            self.SetTimer(self.Target())
+        if self.sweep_divider == 0 or self.sweep_reload:
+            self.sweep_divider = self.sweep_period
+            self.sweep_reload = False
+        else:
+            self.sweep_divider -= 1
+
+    def Samples(self, offsets, cycles):
+        # output at each offset into the next `cycles` cycles, None if silent
+        period = (self.timer + 1) * 2
+        phase = self.phase
+        self.phase = (phase + cycles) % (period * 8)
+        volume = self.envelope.Output() if self.length > 0 and not self.Muted() else 0
+        if volume == 0:
+            return None
+        duty = DUTY_TABLE[self.duty]
+        return [volume if duty[int((phase + offset) // period) & 7] else 0 for offset in offsets]
+
+    def save_state(self):
+        return self.STATE.pack(self.enabled, self.duty, self.sweep_enabled, self.sweep_period, self.sweep_negate,
+            self.sweep_shift, self.sweep_reload, self.sweep_divider, self.timer, self.length,
+            self.phase) + self.envelope.save_state()
+
+    def load_state(self, data, offset):
+        (self.enabled, self.duty, self.sweep_enabled, self.sweep_period, self.sweep_negate,
+            self.sweep_shift, self.sweep_reload, self.sweep_divider, self.timer, self.length,
+            self.phase) = self.STATE.unpack_from(data, offset)
+        return self.envelope.load_state(data, offset + self.STATE.size)
+
+class Triangle:
+    # enabled, control, linear reload value, linear reload flag, linear
+    # counter, timer, length, phase
+    STATE = struct.Struct('<??B?BHBI')
+
+    def __init__(self):
+        self.enabled = False
+        self.control = False
+        self.linear_reload = 0
+        self.linear_reload_flag = False
+        self.linear = 0
+        self.timer = 0
+        self.length = 0
+        # cpu cycles into the 32 step sequence
+        self.phase = 0
+
+    def Write(self, register, data):
+        if register == 0:
+            self.control = bool(data & 0x80)
+            self.linear_reload = data & 0x7F
+        elif register == 2:
+            self.SetTimer((self.timer & 0x0700) | data)
+        elif register == 3:
+            self.SetTimer((self.timer & 0x00FF) | ((data & 0x07) << 8))
+            if self.enabled:
+                self.length = LENGTH_TABLE[data >> 3]
+            self.linear_reload_flag = True
+
+    def SetTimer(self, timer):
+        step, within = divmod(self.phase, self.timer + 1)
+        self.timer = timer
+        self.phase = step * (timer + 1) + min(within, timer)
+
+    def QuarterFrame(self):
+        if self.linear_reload_flag:
+            self.linear = self.linear_reload
+        elif self.linear > 0:
+            self.linear -= 1
+        if not self.control:
+            self.linear_reload_flag = False
+
+    def HalfFrame(self):
+        if self.length > 0 and not self.control:
+            self.length -= 1
+
+    def Samples(self, offsets, cycles):
+        period = self.timer + 1
+        phase = self.phase
+        # the sequencer stops when either counter runs out, holding its
+        # output. Ultrasonic periods are held too instead of aliasing.
+        if self.length == 0 or self.linear == 0 or self.timer < 2:
+            return [TRIANGLE_TABLE[(phase // period) & 31]] * len(offsets)
+        self.phase = (phase + cycles) % (period * 32)
+        return [TRIANGLE_TABLE[int((phase + offset) // period) & 31] for offset in offsets]
+
+    def save_state(self):
+        return self.STATE.pack(self.enabled, self.control, self.linear_reload, self.linear_reload_flag,
+            self.linear, self.timer, self.length, self.phase)
+
+    def load_state(self, data, offset):
+        (self.enabled, self.control, self.linear_reload, self.linear_reload_flag,
+            self.linear, self.timer, self.length, self.phase) = self.STATE.unpack_from(data, offset)
+        return offset + self.STATE.size
+
+class Noise:
+    # enabled, mode, period, length, shift register, phase
+    STATE = struct.Struct('<??HBHI')
+
+    def __init__(self):
+        self.envelope = Envelope()
+        self.enabled = False
+        self.mode = False
+        self.period = NOISE_PERIODS[0]
+        self.length = 0
+        self.lfsr = 1
+        # cpu cycles into the current shift register period
+        self.phase = 0
+
+    def Write(self, register, data):
+        if register == 0:
+            self.envelope.Write(data)
+        elif register == 2:
+            self.mode = bool(data & 0x80)
+            self.period = NOISE_PERIODS[data & 0x0F]
+            self.phase = min(self.phase, self.period - 1)
+        elif register == 3:
+            if self.enabled:
+                self.length = LENGTH_TABLE[data >> 3]
+            self.envelope.start = True
+
+    def QuarterFrame(self):
+        self.envelope.Clock()
+
+    def HalfFrame(self):
+        if self.length > 0 and not self.envelope.loop:
+            self.length -= 1
+
+    def Samples(self, offsets, cycles):
+        period = self.period
+        phase = self.phase
+        clocks, self.phase = divmod(phase + cycles, period)
+        volume = self.envelope.Output() if self.length > 0 else 0
+        if not self.mode:
+            states, index = NoiseSequence()
+            start = index[self.lfsr]
+            self.lfsr = states[(start + clocks) % 32767]
+            if volume == 0:
+                return None
+            return [0 if states[(start + int((phase + offset) // period)) % 32767] & 0x01 else volume
+                for offset in offsets]
+
+        # short mode, the feedback comes from bit 6, stepped one by one
+        lfsr = self.lfsr
+        bits = bytearray(clocks + 1)
+        for i in range(clocks + 1):
+            bits[i] = lfsr & 0x01
+            if i < clocks:
+                lfsr = (lfsr >> 1) | (((lfsr ^ (lfsr >> 6)) & 0x01) << 14)
+        self.lfsr = lfsr
+        if volume == 0:
+            return None
+        return [0 if bits[int((phase + offset) // period)] else volume for offset in offsets]
+
+    def save_state(self):
+        return self.STATE.pack(self.enabled, self.mode, self.period, self.length, self.lfsr,
+            self.phase) + self.envelope.save_state()
+
+    def load_state(self, data, offset):
+        (self.enabled, self.mode, self.period, self.length, self.lfsr,
+            self.phase) = self.STATE.unpack_from(data, offset)
+        return self.envelope.load_state(data, offset + self.STATE.size)
+
+class Dmc:
+    # irq enable, loop, rate, level, sample address, sample length, current
+    # address, bytes remaining, sample buffer (-1 when empty), shift register,
+    # bits remaining, silence, timer, irq
+    STATE = struct.Struct('<??HBHHHHhBB?H?')
+
+    def __init__(self):
+        # reads a byte of the sample from cpu memory
+        self.read = None
+        self.irq_enable = False
+        self.loop = False
+        self.rate = DMC_RATES[0]
+        self.level = 0
+        self.sample_address = 0xC000
+        self.sample_length = 1
+        self.current_address = 0xC000
+        self.bytes_remaining = 0
+        self.buffer = -1
+        self.shift = 0
+        self.bits_remaining = 8
+        self.silence = True
+        # cpu cycles until the output unit is next clocked
+        self.timer = self.rate
+        self.irq = False
+
+    def Write(self, register, data):
+        if register == 0:
+            self.irq_enable = bool(data & 0x80)
+            if not self.irq_enable:
+                self.irq = False
+            self.loop = bool(data & 0x40)
+            self.rate = DMC_RATES[data & 0x0F]
+        elif register == 1:
+            self.level = data & 0x7F
+        elif register == 2:
+            self.sample_address = 0xC000 | (data << 6)
+        else:
+            self.sample_length = (data << 4) | 1
+
+    def Enable(self, enabled):
+        if not enabled:
+            self.bytes_remaining = 0
+        elif self.bytes_remaining == 0:
+            self.current_address = self.sample_address
+            self.bytes_remaining = self.sample_length
+            self.Fill()
+
+    def Fill(self):
+        # the memory reader refills the sample buffer as soon as it empties.
+        # The cpu cycles it steals for the read are not emulated.
+        if self.buffer < 0 and self.bytes_remaining > 0:
+            self.buffer = self.read(self.current_address) if self.read is not None else 0
+            self.current_address = (self.current_address + 1) | 0x8000
+            self.bytes_remaining -= 1
+            if self.bytes_remaining == 0:
+                if self.loop:
+                    self.current_address = self.sample_address
+                    self.bytes_remaining = self.sample_length
+                elif self.irq_enable:
+                    self.irq = True
+
+    def Clock(self):
+        if not self.silence:
+            if self.shift & 0x01:
+                if self.level <= 125:
+                    self.level += 2
+            elif self.level >= 2:
+                self.level -= 2
+        self.shift >>= 1
+        self.bits_remaining -= 1
+        if self.bits_remaining == 0:
+            self.bits_remaining = 8
+            if self.buffer < 0:
+                self.silence = True
+            else:
+                self.silence = False
+                self.shift = self.buffer
+                self.buffer = -1
+                self.Fill()
+
+    def Samples(self, offsets, cycles):
+        if self.bytes_remaining == 0 and self.buffer < 0 and self.silence:
+            # idle, only the timer and the output cycle move on
+            if cycles >= self.timer:
+                clocks = (cycles - self.timer) // self.rate + 1
+                self.bits_remaining = (self.bits_remaining - 1 - clocks) % 8 + 1
+                self.shift >>= min(clocks, 8)
+            self.timer = (self.timer - 1 - cycles) % self.rate + 1
+            return [self.level] * len(offsets)
+        # the level only moves on output clocks, at most a few hundred a frame
+        samples = []
+        i = 0
+        n = len(offsets)
+        t = self.timer
+        while t <= cycles:
+            while i < n and offsets[i] < t:
+                samples.append(self.level)
+                i += 1
+            self.Clock()
+            t += self.rate
+        self.timer = t - cycles
+        samples.extend([self.level] * (n - i))
+        return samples
+
+    def IrqCycles(self):
+        # cpu cycles until the last byte is read and the irq raised, or None
+        if self.irq or not self.irq_enable or self.loop or self.bytes_remaining == 0:
+            return None
+        # each time the output unit takes the buffer one more byte is read
+        return self.timer + (self.bits_remaining - 1) * self.rate + (self.bytes_remaining - 1) * 8 * self.rate
+
+    def save_state(self):
+        return self.STATE.pack(self.irq_enable, self.loop, self.rate, self.level, self.sample_address,
+            self.sample_length, self.current_address, self.bytes_remaining, self.buffer, self.shift,
+            self.bits_remaining, self.silence, self.timer, self.irq)
+
+    def load_state(self, data, offset):
+        (self.irq_enable, self.loop, self.rate, self.level, self.sample_address,
+            self.sample_length, self.current_address, self.bytes_remaining, self.buffer, self.shift,
+            self.bits_remaining, self.silence, self.timer, self.irq) = self.STATE.unpack_from(data, offset)
+        return offset + self.STATE.size
+
+class Nes2A03:
+    # clock, frame counter mode, irq inhibit, irq flag and position, and how
+    # far off the next sample is
+    STATE = struct.Struct('<QB??Id')
+
+    # writes that change when an irq is raised are applied straight away
+    IMMEDIATE = (0x4010, 0x4013, 0x4015, 0x4017)
+
+    def __init__(self):
+        self.pulse = [Pulse(0), Pulse(1)]
+        self.triangle = Triangle()
+        self.noise = Noise()
+        self.dmc = Dmc()
+
+        # the cpu cycle the apu has been run up to, and the register writes
+        # since then as (cycle, address, data)
+        self.clock = 0
+        self.writes = []
+
+        self.frame_mode = 0
+        self.frame_inhibit = False
+        self.frame_irq = False
+        self.frame_cycle = 0
+        self.irq = False
+
+        # synthesis is off unless a frontend wants the samples
+        self.audio = False
+        self.sampleRate = SAMPLE_RATE
+        self.cyclesPerSample = CPU_CLOCK / SAMPLE_RATE
+        self.nextSample = 0.0
+        self.samples = RingBuffer()
+
+    def ConnectBus(self, bus):
+        self.dmc.read = lambda addr: bus.cpuRead(addr, True)
+
+    def SetAudio(self, enabled=True, sampleRate=SAMPLE_RATE):
+        self.audio = enabled
+        self.sampleRate = sampleRate
+        self.cyclesPerSample = CPU_CLOCK / sampleRate
+        self.nextSample = float(self.clock)
+        self.samples.Clear()
+
+    def cpuWrite(self, addr, data, cycle):
+        if addr in self.IMMEDIATE:
+            self.Run(cycle)
+            self.Apply(addr, data)
+        else:
+            self.writes.append((cycle, addr, data))
+
+    def cpuRead(self, addr, cycle, readonly=False):
+        # $4015: length counters running, dmc active and the irq flags.
+        # Reading acknowledges the frame irq.
+        self.Run(cycle)
+        data = 0x00
+        for i, channel in enumerate((self.pulse[0], self.pulse[1], self.triangle, self.noise)):
+            if channel.length > 0:
+                data |= 1 << i
+        if self.dmc.bytes_remaining > 0:
+            data |= 0x10
+        if self.frame_irq:
+            data |= 0x40
+        if self.dmc.irq:
+            data |= 0x80
+        if not readonly:
+            self.frame_irq = False
+            self.irq = self.dmc.irq
+        return data
+
+    def Apply(self, addr, data):
+        if addr <= 0x4007:
+            self.pulse[(addr >> 2) & 0x01].Write(addr & 0x03, data)
+        elif addr <= 0x400B:
+            self.triangle.Write(addr & 0x03, data)
+        elif addr <= 0x400F:
+            self.noise.Write(addr & 0x03, data)
+        elif addr <= 0x4013:
+            self.dmc.Write(addr & 0x03, data)
+        elif addr == 0x4015:
+            for i, channel in enumerate((self.pulse[0], self.pulse[1], self.triangle, self.noise)):
+                channel.enabled = bool(data & (1 << i))
+                if not channel.enabled:
+                    channel.length = 0
+            self.dmc.irq = False
+            self.dmc.Enable(bool(data & 0x10))
+        elif addr == 0x4017:
+            self.frame_mode = data >> 7
+            self.frame_inhibit = bool(data & 0x40)
+            if self.frame_inhibit:
+                self.frame_irq = False
+            self.frame_cycle = 0
+            if self.frame_mode == 1:
+                self.QuarterFrame()
+                self.HalfFrame()
+        self.irq = self.frame_irq or self.dmc.irq
+
+    def QuarterFrame(self):
+        self.pulse[0].QuarterFrame()
+        self.pulse[1].QuarterFrame()
+        self.triangle.QuarterFrame()
+        self.noise.QuarterFrame()
+
+    def HalfFrame(self):
+        self.pulse[0].HalfFrame()
+        self.pulse[1].HalfFrame()
+        self.triangle.HalfFrame()
+        self.noise.HalfFrame()
+
+    def Run(self, cycle):
+        # applies the queued writes in order and runs up to the cpu cycle
+        if self.writes:
+            writes = self.writes
+            self.writes = []
+            for when, addr, data in writes:
+                self.Advance(when)
+                self.Apply(addr, data)
+        self.Advance(cycle)
+
+    def Advance(self, cycle):
+        # runs up to the cpu cycle a frame counter step at a time
+        while self.clock < cycle:
+            for step, quarter, half, irq in FRAME_STEPS[self.frame_mode]:
+                if step > self.frame_cycle:
+                    break
+            cycles = step - self.frame_cycle
+            if self.clock + cycles > cycle:
+                cycles = cycle - self.clock
+                self.Synthesize(cycles)
+                self.clock = cycle
+                self.frame_cycle += cycles
+                break
+            self.Synthesize(cycles)
+            self.clock += cycles
+            self.frame_cycle = step
+            if quarter:
+                self.QuarterFrame()
+            if half:
+                self.HalfFrame()
+            if irq and not self.frame_inhibit:
+                self.frame_irq = True
+            if not quarter:
+                self.frame_cycle = 0
+        self.irq = self.frame_irq or self.dmc.irq
+
+    def Synthesize(self, cycles):
+        # the samples falling in the next `cycles` cycles, all channels playing
+        # a fixed waveform
+        dmc = self.dmc
+        if not self.audio:
+            dmc.Samples((), cycles)
+            return
+        first = self.nextSample - self.clock
+        n = int(math.ceil((cycles - first) / self.cyclesPerSample)) if first < cycles else 0
+        step = self.cyclesPerSample
+        offsets = [first + i * step for i in range(n)]
+        self.nextSample += n * step
+
+        zeros = [0] * n
+        pulse1 = self.pulse[0].Samples(offsets, cycles) or zeros
+        pulse2 = self.pulse[1].Samples(offsets, cycles) or zeros
+        triangle = self.triangle.Samples(offsets, cycles)
+        noise = self.noise.Samples(offsets, cycles) or zeros
+        level = dmc.Samples(offsets, cycles)
+        if n:
+            self.samples.Write(array.array('h', [PULSE_MIX[p1 + p2] + TND_MIX[3 * t + 2 * r + d] - 32768
+                for p1, p2, t, r, d in zip(pulse1, pulse2, triangle, noise, level)]))
+
+    def IrqCycles(self):
+        # cpu cycles after self.clock until the apu raises an irq, or None
+        cycles = None
+        if self.frame_mode == 0 and not self.frame_inhibit and not self.frame_irq:
+            cycles = FRAME_IRQ_CYCLE - self.frame_cycle
+            if cycles <= 0:
+                cycles += FRAME_PERIOD
+        dmc = self.dmc.IrqCycles()
+        if dmc is not None and (cycles is None or dmc < cycles):
+            cycles = dmc
+        return cycles
+
+    def Reset(self, cycle):
+        self.Run(cycle)
+        self.Apply(0x4015, 0x00)
+        self.frame_irq = False
+        self.irq = False
+
+    def save_state(self):
+        # queued writes are applied first
+        return b''.join([
+            self.STATE.pack(self.clock, self.frame_mode, self.frame_inhibit, self.frame_irq, self.frame_cycle,
+                self.nextSample - self.clock if self.audio else 0.0),
+            self.pulse[0].save_state(), self.pulse[1].save_state(), self.triangle.save_state(),
+            self.noise.save_state(), self.dmc.save_state()])
+
+    def load_state(self, data, offset):
+        (self.clock, self.frame_mode, self.frame_inhibit, self.frame_irq,
+            self.frame_cycle, nextSample) = self.STATE.unpack_from(data, offset)
+        offset += self.STATE.size
+        for channel in (self.pulse[0], self.pulse[1], self.triangle, self.noise, self.dmc):
+            offset = channel.load_state(data, offset)
+        self.writes = []
+        self.irq = self.frame_irq or self.dmc.irq
+        self.nextSample = self.clock + nextSample if self.audio else float(self.clock)
+        return offset
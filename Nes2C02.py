@@ -1,3 +1,5 @@
+import struct
+
 import Cartridge
 
 class Nes2C02:
@@ -28,13 +30,38 @@ class Nes2C02:
     LOOPY_NAMETBL_X    = 0x0400
     LOOPY_NAMETBL_Y    = 0x0800
     LOOPY_FINE_Y       = 0x7000
+
+    # translate tables that put a 2-bit attribute above decoded 2-bit pixels
+    TILE_ATTRIB = [bytes((a << 2) | (i & 0x03) for i in range(256)) for a in range(8)]
+
+    # flags or'ed into the palette index of a pixel in sprite_line
+    SPRITE_BEHIND      = 0x20
+    SPRITE_ZERO        = 0x40
+    EMPTY_LINE = bytes(256)
+
+    # registers, loopy registers, background latches and shifters, timing,
+    # oam address and the sprites evaluated for the next scanline
+    STATE = struct.Struct('<BBBBBH?IIBBBBBHHHH?IhHHBBh')
     def __init__(self):
         self.cart = None
+        # the cartridge's mapper when it counts scanlines (MMC3), clocked at
+        # dot 260 of the pre-render and visible lines while rendering
+        self.scanlineCounter = None
 
         # 2D array, tblName[2][1024]
-        self.tblName = [[0 for i in range(1024)] for j in range(2)]
-        self.tblPalette = [0 for i in range(32)]
-        self.tblPattern = [[0 for i in range(4096)] for j in range(2)]
+        self.tblName = [bytearray(1024), bytearray(1024)]
+        # Nametable map: the 1KB buffer behind each of $2000, $2400, $2800
+        # and $2C00 (mirrored at $3000-$3EFF), rebuilt by UpdateNametables
+        # whenever the cartridge's mirroring changes
+        self.nametables = [self.tblName[0], self.tblName[0], self.tblName[1], self.tblName[1]]
+        self.tblPalette = bytearray(32)
+        self.tblPattern = [bytearray(4096), bytearray(4096)]
+
+        # decoded pattern table tiles, 512 entries of 8 rows x 8 2-bit pixels.
+        # Filled on first use and invalidated by writes to $0000-$1FFF or when
+        # the mapper switches chr banks (InvalidateTiles), for the 64 tiles
+        # of each switched 1KB slot.
+        self.tileCache = [None] * 512
 
         self.status = 0x00
         self.mask = 0x00
@@ -56,22 +83,56 @@ class Nes2C02:
         self.bg_shifter_pattern_hi = 0x0000
         self.bg_shifter_attrib_lo = 0x0000
         self.bg_shifter_attrib_hi = 0x0000
-        
+
+        # object attribute memory: 64 sprites of y, tile, attributes, x
+        self.oam = bytearray(256)
+        self.oam_addr = 0x00
+        # Sprites are evaluated once per scanline, at dot 257, for the line
+        # after it. sprite_line holds one byte per pixel of that line: 0 where
+        # no sprite is opaque, otherwise the palette index of the front-most
+        # sprite pixel with SPRITE_BEHIND and SPRITE_ZERO or'ed in.
+        self.sprite_line = bytearray(256)
+        self.sprite_count = 0
+        self.sprite_zero = -1   # x of sprite 0 if it is on that line
+        # background pixels of the scanline being drawn, for sprite priority
+        # and sprite 0 hits
+        self.bg_line = bytearray(256)
+        # sprites in range of each evaluation line, from SpriteLineCounts.
+        # oamVersion is bumped whenever oam changes.
+        self.oamVersion = 0
+        self.spriteLines = None
 
         # For visualizing the state of the ppu
-        import pygame
         self.palScreen = [
             (84, 84, 84),       (0, 30, 116),       (8, 16, 144),       (48, 0, 136),       (68, 0, 100),       (92, 0, 48),        (84, 4, 0),         (60, 24, 0),        (32, 42, 0),        (8, 58, 0),         (0, 64, 0),         (0, 60, 0),         (0, 50, 60),        (0, 0, 0),          (0, 0, 0), (0, 0, 0), 
             (152, 150, 152),    (8, 76, 196),       (48, 50, 236),      (92, 30, 228),      (136, 20, 176),     (160, 20, 100),     (152, 34, 32),      (120, 60, 0),       (84, 90, 0),        (40, 114, 0),       (8, 124, 0),        (0, 118, 40),       (0, 102, 120),      (0, 0, 0),          (0, 0, 0), (0, 0, 0), 
             (236, 238, 236),    (76, 154, 236),     (120, 124, 236),    (176, 98, 236),     (228, 84, 236),     (236, 88, 180),     (236, 106, 100),    (212, 136, 32),     (160, 170, 0),      (116, 196, 0),      (76, 208, 32),      (56, 204, 108),     (56, 180, 204),     (60, 60, 60),       (0, 0, 0), (0, 0, 0), 
             (236, 238, 236),    (168, 204, 236),    (188, 188, 236),    (212, 178, 236),    (236, 174, 236),    (236, 174, 212),    (236, 180, 176),    (228, 196, 144),    (204, 210, 120),    (180, 222, 120),    (168, 226, 144),    (152, 226, 180),    (160, 214, 228),    (160, 162, 160),    (0, 0, 0), (0, 0, 0)
         ]
-        self.sprScreen = pygame.Surface((256, 240))
-        self.sprNameTable = [pygame.Surface((256, 240)), pygame.Surface((256, 240))]
-        self.sprPatternTable = [pygame.Surface((128, 128)), pygame.Surface((128, 128))]
+        # translation tables from a 6-bit palette index to each rgb channel,
+        # used to convert the whole frame buffer in one pass
+        self.palTranslate = [bytes([self.palScreen[i & 0x3F][channel] for i in range(256)]) for channel in range(3)]
+
+        # the ppu renders palette indices (0x00-0x3F) into frameBuffer, they are
+        # only converted to rgb when a frontend asks for the screen
+        self.frameBuffer = bytearray(256 * 240)
+        self.frameRGB = bytearray(256 * 240 * 3)
+        self.frameRGBKey = None
+
+        # pygame surfaces are only created once a frontend asks for them, so
+        # the ppu can run headless without pygame installed
+        self.sprScreen = None
+        self.sprNameTable = None
+        self.sprPatternTable = None
         self.frame_complete = False
+        self.frame_count = 0
         self.scanline = 0
         self.cycle = 0
+
+        # scanline renderer: visible scanlines are rendered in batches instead
+        # of dot by dot, catching up whenever the cpu touches a ppu register
+        self.scanline_render = False
+        self.render_cycle = 1   # next dot of the current scanline not yet rendered
     @property
     def vram_addr_coarse_x(self):
         return self.vram_addr & self.LOOPY_COARSE_X
@@ -88,26 +149,77 @@ class Nes2C02:
     def vram_addr_fine_y(self):
         return (self.vram_addr & self.LOOPY_FINE_Y) >> 12
 
+    def GetFrameBuffer(self):
+        # 256x240 palette indices, row major
+        return self.frameBuffer
+    def GetFrameRGB(self):
+        # 256x240 packed rgb triplets, converted at most once per ppu position
+        key = (self.frame_count, self.scanline, self.cycle)
+        if key != self.frameRGBKey:
+            self.frameRGB[0::3] = self.frameBuffer.translate(self.palTranslate[0])
+            self.frameRGB[1::3] = self.frameBuffer.translate(self.palTranslate[1])
+            self.frameRGB[2::3] = self.frameBuffer.translate(self.palTranslate[2])
+            self.frameRGBKey = key
+            self.sprScreen = None
+        return self.frameRGB
     def GetScreen(self):
+        rgb = self.GetFrameRGB()
+        if self.sprScreen is None:
+            import pygame
+            self.sprScreen = pygame.image.frombuffer(rgb, (256, 240), 'RGB')
         return self.sprScreen
     def GetNameTable(self, i):
+        if self.sprNameTable is None:
+            import pygame
+            self.sprNameTable = [pygame.Surface((256, 240)), pygame.Surface((256, 240))]
         return self.sprNameTable[i]
+    def GetPatternTableBuffer(self, i, palette):
+        # 128x128 palette indices of pattern table i drawn with the given palette
+        colors = bytes([self.ppuRead(0x3F00 + c) & 0x3F for c in range(32)]) * 8
+        attrib = self.TILE_ATTRIB[palette]
+        tileCache = self.tileCache
+        buffer = bytearray(128 * 128)
+        for tile in range(256):
+            index = (i << 8) | tile
+            rows = tileCache[index]
+            if rows is None:
+                rows = self.DecodeTile(index)
+            offset = (tile >> 4) * 1024 + (tile & 0x0F) * 8
+            for row in range(8):
+                buffer[offset + row * 128:offset + row * 128 + 8] = rows[row]
+        return buffer.translate(attrib).translate(colors)
     def GetPatternTable(self, i, palette):
-        for tileY in range(16):
-            for tileX in range(16):
-                offset = tileY * 256 + tileX * 16
-                for row in range(8):
-                    tile_lsb = self.ppuRead(i * 0x1000 + offset + row)
-                    tile_msb = self.ppuRead(i * 0x1000 + offset + row + 8)
-                    for col in range(8):
-                        pixel = ((tile_msb & 0x01) << 1) | (tile_lsb & 0x01)
-                        tile_lsb >>= 1
-                        tile_msb >>= 1
-                        self.sprPatternTable[i].set_at(
-                            (tileX * 8 + (7 - col), tileY * 8 + row),
-                            self.GetColorFromPaletteRam(palette, pixel)
-                        )
+        import pygame
+        indices = self.GetPatternTableBuffer(i, palette)
+        rgb = bytearray(128 * 128 * 3)
+        rgb[0::3] = indices.translate(self.palTranslate[0])
+        rgb[1::3] = indices.translate(self.palTranslate[1])
+        rgb[2::3] = indices.translate(self.palTranslate[2])
+        if self.sprPatternTable is None:
+            self.sprPatternTable = [None, None]
+        self.sprPatternTable[i] = pygame.image.frombuffer(rgb, (128, 128), 'RGB')
         return self.sprPatternTable[i]
+    def DecodeTile(self, index):
+        # chr rom tiles are also kept by the cartridge by where they are in chr
+        # rom, so a bank switched back in is not decoded again
+        key = self.cart.ChrTileKey(index) if self.cart is not None else None
+        rows = self.cart.chrTiles.get(key) if key is not None else None
+        if rows is None:
+            rows = []
+            for row in range(8):
+                tile_lsb = self.ppuRead((index << 4) + row)
+                tile_msb = self.ppuRead((index << 4) + row + 8)
+                rows.append(bytes([(((tile_msb >> (7 - col)) & 0x01) << 1) | ((tile_lsb >> (7 - col)) & 0x01) for col in range(8)]))
+            if key is not None:
+                self.cart.chrTiles[key] = rows
+        self.tileCache[index] = rows
+        return rows
+    def InvalidateTiles(self, first=0, last=7):
+        # drops the decoded tiles of 1KB chr slots first..last
+        if first == 0 and last == 7:
+            self.tileCache = [None] * 512
+        else:
+            self.tileCache[first * 64:(last + 1) * 64] = [None] * ((last - first + 1) * 64)
     def GetColorFromPaletteRam(self, palette, pixel):
         return self.palScreen[self.ppuRead(0x3F00 + (palette << 2) + pixel) & 0x3F]
 
@@ -124,7 +236,7 @@ class Nes2C02:
             elif addr == 0x0003:    # oam address
                 pass
             elif addr == 0x0004:    # oam data
-                pass
+                data = self.oam[self.oam_addr]
             elif addr == 0x0005:    # scroll
                 pass
             elif addr == 0x0006:    # ppu address
@@ -137,6 +249,8 @@ class Nes2C02:
             elif addr == 0x0001:    # mask
                 pass
             elif addr == 0x0002:    # status
+                # a sprite 0 hit may be waiting in the unrendered part of the line
+                self.CatchUp()
                 # if (self.status & self.STATUS_VERTBLANK) > 0:
                 #     print("  (PPU) reading status - vertblank true")
                 data = (self.status & 0xE0) | (self.ppu_data_buffer & 0x1F)
@@ -147,12 +261,13 @@ class Nes2C02:
             elif addr == 0x0003:    # oam address
                 pass
             elif addr == 0x0004:    # oam data
-                pass
+                data = self.oam[self.oam_addr]
             elif addr == 0x0005:    # scroll
                 pass
             elif addr == 0x0006:    # ppu address
                 pass
             elif addr == 0x0007:    # ppu data
+                self.CatchUp()
                 data = self.ppu_data_buffer
                 self.ppu_data_buffer = self.ppuRead(self.vram_addr)
 
@@ -164,6 +279,7 @@ class Nes2C02:
         return data
 
     def cpuWrite(self, addr, data):
+        self.CatchUp()
         if addr == 0x0000:      # control
             self.control = data
             if self.control & self.CONTROL_NAMETBL_X > 0:
@@ -179,9 +295,11 @@ class Nes2C02:
         elif addr == 0x0002:    # status
             pass
         elif addr == 0x0003:    # oam address
-            pass
+            self.oam_addr = data
         elif addr == 0x0004:    # oam data
-            pass
+            self.oam[self.oam_addr] = data
+            self.oam_addr = (self.oam_addr + 1) & 0xFF
+            self.oamVersion += 1
         elif addr == 0x0005:    # scroll
             if self.address_latch == 0:
                 self.fine_x = data & 0x07
@@ -204,76 +322,36 @@ class Nes2C02:
             self.vram_addr += 32 if (self.control & self.CONTROL_INC_MODE > 0) else 1
 
     def ppuRead(self, addr, readonly=False):
-        data = 0x00
         addr &= 0x3FFF
 
-        cartData = self.cart.ppuRead(addr)
-        if cartData:
-            data = cartData
-        elif addr >= 0x0000 and addr <= 0x1FFF:
-            data = self.tblPattern[(addr & 0x1000) >> 12][addr & 0x0FFF]
-        elif addr >= 0x2000 and addr <= 0x3EFF:
-            addr &= 0x0FFF
-            if self.cart.mirror == self.cart.MIRROR_VERTICAL:
-                if addr >= 0x0000 and addr <= 0x03FF:
-                    data = self.tblName[0][addr & 0x03FF]
-                if addr >= 0x0400 and addr <= 0x07FF:
-                    data = self.tblName[1][addr & 0x03FF]
-                if addr >= 0x0800 and addr <= 0x0BFF:
-                    data = self.tblName[0][addr & 0x03FF]
-                if addr >= 0x0C00 and addr <= 0x0FFF:
-                    data = self.tblName[1][addr & 0x03FF]
-            elif self.cart.mirror == self.cart.MIRROR_HORIZONTAL:
-                if addr >= 0x0000 and addr <= 0x03FF:
-                    data = self.tblName[0][addr & 0x03FF]
-                if addr >= 0x0400 and addr <= 0x07FF:
-                    data = self.tblName[0][addr & 0x03FF]
-                if addr >= 0x0800 and addr <= 0x0BFF:
-                    data = self.tblName[1][addr & 0x03FF]
-                if addr >= 0x0C00 and addr <= 0x0FFF:
-                    data = self.tblName[1][addr & 0x03FF]
-        elif addr >= 0x3F00 and addr <= 0x3FFF:
-            addr &= 0x001F
-            if addr == 0x0010:
-                addr = 0x0000
-            elif addr == 0x0014:
-                addr = 0x0004
-            elif addr == 0x0018:
-                addr = 0x0008
-            elif addr == 0x001C:
-                addr = 0x000C
-            data = self.tblPalette[addr]
-        
-        return data
+        if addr <= 0x1FFF:
+            data = self.cart.ppuRead(addr)
+            if data is None:
+                data = self.tblPattern[(addr & 0x1000) >> 12][addr & 0x0FFF]
+            return data
+        if addr <= 0x3EFF:
+            return self.nametables[(addr >> 10) & 0x03][addr & 0x03FF]
+        addr &= 0x001F
+        if addr == 0x0010:
+            addr = 0x0000
+        elif addr == 0x0014:
+            addr = 0x0004
+        elif addr == 0x0018:
+            addr = 0x0008
+        elif addr == 0x001C:
+            addr = 0x000C
+        return self.tblPalette[addr]
 
     def ppuWrite(self, addr, data):
         addr &= 0x3FFF
 
-        if self.cart.ppuWrite(addr, data):
-            pass
-        elif addr >= 0x0000 and addr <= 0x1FFF:
-            self.tblPattern[(addr & 0x1000) >> 12][addr & 0x0FFF] = data
-        elif addr >= 0x2000 and addr <= 0x3EFF:
-            addr &= 0x0FFF
-            if self.cart.mirror == self.cart.MIRROR_VERTICAL:
-                if addr >= 0x0000 and addr <= 0x03FF:
-                    self.tblName[0][addr & 0x03FF] = data
-                if addr >= 0x0400 and addr <= 0x07FF:
-                    self.tblName[1][addr & 0x03FF] = data
-                if addr >= 0x0800 and addr <= 0x0BFF:
-                    self.tblName[0][addr & 0x03FF] = data
-                if addr >= 0x0C00 and addr <= 0x0FFF:
-                    self.tblName[1][addr & 0x03FF] = data
-            elif self.cart.mirror == self.cart.MIRROR_HORIZONTAL:
-                if addr >= 0x0000 and addr <= 0x03FF:
-                    self.tblName[0][addr & 0x03FF] = data
-                if addr >= 0x0400 and addr <= 0x07FF:
-                    self.tblName[0][addr & 0x03FF] = data
-                if addr >= 0x0800 and addr <= 0x0BFF:
-                    self.tblName[1][addr & 0x03FF] = data
-                if addr >= 0x0C00 and addr <= 0x0FFF:
-                    self.tblName[1][addr & 0x03FF] = data
-        elif addr >= 0x3F00 and addr <= 0x3FFF:
+        if addr <= 0x1FFF:
+            self.tileCache[addr >> 4] = None
+            if self.cart.ppuWrite(addr, data) is None:
+                self.tblPattern[(addr & 0x1000) >> 12][addr & 0x0FFF] = data
+        elif addr <= 0x3EFF:
+            self.nametables[(addr >> 10) & 0x03][addr & 0x03FF] = data
+        else:
             addr &= 0x001F
             if addr == 0x0010:
                 addr = 0x0000
@@ -285,8 +363,66 @@ class Nes2C02:
                 addr = 0x000C
             self.tblPalette[addr] = data
 
+    def UpdateNametables(self):
+        mirror = self.cart.mirror if self.cart is not None else Cartridge.Cartridge.MIRROR_HORIZONTAL
+        a, b = self.tblName
+        if mirror == Cartridge.Cartridge.MIRROR_VERTICAL:
+            self.nametables = [a, b, a, b]
+        elif mirror == Cartridge.Cartridge.MIRROR_ONESCREEN_LO:
+            self.nametables = [a, a, a, a]
+        elif mirror == Cartridge.Cartridge.MIRROR_ONESCREEN_HI:
+            self.nametables = [b, b, b, b]
+        elif mirror == Cartridge.Cartridge.MIRROR_FOURSCREEN:
+            self.nametables = [a, b] + self.cart.nameRam
+        else:
+            self.nametables = [a, a, b, b]
+
+    def WriteOam(self, data):
+        # oam dma: 256 bytes written from the oam address on, wrapping around
+        start = self.oam_addr
+        self.oam[start:] = data[:256 - start]
+        self.oam[:start] = data[256 - start:]
+        self.oamVersion += 1
+
     def ConnectCartridge(self, cartridge):
         self.cart = cartridge
+        self.scanlineCounter = cartridge.mapper if cartridge.mapper.countsScanlines else None
+        self.InvalidateTiles()
+        self.UpdateNametables()
+
+    def save_state(self):
+        # the shifters only ever have their low 16 bits read, the rest is dropped
+        return b''.join([
+            self.STATE.pack(self.status, self.mask, self.control, self.address_latch, self.ppu_data_buffer,
+                self.ppu_address, self.nmi, self.vram_addr, self.tram_addr, self.fine_x,
+                self.bg_next_tile_id, self.bg_next_tile_attrib, self.bg_next_tile_lsb, self.bg_next_tile_msb,
+                self.bg_shifter_pattern_lo & 0xFFFF, self.bg_shifter_pattern_hi & 0xFFFF,
+                self.bg_shifter_attrib_lo & 0xFFFF, self.bg_shifter_attrib_hi & 0xFFFF,
+                self.frame_complete, self.frame_count, self.scanline, self.cycle, self.render_cycle,
+                self.oam_addr, self.sprite_count, self.sprite_zero),
+            bytes(self.tblName[0]), bytes(self.tblName[1]), bytes(self.tblPalette),
+            bytes(self.tblPattern[0]), bytes(self.tblPattern[1]), bytes(self.oam), bytes(self.sprite_line)])
+
+    def load_state(self, data, offset):
+        (self.status, self.mask, self.control, self.address_latch, self.ppu_data_buffer,
+            self.ppu_address, self.nmi, self.vram_addr, self.tram_addr, self.fine_x,
+            self.bg_next_tile_id, self.bg_next_tile_attrib, self.bg_next_tile_lsb, self.bg_next_tile_msb,
+            self.bg_shifter_pattern_lo, self.bg_shifter_pattern_hi,
+            self.bg_shifter_attrib_lo, self.bg_shifter_attrib_hi,
+            self.frame_complete, self.frame_count, self.scanline, self.cycle, self.render_cycle,
+            self.oam_addr, self.sprite_count, self.sprite_zero) = self.STATE.unpack_from(data, offset)
+        offset += self.STATE.size
+        for table in (self.tblName[0], self.tblName[1], self.tblPalette, self.tblPattern[0], self.tblPattern[1],
+                self.oam, self.sprite_line):
+            table[:] = data[offset:offset + len(table)]
+            offset += len(table)
+
+        # pattern memory may have changed under the tile cache, and the frame
+        # buffer no longer matches the cached rgb conversion
+        self.InvalidateTiles()
+        self.frameRGBKey = None
+        self.oamVersion += 1
+        return offset
 
     def IncrementScrollX(self):
         if self.mask & self.MASK_RENDER_BKGD > 0 or self.mask & self.MASK_RENDER_SPR > 0:
@@ -345,10 +481,478 @@ class Nes2C02:
             self.bg_shifter_attrib_hi <<= 1
         
 
+    def CatchUp(self):
+        # bring a batch rendered scanline up to the current dot before the cpu
+        # changes state the rest of the scanline depends on
+        if self.scanline_render and self.scanline >= 0 and self.scanline < 240:
+            end = self.cycle if self.cycle < 257 else 257
+            if end > self.render_cycle:
+                self.RenderScanline(end)
+
+    def RenderScanline(self, end):
+        # Renders dots render_cycle..end-1 (at most dot 256) of the current
+        # visible scanline. This does exactly what clock() does for those dots,
+        # but keeps the ppu state in locals for the duration of the batch.
+        if self.render_cycle == 1 and end == 257 and (self.mask & self.MASK_RENDER_BKGD) > 0:
+            self.RenderScanlineTiles()
+            return
+
+        cycle = self.render_cycle
+        ppuRead = self.ppuRead
+        nametables = self.nametables
+        tblPalette = self.tblPalette
+        render_bkgd = (self.mask & self.MASK_RENDER_BKGD) > 0
+        rendering = render_bkgd or (self.mask & self.MASK_RENDER_SPR) > 0
+        patt_base = 0x1000 if (self.control & self.CONTROL_PATT_BKGD) > 0 else 0x0000
+        bit = 15 - self.fine_x
+        frameBuffer = self.frameBuffer
+        row = self.scanline * 256 - 1
+        sprites = self.sprite_count > 0 and (self.mask & self.MASK_RENDER_SPR) > 0
+        background = self.bg_line
+        first = cycle
+
+        v = self.vram_addr
+        tile_id = self.bg_next_tile_id
+        tile_attrib = self.bg_next_tile_attrib
+        tile_lsb = self.bg_next_tile_lsb
+        tile_msb = self.bg_next_tile_msb
+        pat_lo = self.bg_shifter_pattern_lo
+        pat_hi = self.bg_shifter_pattern_hi
+        att_lo = self.bg_shifter_attrib_lo
+        att_hi = self.bg_shifter_attrib_hi
+
+        while cycle < end:
+            if cycle >= 2:
+                if render_bkgd:
+                    pat_lo <<= 1
+                    pat_hi <<= 1
+                    att_lo <<= 1
+                    att_hi <<= 1
+                phase = (cycle - 1) & 0x07
+                if phase == 0:
+                    pat_lo = (pat_lo & 0xFF00) | tile_lsb
+                    pat_hi = (pat_hi & 0xFF00) | tile_msb
+                    att_lo = (att_lo & 0xFF00) | (0xFF if (tile_attrib & 0x01) > 0 else 0x00)
+                    att_hi = (att_hi & 0xFF00) | (0xFF if (tile_attrib & 0x02) > 0 else 0x00)
+                    tile_id = nametables[(v >> 10) & 0x03][v & 0x03FF]
+                elif phase == 2:
+                    tile_attrib = nametables[(v >> 10) & 0x03][0x03C0 | ((v >> 4) & 0x38) | ((v >> 2) & 0x07)]
+                    if v & 0x0040:
+                        tile_attrib >>= 4
+                    if v & 0x0002:
+                        tile_attrib >>= 2
+                    tile_attrib &= 0x03
+                elif phase == 4:
+                    tile_lsb = ppuRead(patt_base + (tile_id << 4) + ((v >> 12) & 0x07))
+                elif phase == 6:
+                    tile_msb = ppuRead(patt_base + (tile_id << 4) + ((v >> 12) & 0x07) + 8)
+                elif phase == 7 and rendering:
+                    # IncrementScrollX
+                    if (v & self.LOOPY_COARSE_X) == 31:
+                        v = (v & ~self.LOOPY_COARSE_X) ^ self.LOOPY_NAMETBL_X
+                    else:
+                        v += 1
+            if cycle == 256:
+                self.vram_addr = v
+                self.IncrementScrollY()
+                v = self.vram_addr
+
+            if render_bkgd:
+                pixel = (((pat_hi >> bit) & 0x01) << 1) | ((pat_lo >> bit) & 0x01)
+                palette = (((att_hi >> bit) & 0x01) << 1) | ((att_lo >> bit) & 0x01)
+                frameBuffer[row + cycle] = tblPalette[(palette << 2) | pixel] & 0x3F
+                if sprites:
+                    background[cycle - 1] = (palette << 2) | pixel
+            else:
+                frameBuffer[row + cycle] = tblPalette[0] & 0x3F
+            cycle += 1
+
+        self.vram_addr = v
+        self.bg_next_tile_id = tile_id
+        self.bg_next_tile_attrib = tile_attrib
+        self.bg_next_tile_lsb = tile_lsb
+        self.bg_next_tile_msb = tile_msb
+        self.bg_shifter_pattern_lo = pat_lo
+        self.bg_shifter_pattern_hi = pat_hi
+        self.bg_shifter_attrib_lo = att_lo
+        self.bg_shifter_attrib_hi = att_hi
+        self.render_cycle = cycle
+        if sprites:
+            self.ComposeSprites(first - 1, cycle - 1)
+
+    def RenderScanlineTiles(self):
+        # Whole scanline version of RenderScanline for when the background is
+        # enabled and nothing interrupted the line. The pixels of a line are a
+        # continuous stream: the 16 already in the shifters followed by the
+        # tiles fetched during the line, so they are assembled from decoded
+        # tile rows instead of being shifted out bit by bit.
+        ppuRead = self.ppuRead
+        nametables = self.nametables
+        tileCache = self.tileCache
+        patt_base = 0x1000 if (self.control & self.CONTROL_PATT_BKGD) > 0 else 0x0000
+        tile_base = patt_base >> 4
+        v = self.vram_addr
+        fine_y = (v >> 12) & 0x07
+
+        pat_lo = self.bg_shifter_pattern_lo
+        pat_hi = self.bg_shifter_pattern_hi
+        att_lo = self.bg_shifter_attrib_lo
+        att_hi = self.bg_shifter_attrib_hi
+        head = bytearray(16)
+        for i in range(16):
+            bit = 15 - i
+            head[i] = ((((att_hi >> bit) & 0x01) << 3) | (((att_lo >> bit) & 0x01) << 2)
+                | (((pat_hi >> bit) & 0x01) << 1) | ((pat_lo >> bit) & 0x01))
+        pieces = [head]
+
+        # tile 0 was named during the previous scanline, the rest are fetched
+        # at dots 9, 17, ... 249 and only the first 31 reach the screen
+        tile_id = self.bg_next_tile_id
+        tile_ids = []
+        tile_attribs = []
+        for k in range(32):
+            if k > 0:
+                tile_id = nametables[(v >> 10) & 0x03][v & 0x03FF]
+            tile_attrib = nametables[(v >> 10) & 0x03][0x03C0 | ((v >> 4) & 0x38) | ((v >> 2) & 0x07)]
+            if v & 0x0040:
+                tile_attrib >>= 4
+            if v & 0x0002:
+                tile_attrib >>= 2
+            tile_attrib &= 0x03
+            tile_ids.append(tile_id)
+            tile_attribs.append(tile_attrib)
+            if k < 31:
+                rows = tileCache[tile_base + tile_id]
+                if rows is None:
+                    rows = self.DecodeTile(tile_base + tile_id)
+                pieces.append(rows[fine_y].translate(self.TILE_ATTRIB[tile_attrib]))
+            # IncrementScrollX
+            if (v & self.LOOPY_COARSE_X) == 31:
+                v = (v & ~self.LOOPY_COARSE_X) ^ self.LOOPY_NAMETBL_X
+            else:
+                v += 1
+
+        colors = bytes([self.tblPalette[c] & 0x3F for c in range(16)]) * 16
+        row = self.scanline * 256
+        line = b''.join(pieces)[self.fine_x:self.fine_x + 256]
+        self.frameBuffer[row:row + 256] = line.translate(colors)
+        if self.sprite_count > 0 and (self.mask & self.MASK_RENDER_SPR) > 0:
+            self.bg_line[:] = line
+            self.ComposeSprites(0, 256)
+
+        # leave the shifters and fetch latches exactly as the per dot path
+        # would: tiles 29 and 30 in the shifters, shifted 7 times since the
+        # last load at dot 249, and tile 31 in the latches
+        lsb = [ppuRead(patt_base + (tile_ids[k] << 4) + fine_y) for k in (29, 30, 31)]
+        msb = [ppuRead(patt_base + (tile_ids[k] << 4) + fine_y + 8) for k in (29, 30, 31)]
+        self.bg_shifter_pattern_lo = ((lsb[0] << 8) | lsb[1]) << 7
+        self.bg_shifter_pattern_hi = ((msb[0] << 8) | msb[1]) << 7
+        self.bg_shifter_attrib_lo = (((0xFF if (tile_attribs[29] & 0x01) > 0 else 0x00) << 8)
+            | (0xFF if (tile_attribs[30] & 0x01) > 0 else 0x00)) << 7
+        self.bg_shifter_attrib_hi = (((0xFF if (tile_attribs[29] & 0x02) > 0 else 0x00) << 8)
+            | (0xFF if (tile_attribs[30] & 0x02) > 0 else 0x00)) << 7
+        self.bg_next_tile_id = tile_ids[31]
+        self.bg_next_tile_attrib = tile_attribs[31]
+        self.bg_next_tile_lsb = lsb[2]
+        self.bg_next_tile_msb = msb[2]
+
+        self.vram_addr = v
+        self.IncrementScrollY()
+        self.render_cycle = 257
+
+    def EvaluateSprites(self):
+        # Dot 257: finds the first 8 sprites in range of the next scanline and
+        # draws their pixels for it into sprite_line, lower oam entries in
+        # front. A ninth sprite in range sets the overflow flag.
+        height = 16 if (self.control & self.CONTROL_SPR_SIZE) > 0 else 8
+        if self.SpriteLineCounts(height)[0][self.scanline] == 0:
+            self.ClearSprites()
+            return
+        line = self.sprite_line
+        line[:] = self.EMPTY_LINE
+        table = 0x100 if (self.control & self.CONTROL_PATT_SPR) > 0 else 0x000
+        scanline = self.scanline
+        oam = self.oam
+        tileCache = self.tileCache
+        count = 0
+        self.sprite_zero = -1
+        for i in range(0, 256, 4):
+            row = scanline - oam[i]
+            if row < 0 or row >= height:
+                continue
+            if count == 8:
+                self.status |= self.STATUS_SPROVERFLOW
+                break
+            count += 1
+            tile = oam[i + 1]
+            attrib = oam[i + 2]
+            x = oam[i + 3]
+            if attrib & 0x80:
+                row = height - 1 - row
+            if height == 16:
+                index = ((tile & 0x01) << 8) | (tile & 0xFE) | (row >> 3)
+            else:
+                index = table | tile
+            rows = tileCache[index]
+            if rows is None:
+                rows = self.DecodeTile(index)
+            pixels = rows[row & 0x07]
+            if attrib & 0x40:
+                pixels = pixels[::-1]
+            flags = 0x10 | ((attrib & 0x03) << 2) | (self.SPRITE_BEHIND if attrib & 0x20 else 0)
+            if i == 0:
+                flags |= self.SPRITE_ZERO
+                self.sprite_zero = x
+            for p in range(8 if x <= 248 else 256 - x):
+                if pixels[p] and not line[x + p]:
+                    line[x + p] = flags | pixels[p]
+        self.sprite_count = count
+
+    def SpriteLineCounts(self, height):
+        # (sprites in range of each line 0-239, lines with more than 8), kept
+        # until oam or the sprite size changes
+        key = (self.oamVersion, height)
+        if self.spriteLines is None or self.spriteLines[0] != key:
+            counts = [0] * 240
+            for y in self.oam[0::4]:
+                for line in range(y, y + height if y + height < 240 else 240):
+                    counts[line] += 1
+            self.spriteLines = (key, counts, [line for line in range(240) if counts[line] > 8])
+        return self.spriteLines[1:]
+
+    def ClearSprites(self):
+        # no sprites on the next line, evaluation only runs while rendering
+        self.sprite_count = 0
+        self.sprite_zero = -1
+
+    def ComposeSprites(self, first, last):
+        # Draws the sprite pixels of pixels first..last-1 of the current scanline
+        # over the background already in the frame buffer, whose pixels are in
+        # bg_line, and raises the sprite 0 hit.
+        mask = self.mask
+        if first < 8 and (mask & self.MASK_RENDER_SPR_L) == 0:
+            first = 8
+        segment = self.sprite_line[first:last]
+        stop = first + len(segment.rstrip(b'\x00'))
+        first += len(segment) - len(segment.lstrip(b'\x00'))
+        line = self.sprite_line
+        background = self.bg_line
+        render_bkgd = (mask & self.MASK_RENDER_BKGD) > 0
+        # a hit needs both layers on and is not made at x=255 or, when either
+        # layer is clipped there, the 8 leftmost pixels
+        hit_first = 0 if (mask & self.MASK_RENDER_BKGD_L) > 0 else 8
+        frameBuffer = self.frameBuffer
+        tblPalette = self.tblPalette
+        row = self.scanline * 256
+        for x in range(first, stop):
+            sprite = line[x]
+            if sprite:
+                bg_pixel = background[x] & 0x03 if render_bkgd else 0
+                if sprite & self.SPRITE_ZERO and bg_pixel and x >= hit_first and x != 255:
+                    self.status |= self.STATUS_SPRZERO
+                if bg_pixel == 0 or (sprite & self.SPRITE_BEHIND) == 0:
+                    frameBuffer[row + x] = tblPalette[sprite & 0x1F] & 0x3F
+
+    def DotsUntilEvent(self):
+        # Dots that can run before the next clock() that changes something the
+        # cpu sees without writing a register: vertical blank set (and nmi
+        # raised), the frame completing, vertical blank cleared on the
+        # pre-render line, or a sprite flag possibly being set. Zero when the
+        # very next dot is one of them.
+        position = (self.scanline + 1) * 341 + self.cycle
+        frame = 262 * 341
+        dots = min((1 - position) % frame, (242 * 341 + 1 - position) % frame, (frame - 1 - position) % frame)
+        if (self.mask & (self.MASK_RENDER_BKGD | self.MASK_RENDER_SPR)) > 0:
+            if self.scanline < 240:
+                sprite = self.DotsUntilSpriteFlag(position)
+                if sprite is not None and sprite < dots:
+                    dots = sprite
+            if self.scanlineCounter is not None:
+                # the mapper's irq, with rendering staying on
+                clocks = self.scanlineCounter.ScanlinesUntilIrq()
+                if clocks is not None:
+                    irq = self.DotsUntilScanlineClock(position, clocks)
+                    if irq < dots:
+                        dots = irq
+        return dots
+
+    def DotsUntilScanlineClock(self, position, clocks):
+        # Dots until the dot 260 that gives the mapper its clocks-th scanline
+        # clock from position. Lines are counted from the pre-render line, the
+        # 241 lines 0-240 are clocked and the frame has 262.
+        line, cycle = divmod(position, 341)
+        if line > 240 or (line == 240 and cycle > 260):
+            first = 262
+        elif cycle > 260:
+            first = line + 1
+        else:
+            first = line
+        frames, index = divmod(first, 262)
+        n = index + clocks - 1
+        target = (frames + n // 241) * 262 + n % 241
+        return target * 341 + 260 - position
+
+    def DotsUntilSpriteFlag(self, position):
+        # Dots until the earliest dot this frame that may set the sprite
+        # overflow flag (an evaluation finding more than 8 sprites) or the
+        # sprite 0 hit (sprite 0 drawn over the background), from the line
+        # already evaluated and from oam for the lines still to come. A hit
+        # depends on the background, so this is where one can first happen.
+        # None if neither flag can change.
+        height = 16 if (self.control & self.CONTROL_SPR_SIZE) > 0 else 8
+        overflow = self.SpriteLineCounts(height)[1]
+
+        # the first line whose dot 257 evaluation is still to come
+        first = self.scanline if self.cycle <= 257 else self.scanline + 1
+        if first < 0:
+            first = 0
+        targets = []
+        if (self.status & self.STATUS_SPROVERFLOW) == 0:
+            for line in overflow:
+                if line >= first:
+                    targets.append((line + 1) * 341 + 257)
+                    break
+        if (self.status & self.STATUS_SPRZERO) == 0 and (self.mask & self.MASK_RENDER_BKGD) > 0 and (self.mask & self.MASK_RENDER_SPR) > 0:
+            # sprite_line is for that same line, pixel x is drawn by dot x + 1.
+            # The scanline renderer may not have drawn the dots passed so far,
+            # then a hit in them is still to be made.
+            x = self.sprite_zero
+            if x >= 0 and self.scanline >= 0 and first < 240:
+                start = (first + 1) * 341 + x + 1
+                end = (first + 1) * 341 + (x + 8 if x < 248 else 255)
+                drawn = position
+                if self.scanline_render and self.cycle <= 257:
+                    drawn = (first + 1) * 341 + self.render_cycle
+                if drawn <= end:
+                    targets.append(start if start > position else position)
+            # sprite 0 in range of an evaluation is drawn on the line after it
+            y = self.oam[0]
+            line = first if first > y else y
+            if line < y + height and line < 239:
+                targets.append((line + 2) * 341 + self.oam[3] + 1)
+        if not targets:
+            return None
+        return min(targets) - position
+
+    def FetchesSettled(self):
+        # With rendering off vram_addr stays put, so the background fetches read
+        # the same tile, attribute and pattern bytes over and over. Once the
+        # latches and the low bytes of the shifters hold those the fetches
+        # change nothing.
+        v = self.vram_addr
+        tile_id = self.ppuRead(0x2000 | (v & 0x0FFF))
+        tile_attrib = self.ppuRead(0x23C0 | (v & 0x0C00) | ((v >> 4) & 0x38) | ((v >> 2) & 0x07))
+        if v & 0x0040:
+            tile_attrib >>= 4
+        if v & 0x0002:
+            tile_attrib >>= 2
+        tile_attrib &= 0x03
+        pattern = (0x1000 if (self.control & self.CONTROL_PATT_BKGD) > 0 else 0x0000) + (tile_id << 4) + ((v >> 12) & 0x07)
+        tile_lsb = self.ppuRead(pattern)
+        tile_msb = self.ppuRead(pattern + 8)
+        return (self.bg_next_tile_id == tile_id and self.bg_next_tile_attrib == tile_attrib
+            and self.bg_next_tile_lsb == tile_lsb and self.bg_next_tile_msb == tile_msb
+            and (self.bg_shifter_pattern_lo & 0xFF) == tile_lsb and (self.bg_shifter_pattern_hi & 0xFF) == tile_msb
+            and (self.bg_shifter_attrib_lo & 0xFF) == (0xFF if (tile_attrib & 0x01) > 0 else 0x00)
+            and (self.bg_shifter_attrib_hi & 0xFF) == (0xFF if (tile_attrib & 0x02) > 0 else 0x00))
+
+    def SkipRenderingOff(self, dots):
+        # Runs up to the start of line 240 with rendering off and the fetches
+        # settled, a whole scanline at a time: all that changes is the position
+        # and the frame buffer, which gets the backdrop color. In scanline mode
+        # the visible dots are filled when dot 256 is passed, as RenderScanline
+        # would. Returns the dots left over.
+        backdrop = bytes([self.ppuRead(0x3F00) & 0x3F])
+        frameBuffer = self.frameBuffer
+        while dots > 0 and self.scanline < 240:
+            scanline = self.scanline
+            cycle = self.cycle
+            end = cycle + dots if cycle + dots < 341 else 341
+            if scanline >= 0:
+                row = scanline * 256 - 1
+                if self.scanline_render:
+                    if cycle <= 256 and end > 256:
+                        if self.render_cycle < 257:
+                            frameBuffer[row + self.render_cycle:row + 257] = backdrop * (257 - self.render_cycle)
+                        self.render_cycle = 257
+                else:
+                    first = cycle if cycle > 1 else 1
+                    last = end if end < 257 else 257
+                    if last > first:
+                        frameBuffer[row + first:row + last] = backdrop * (last - first)
+            if cycle <= 257 and end > 257:
+                self.ClearSprites()
+            dots -= end - cycle
+            if end == 341:
+                self.cycle = 0
+                self.render_cycle = 1
+                self.scanline += 1
+            else:
+                self.cycle = end
+        return dots
+
+    def run_dots(self, dots):
+        # Advances the ppu by a number of dots. Stretches where clock() would
+        # only move the position along are skipped in one step: the post-render
+        # line and vertical blank up to the next event, horizontal blank of the
+        # visible lines, and the part of a scanline the scanline renderer draws
+        # in one go. With rendering off whole scanlines are skipped.
+        rendering = (self.mask & (self.MASK_RENDER_BKGD | self.MASK_RENDER_SPR)) > 0
+        settled = False
+        while dots > 0:
+            scanline = self.scanline
+            cycle = self.cycle
+            if not rendering and scanline < 240 and (scanline >= 0 or cycle >= 2):
+                # the pre-render line clears vertical blank at dot 1
+                if settled or self.FetchesSettled():
+                    settled = True
+                    dots = self.SkipRenderingOff(dots)
+                    continue
+            if scanline >= 240:
+                # dots from the start of line 240; vertical blank is set at
+                # (241, 1) and the frame ends at (260, 340)
+                position = (scanline - 240) * 341 + cycle
+                skip = (342 if position <= 342 else 20 * 341 + 340) - position
+                if skip > dots:
+                    skip = dots
+                if skip > 0:
+                    position += skip
+                    self.scanline = 240 + position // 341
+                    self.cycle = position % 341
+                    dots -= skip
+                    continue
+            elif scanline >= 0:
+                if cycle >= 258 and cycle <= 320:
+                    skip = 321 - cycle
+                    if cycle <= 260 and rendering and self.scanlineCounter is not None:
+                        skip = 260 - cycle
+                elif cycle >= 338:
+                    skip = 340 - cycle
+                elif self.scanline_render and cycle >= 1 and cycle < 256:
+                    skip = 256 - cycle
+                else:
+                    skip = 0
+                if skip > 0:
+                    if skip > dots:
+                        skip = dots
+                    self.cycle += skip
+                    dots -= skip
+                    continue
+            self.clock()
+            dots -= 1
+
     def clock(self):
+        if self.scanline_render and self.scanline >= 0 and self.scanline < 240 and self.cycle >= 1 and self.cycle <= 256:
+            # deferred to RenderScanline, which runs at the end of the visible
+            # part of the scanline or earlier if the cpu touches a register
+            if self.cycle == 256:
+                self.RenderScanline(257)
+            self.cycle += 1
+            return
+
         if self.scanline >= -1 and self.scanline < 240:
             if self.scanline == -1 and self.cycle == 1:
-                self.status &= ~self.STATUS_VERTBLANK
+                self.status &= ~(self.STATUS_VERTBLANK | self.STATUS_SPRZERO | self.STATUS_SPROVERFLOW)
             if (self.cycle >=2 and self.cycle < 258) or (self.cycle >= 321 and self.cycle < 338):
                 self.UpdateShifters()
                 cycle = (self.cycle - 1) % 8
@@ -381,10 +985,17 @@ class Nes2C02:
 
             if self.cycle == 257:
                 self.TransferAddressX()
+                if self.scanline >= 0 and (self.mask & (self.MASK_RENDER_BKGD | self.MASK_RENDER_SPR)) > 0:
+                    self.EvaluateSprites()
+                else:
+                    self.ClearSprites()
 
             if self.scanline == -1 and self.cycle >= 280 and self.cycle <= 305:
                 self.TransferAddressY()
 
+            if self.cycle == 260 and self.scanlineCounter is not None and (self.mask & (self.MASK_RENDER_BKGD | self.MASK_RENDER_SPR)) > 0:
+                self.scanlineCounter.Scanline()
+
         if self.scanline == 240:
             pass
         
@@ -408,11 +1019,17 @@ class Nes2C02:
             bg_pal1 = 1 if (self.bg_shifter_attrib_hi & bit_mux) > 0 else 0
             bg_palette = (bg_pal1 << 1) | bg_pal0
 
-        self.sprScreen.set_at((self.cycle - 1, self.scanline), self.GetColorFromPaletteRam(bg_palette, bg_pixel))
+        if self.scanline >= 0 and self.scanline < 240 and self.cycle >= 1 and self.cycle <= 256:
+            self.frameBuffer[self.scanline * 256 + self.cycle - 1] = self.ppuRead(0x3F00 + (bg_palette << 2) + bg_pixel) & 0x3F
+            if self.sprite_count > 0 and self.mask & self.MASK_RENDER_SPR:
+                self.bg_line[self.cycle - 1] = (bg_palette << 2) | bg_pixel
+                self.ComposeSprites(self.cycle - 1, self.cycle)
         self.cycle += 1
         if self.cycle >= 341:
             self.cycle = 0
+            self.render_cycle = 1
             self.scanline += 1
             if self.scanline >= 261:
                 self.scanline = -1
                 self.frame_complete = True
+                self.frame_count += 1
@@ -1,3 +1,7 @@
+import struct
+
+import Nes6502Codegen
+
 class INSTRUCTION:
     def __init__(self, name, operate, addrmode, cycles):
         self.name = name
@@ -14,7 +18,18 @@ class Nes6502:
     FLAGS6502_U = (1 << 5)  # Unused
     FLAGS6502_V = (1 << 6)  # Overflow
     FLAGS6502_N = (1 << 7)  # Negative
-    
+
+    FLAGS6502_NZ   = FLAGS6502_N | FLAGS6502_Z
+    FLAGS6502_NZC  = FLAGS6502_N | FLAGS6502_Z | FLAGS6502_C
+    FLAGS6502_NVZC = FLAGS6502_N | FLAGS6502_V | FLAGS6502_Z | FLAGS6502_C
+
+    # Z and N flags for every 8-bit result, so updating them is a single
+    # mask-and-or on the status register
+    NZ_FLAGS = [(0x02 if v == 0 else 0x00) | (v & 0x80) for v in range(256)]
+
+    # a, x, y, stkp, pc, status, fetched, addr_abs, addr_rel, opcode, cycles, clock_count
+    STATE = struct.Struct('<BBBBHBBHHBBQ')
+
     def __init__(self):
         self.bus = None
 
@@ -32,6 +47,8 @@ class Nes6502:
         self.clock_count = 0
 
         self.setupLookupTable()
+        # specialized per-opcode functions generated from the lookup table
+        self.handlers = Nes6502Codegen.build(self)
 
     def setupLookupTable(self):
         self.lookup = [
@@ -55,6 +72,20 @@ class Nes6502:
 
     def ConnectBus(self, bus):
         self.bus = bus
+        # bind the bus accessors directly, read()/write() below are only a
+        # fallback for a cpu without a bus
+        self.read = bus.cpuRead
+        self.write = bus.cpuWrite
+        self.handlers = Nes6502Codegen.build(self)
+
+    def save_state(self):
+        return self.STATE.pack(self.a, self.x, self.y, self.stkp, self.pc & 0xFFFF, self.status,
+            self.fetched, self.addr_abs & 0xFFFF, self.addr_rel & 0xFFFF, self.opcode, self.cycles, self.clock_count)
+
+    def load_state(self, data, offset):
+        (self.a, self.x, self.y, self.stkp, self.pc, self.status, self.fetched, self.addr_abs,
+            self.addr_rel, self.opcode, self.cycles, self.clock_count) = self.STATE.unpack_from(data, offset)
+        return offset + self.STATE.size
 
     def read(self, a):
         return self.bus.cpuRead(a, False)
@@ -62,6 +93,8 @@ class Nes6502:
     def write(self, a, d):
         self.bus.cpuWrite(a, d)
 
+    # GetFlag/SetFlag are kept for tooling, the instructions below update the
+    # status register directly
     def GetFlag(self, f):
         return 1 if self.status & f > 0 else 0
 
@@ -184,11 +217,10 @@ class Nes6502:
     def ADC(self):
         self.fetch()
 
-        temp = self.a + self.fetched + self.GetFlag(self.FLAGS6502_C)
-        self.SetFlag(self.FLAGS6502_C, 1 if temp > 255 else 0)
-        self.SetFlag(self.FLAGS6502_Z, 1 if (temp & 0x00FF) == 0 else 0)
-        self.SetFlag(self.FLAGS6502_N, 1 if (temp & 0x80) > 0 else 0)
-        self.SetFlag(self.FLAGS6502_V, 1 if ((~(self.a ^ self.fetched) & (self.a ^ temp)) & 0x0080) > 0 else 0)
+        temp = self.a + self.fetched + (self.status & self.FLAGS6502_C)
+        # carry is bit 8 of the sum, overflow is bit 7 of the sign test moved to bit 6
+        self.status = ((self.status & ~self.FLAGS6502_NVZC) | (temp >> 8) | self.NZ_FLAGS[temp & 0x00FF]
+            | (((~(self.a ^ self.fetched) & (self.a ^ temp)) & 0x0080) >> 1))
 
         self.a = temp & 0xFF
         return 1
@@ -196,16 +228,13 @@ class Nes6502:
     def AND(self):
         self.fetch()
         self.a &= self.fetched
-        self.SetFlag(self.FLAGS6502_Z, 1 if self.a == 0x00 else 0)
-        self.SetFlag(self.FLAGS6502_N, 1 if self.a & 0x80 else 0)
+        self.status = (self.status & ~self.FLAGS6502_NZ) | self.NZ_FLAGS[self.a]
         return 1
 
     def ASL(self):
         self.fetch()
         temp = self.fetched << 1
-        self.SetFlag(self.FLAGS6502_C, 1 if (temp & 0xFF00) > 0 else 0)
-        self.SetFlag(self.FLAGS6502_Z, 1 if (temp & 0x00FF) == 0x00 else 0)
-        self.SetFlag(self.FLAGS6502_N, 1 if (temp & 0x80) > 0 else 0)
+        self.status = (self.status & ~self.FLAGS6502_NZC) | (temp >> 8) | self.NZ_FLAGS[temp & 0x00FF]
         if self.lookup[self.opcode].addrmode == self.IMP:
             self.a = temp & 0xFF
         else:
@@ -213,7 +242,7 @@ class Nes6502:
         return 0
 
     def BCC(self):
-        if self.GetFlag(self.FLAGS6502_C) == 0:
+        if (self.status & self.FLAGS6502_C) == 0:
             self.cycles += 1
             self.addr_abs = self.pc + self.addr_rel
 
@@ -224,7 +253,7 @@ class Nes6502:
         return 0
 
     def BCS(self):
-        if self.GetFlag(self.FLAGS6502_C) == 1:
+        if (self.status & self.FLAGS6502_C) != 0:
             self.cycles += 1
             self.addr_abs = self.pc + self.addr_rel
 
@@ -235,7 +264,7 @@ class Nes6502:
         return 0
 
     def BEQ(self):
-        if self.GetFlag(self.FLAGS6502_Z) == 1:
+        if (self.status & self.FLAGS6502_Z) != 0:
             self.cycles += 1
             self.addr_abs = self.pc + self.addr_rel
 
@@ -248,13 +277,13 @@ class Nes6502:
     def BIT(self):
         self.fetch()
         temp = self.a & self.fetched
-        self.SetFlag(self.FLAGS6502_Z, 1 if (temp & 0x00FF) == 0x00 else 0)
-        self.SetFlag(self.FLAGS6502_N, 1 if self.fetched & 0x80 > 0 else 0)
-        self.SetFlag(self.FLAGS6502_V, 1 if self.fetched & 0x40 > 0 else 0)
+        self.status = ((self.status & ~(self.FLAGS6502_NZ | self.FLAGS6502_V))
+            | (self.NZ_FLAGS[temp & 0x00FF] & self.FLAGS6502_Z)
+            | (self.fetched & (self.FLAGS6502_N | self.FLAGS6502_V)))
         return 0
 
     def BMI(self):
-        if self.GetFlag(self.FLAGS6502_N) == 1:
+        if (self.status & self.FLAGS6502_N) != 0:
             self.cycles += 1
             self.addr_abs = self.pc + self.addr_rel
 
@@ -265,7 +294,7 @@ class Nes6502:
         return 0
 
     def BNE(self):
-        if self.GetFlag(self.FLAGS6502_Z) == 0:
+        if (self.status & self.FLAGS6502_Z) == 0:
             self.cycles += 1
             self.addr_abs = self.pc + self.addr_rel
 
@@ -276,7 +305,7 @@ class Nes6502:
         return 0
 
     def BPL(self):
-        if self.GetFlag(self.FLAGS6502_N) == 0:
+        if (self.status & self.FLAGS6502_N) == 0:
             self.cycles += 1
             self.addr_abs = self.pc + self.addr_rel
 
@@ -289,16 +318,14 @@ class Nes6502:
     def BRK(self):
         self.pc = (self.pc + 1) & 0xFFFF
 
-        self.SetFlag(self.FLAGS6502_I, 1)
         self.write(0x0100 + self.stkp, (self.pc >> 8) & 0x00FF)
         self.stkp = (self.stkp - 1) & 0xFF
         self.write(0x0100 + self.stkp, self.pc & 0x00FF)
         self.stkp = (self.stkp - 1) & 0xFF
 
-        self.SetFlag(self.FLAGS6502_B, 1)
-        self.write(0x0100 + self.stkp, self.status)
+        self.write(0x0100 + self.stkp, self.status | self.FLAGS6502_B | self.FLAGS6502_U)
         self.stkp = (self.stkp - 1) & 0xFF
-        self.SetFlag(self.FLAGS6502_B, 0)
+        self.status = (self.status & ~self.FLAGS6502_B) | self.FLAGS6502_I
 
         self.addr_abs = 0xFFFE
         lo = self.read(self.addr_abs)
@@ -308,7 +335,7 @@ class Nes6502:
 
 
     def BVC(self):
-        if self.GetFlag(self.FLAGS6502_V) == 0:
+        if (self.status & self.FLAGS6502_V) == 0:
             self.cycles += 1
             self.addr_abs = self.pc + self.addr_rel
 
@@ -319,7 +346,7 @@ class Nes6502:
         return 0
 
     def BVS(self):
-        if self.GetFlag(self.FLAGS6502_V) == 1:
+        if (self.status & self.FLAGS6502_V) != 0:
             self.cycles += 1
             self.addr_abs = self.pc + self.addr_rel
 
@@ -330,90 +357,80 @@ class Nes6502:
         return 0
 
     def CLC(self):
-        self.SetFlag(self.FLAGS6502_C, 0)
+        self.status &= ~self.FLAGS6502_C
         return 0
 
     def CLD(self):
-        self.SetFlag(self.FLAGS6502_D, 0)
+        self.status &= ~self.FLAGS6502_D
         return 0
 
     def CLI(self):
-        self.SetFlag(self.FLAGS6502_I, 0)
+        self.status &= ~self.FLAGS6502_I
         return 0
 
     def CLV(self):
-        self.SetFlag(self.FLAGS6502_V, 0)
+        self.status &= ~self.FLAGS6502_V
         return 0
 
     def CMP(self):
         self.fetch()
         temp = self.a - self.fetched
-        self.SetFlag(self.FLAGS6502_C, 1 if temp >= 0 else 0)
-        self.SetFlag(self.FLAGS6502_Z, 1 if (temp & 0x00FF) == 0x0000 else 0)
-        self.SetFlag(self.FLAGS6502_N, 1 if temp & 0x0080 > 0 else 0)
+        # (temp >> 8) is -1 when the subtraction borrowed, so this sets carry otherwise
+        self.status = (self.status & ~self.FLAGS6502_NZC) | ((temp >> 8) + 1) | self.NZ_FLAGS[temp & 0x00FF]
         return 1
 
     def CPX(self):
         self.fetch()
         temp = self.x - self.fetched
-        self.SetFlag(self.FLAGS6502_C, 1 if temp >= 0 else 0)
-        self.SetFlag(self.FLAGS6502_Z, 1 if (temp & 0x00FF) == 0x0000 else 0)
-        self.SetFlag(self.FLAGS6502_N, 1 if temp & 0x0080 > 0 else 0)
+        # (temp >> 8) is -1 when the subtraction borrowed, so this sets carry otherwise
+        self.status = (self.status & ~self.FLAGS6502_NZC) | ((temp >> 8) + 1) | self.NZ_FLAGS[temp & 0x00FF]
         return 1
 
     def CPY(self):
         self.fetch()
         temp = self.y - self.fetched
-        self.SetFlag(self.FLAGS6502_C, 1 if temp >= 0 else 0)
-        self.SetFlag(self.FLAGS6502_Z, 1 if (temp & 0x00FF) == 0x0000 else 0)
-        self.SetFlag(self.FLAGS6502_N, 1 if temp & 0x0080 > 0 else 0)
+        # (temp >> 8) is -1 when the subtraction borrowed, so this sets carry otherwise
+        self.status = (self.status & ~self.FLAGS6502_NZC) | ((temp >> 8) + 1) | self.NZ_FLAGS[temp & 0x00FF]
         return 1
 
     def DEC(self):
         self.fetch()
         temp = self.fetched - 1
         self.write(self.addr_abs, temp & 0x00FF)
-        self.SetFlag(self.FLAGS6502_Z, 1 if temp == 0x00 else 0)
-        self.SetFlag(self.FLAGS6502_N, 1 if (temp & 0x80) > 0 else 0)
+        self.status = (self.status & ~self.FLAGS6502_NZ) | self.NZ_FLAGS[temp & 0x00FF]
         return 0
 
     def DEX(self):
         self.x = (self.x - 1) & 0xFF
-        self.SetFlag(self.FLAGS6502_Z, 1 if self.x == 0x00 else 0)
-        self.SetFlag(self.FLAGS6502_N, 1 if (self.x & 0x80) > 0 else 0)
+        self.status = (self.status & ~self.FLAGS6502_NZ) | self.NZ_FLAGS[self.x]
         return 0
 
     def DEY(self):
         self.y = (self.y - 1) & 0xFF
-        self.SetFlag(self.FLAGS6502_Z, 1 if self.y == 0x00 else 0)
-        self.SetFlag(self.FLAGS6502_N, 1 if (self.y & 0x80) > 0 else 0)
+        self.status = (self.status & ~self.FLAGS6502_NZ) | self.NZ_FLAGS[self.y]
         return 0
 
     def EOR(self):
         self.fetch()
         self.a ^= self.fetched
-        self.SetFlag(self.FLAGS6502_Z, 1 if self.a == 0x00 else 0)
-        self.SetFlag(self.FLAGS6502_N, 1 if (self.a & 0x80) > 0 else 0)
+        self.status = (self.status & ~self.FLAGS6502_NZ) | self.NZ_FLAGS[self.a]
         return 0
 
     def INC(self):
         self.fetch()
         temp = self.fetched + 1
         self.write(self.addr_abs, temp & 0x00FF)
-        self.SetFlag(self.FLAGS6502_Z, 1 if temp == 0x00 else 0)
-        self.SetFlag(self.FLAGS6502_N, 1 if (temp & 0x80) > 0 else 0)
+        self.status = (self.status & ~self.FLAGS6502_NZ) | self.NZ_FLAGS[temp & 0x00FF]
         return 0
 
     def INX(self):
         self.x = (self.x + 1) & 0xFF
-        self.SetFlag(self.FLAGS6502_Z, 1 if self.x == 0x00 else 0)
-        self.SetFlag(self.FLAGS6502_N, 1 if (self.x & 0x80) > 0 else 0)
+        self.status = (self.status & ~self.FLAGS6502_NZ) | self.NZ_FLAGS[self.x]
         return 0
 
     def INY(self):
         self.y = (self.y + 1) & 0xFF
-        self.SetFlag(self.FLAGS6502_Z, 1 if self.y == 0x00 else 0)
-        self.SetFlag(self.FLAGS6502_N, 1 if (self.y & 0x80) > 0 else 0)
+        self.status = (self.status & ~self.FLAGS6502_NZ) | self.NZ_FLAGS[self.y]
         return 0
 
     def JMP(self):
@@ -434,30 +451,25 @@ class Nes6502:
     def LDA(self):
         self.fetch()
         self.a = self.fetched & 0xFF
-        self.SetFlag(self.FLAGS6502_Z, 1 if self.a == 0x00 else 0)
-        self.SetFlag(self.FLAGS6502_N, 1 if (self.a & 0x80) > 0 else 0)
+        self.status = (self.status & ~self.FLAGS6502_NZ) | self.NZ_FLAGS[self.a]
         return 0
 
     def LDX(self):
         self.fetch()
         self.x = self.fetched & 0xFF
-        self.SetFlag(self.FLAGS6502_Z, 1 if self.x == 0x00 else 0)
-        self.SetFlag(self.FLAGS6502_N, 1 if (self.x & 0x80) > 0 else 0)
+        self.status = (self.status & ~self.FLAGS6502_NZ) | self.NZ_FLAGS[self.x]
         return 0
 
     def LDY(self):
         self.fetch()
         self.y = self.fetched & 0xFF
-        self.SetFlag(self.FLAGS6502_Z, 1 if self.y == 0x00 else 0)
-        self.SetFlag(self.FLAGS6502_N, 1 if (self.y & 0x80) > 0 else 0)
+        self.status = (self.status & ~self.FLAGS6502_NZ) | self.NZ_FLAGS[self.y]
         return 0
 
     def LSR(self):
         self.fetch()
-        self.SetFlag(self.FLAGS6502_C, 1 if self.fetched & 0x0001 > 0 else 0)
         temp = self.fetched >> 1
-        self.SetFlag(self.FLAGS6502_Z, 1 if (temp & 0x00FF) == 0x0000 else 0)
-        self.SetFlag(self.FLAGS6502_N, 1 if (temp & 0x0080) > 0 else 0)
+        self.status = (self.status & ~self.FLAGS6502_NZC) | (self.fetched & 0x0001) | self.NZ_FLAGS[temp & 0x00FF]
         if (self.lookup[self.opcode].addrmode == self.IMP):
             self.a = temp & 0xFF
         else:
@@ -472,8 +484,7 @@ class Nes6502:
     def ORA(self):
         self.fetch()
         self.a |= self.fetched
-        self.SetFlag(self.FLAGS6502_Z, 1 if self.a == 0x00 else 0)
-        self.SetFlag(self.FLAGS6502_N, 1 if (self.a & 0x80) > 0 else 0)
+        self.status = (self.status & ~self.FLAGS6502_NZ) | self.NZ_FLAGS[self.a]
         return 0
 
     def PHA(self):
@@ -482,31 +493,26 @@ class Nes6502:
         return 0
 
     def PHP(self):
+        # B and U only exist in the pushed copy, the status keeps U set
         self.write(0x0100 + self.stkp, self.status | self.FLAGS6502_B | self.FLAGS6502_U)
-        self.SetFlag(self.FLAGS6502_B, 0)
-        self.SetFlag(self.FLAGS6502_U, 0)
         self.stkp = (self.stkp - 1) & 0xFF
         return 0
 
     def PLA(self):
         self.stkp = (self.stkp + 1) & 0xFF
         self.a = self.read(0x0100 + self.stkp)
-        self.SetFlag(self.FLAGS6502_Z, 1 if self.a == 0x00 else 0)
-        self.SetFlag(self.FLAGS6502_N, 1 if self.a & 0x80 > 0 else 0)
+        self.status = (self.status & ~self.FLAGS6502_NZ) | self.NZ_FLAGS[self.a]
         return 0
 
     def PLP(self):
         self.stkp = (self.stkp + 1) & 0xFF
-        self.status = self.read(0x0100 + self.stkp)
-        self.SetFlag(self.FLAGS6502_U, 1)
+        self.status = (self.read(0x0100 + self.stkp) & ~self.FLAGS6502_B) | self.FLAGS6502_U
         return 0
 
     def ROL(self):
         self.fetch()
-        temp = (self.fetched << 1) | self.GetFlag(self.FLAGS6502_C)
-        self.SetFlag(self.FLAGS6502_C, 1 if (temp & 0xFF00) > 0 else 0)
-        self.SetFlag(self.FLAGS6502_Z, 1 if (temp & 0x00FF) == 0x0000 else 0)
-        self.SetFlag(self.FLAGS6502_N, 1 if (temp & 0x0080) > 0 else 0)
+        temp = (self.fetched << 1) | (self.status & self.FLAGS6502_C)
+        self.status = (self.status & ~self.FLAGS6502_NZC) | (temp >> 8) | self.NZ_FLAGS[temp & 0x00FF]
         if (self.lookup[self.opcode].addrmode == self.IMP):
             self.a = temp & 0xFF
         else:
@@ -515,10 +521,8 @@ class Nes6502:
 
     def ROR(self):
         self.fetch()
-        temp = (self.GetFlag(self.FLAGS6502_C) << 7) | (self.fetched >> 1)
-        self.SetFlag(self.FLAGS6502_C, 1 if (self.fetched & 0x0001) > 0 else 0)
-        self.SetFlag(self.FLAGS6502_Z, 1 if (temp & 0x00FF) == 0x0000 else 0)
-        self.SetFlag(self.FLAGS6502_N, 1 if (temp & 0x0080) > 0 else 0)
+        temp = ((self.status & self.FLAGS6502_C) << 7) | (self.fetched >> 1)
+        self.status = (self.status & ~self.FLAGS6502_NZC) | (self.fetched & 0x0001) | self.NZ_FLAGS[temp & 0x00FF]
         if (self.lookup[self.opcode].addrmode == self.IMP):
             self.a = temp & 0xFF
         else:
@@ -527,9 +531,7 @@ class Nes6502:
 
     def RTI(self):
         self.stkp = (self.stkp + 1) & 0xFF
-        self.status = self.read(0x0100 + self.stkp)
-        self.SetFlag(self.FLAGS6502_B, 0)
-        self.SetFlag(self.FLAGS6502_U, 0)
+        self.status = (self.read(0x0100 + self.stkp) & ~self.FLAGS6502_B) | self.FLAGS6502_U
 
         self.stkp = (self.stkp + 1) & 0xFF
         lo = self.read(0x0100 + self.stkp)
@@ -552,25 +554,23 @@ class Nes6502:
         self.fetch()
         
         value = self.fetched ^ 0x00FF
-        temp = self.a + value + self.GetFlag(self.FLAGS6502_C)
-        self.SetFlag(self.FLAGS6502_C, 1 if temp > 255 else 0)
-        self.SetFlag(self.FLAGS6502_Z, 1 if (temp & 0x00FF) == 0 else 0)
-        self.SetFlag(self.FLAGS6502_N, 1 if (temp & 0x80) > 0 else 0)
-        self.SetFlag(self.FLAGS6502_V, 1 if (((self.a ^ temp) & (value ^ temp)) & 0x0080) > 0 else 0)
+        temp = self.a + value + (self.status & self.FLAGS6502_C)
+        self.status = ((self.status & ~self.FLAGS6502_NVZC) | (temp >> 8) | self.NZ_FLAGS[temp & 0x00FF]
+            | ((((self.a ^ temp) & (value ^ temp)) & 0x0080) >> 1))
 
         self.a = temp & 0xFF
         return 1
 
     def SEC(self):
-        self.SetFlag(self.FLAGS6502_C, 1)
+        self.status |= self.FLAGS6502_C
         return 0
 
     def SED(self):
-        self.SetFlag(self.FLAGS6502_D, 1)
+        self.status |= self.FLAGS6502_D
         return 0
 
     def SEI(self):
-        self.SetFlag(self.FLAGS6502_I, 1)
+        self.status |= self.FLAGS6502_I
         return 0
 
     def STA(self):
@@ -587,26 +587,22 @@ class Nes6502:
 
     def TAX(self):
         self.x = self.a & 0xFF
-        self.SetFlag(self.FLAGS6502_Z, 1 if (self.x & 0x00FF) == 0 else 0)
-        self.SetFlag(self.FLAGS6502_N, 1 if (self.x & 0x80) > 0 else 0)
+        self.status = (self.status & ~self.FLAGS6502_NZ) | self.NZ_FLAGS[self.x]
         return 0
 
     def TAY(self):
         self.y = self.a & 0xFF
-        self.SetFlag(self.FLAGS6502_Z, 1 if (self.y & 0x00FF) == 0 else 0)
-        self.SetFlag(self.FLAGS6502_N, 1 if (self.y & 0x80) > 0 else 0)
+        self.status = (self.status & ~self.FLAGS6502_NZ) | self.NZ_FLAGS[self.y]
         return 0
 
     def TSX(self):
         self.x = self.stkp & 0xFF
-        self.SetFlag(self.FLAGS6502_Z, 1 if (self.x & 0x00FF) == 0 else 0)
-        self.SetFlag(self.FLAGS6502_N, 1 if (self.x & 0x80) > 0 else 0)
+        self.status = (self.status & ~self.FLAGS6502_NZ) | self.NZ_FLAGS[self.x]
         return 0
 
     def TXA(self):
         self.a = self.x & 0xFF
-        self.SetFlag(self.FLAGS6502_Z, 1 if (self.a & 0x00FF) == 0 else 0)
-        self.SetFlag(self.FLAGS6502_N, 1 if (self.a & 0x80) > 0 else 0)
+        self.status = (self.status & ~self.FLAGS6502_NZ) | self.NZ_FLAGS[self.a]
         return 0
 
     def TXS(self):
@@ -615,8 +611,7 @@ class Nes6502:
 
     def TYA(self):
         self.a = self.y & 0xFF
-        self.SetFlag(self.FLAGS6502_Z, 1 if (self.a & 0x00FF) == 0 else 0)
-        self.SetFlag(self.FLAGS6502_N, 1 if (self.a & 0x80) > 0 else 0)
+        self.status = (self.status & ~self.FLAGS6502_NZ) | self.NZ_FLAGS[self.a]
         return 0
 
     def XXX(self):
@@ -628,17 +623,34 @@ class Nes6502:
         if self.cycles == 0:
             self.opcode = self.read(self.pc)
             self.pc = (self.pc + 1) & 0xFFFF
-
-            instruction = self.lookup[self.opcode]
-            self.cycles = instruction.cycles
-            additional_cycle1 = instruction.addrmode()
-            additional_cycle2 = instruction.operate()
-
-            if additional_cycle1 and additional_cycle2:
-                self.cycles += 1
+            # the handler may add owed cycles (oam dma), so read them after it
+            cycles = self.handlers[self.opcode]()
+            self.cycles += cycles
         self.cycles -= 1
         self.clock_count += 1
 
+    def step(self):
+        # Executes one whole instruction at once and returns the number of
+        # cycles it took, plus any cycles still owed from clock(), a reset,
+        # an interrupt or an oam dma the instruction started. The caller is
+        # expected to catch the rest of the system up by that many cycles.
+        opcode = self.read(self.pc)
+        self.opcode = opcode
+        self.pc = (self.pc + 1) & 0xFFFF
+        cycles = self.handlers[opcode]() + self.cycles
+        self.cycles = 0
+
+        self.clock_count += cycles
+        return cycles
+
+    def run_cycles(self, cycles):
+        # runs whole instructions until at least the given number of cycles
+        # have passed, returns how many actually did
+        elapsed = 0
+        while elapsed < cycles:
+            elapsed += self.step()
+        return elapsed
+
     def reset(self):
         self.a = 0x00
         self.x = 0x00
@@ -660,17 +672,18 @@ class Nes6502:
         self.cycles = 8
 
     def irq(self):
-        if self.GetFlag(self.FLAGS6502_I) == 0:
+        if (self.status & self.FLAGS6502_I) == 0:
             self.write(0x0100 + self.stkp, (self.pc >> 8) & 0x00FF)
             self.stkp = (self.stkp - 1) & 0xFF
             self.write(0x0100 + self.stkp, self.pc & 0x00FF)
             self.stkp = (self.stkp - 1) & 0xFF
 
-            self.SetFlag(self.FLAGS6502_B, 0)
-            self.SetFlag(self.FLAGS6502_U, 1)
-            self.SetFlag(self.FLAGS6502_I, 1)
+            # the status is pushed as it was before interrupts were disabled,
+            # RTI turns them back on
+            self.status = (self.status & ~self.FLAGS6502_B) | self.FLAGS6502_U
             self.write(0x0100 + self.stkp, self.status)
             self.stkp = (self.stkp - 1) & 0xFF
+            self.status |= self.FLAGS6502_I
 
             self.addr_abs = 0xFFFE
             lo = self.read(self.addr_abs)
@@ -685,11 +698,10 @@ class Nes6502:
         self.write(0x0100 + self.stkp, self.pc & 0x00FF)
         self.stkp = (self.stkp - 1) & 0xFF
 
-        self.SetFlag(self.FLAGS6502_B, 0)
-        self.SetFlag(self.FLAGS6502_U, 1)
-        self.SetFlag(self.FLAGS6502_I, 1)
+        self.status = (self.status & ~self.FLAGS6502_B) | self.FLAGS6502_U
         self.write(0x0100 + self.stkp, self.status)
         self.stkp = (self.stkp - 1) & 0xFF
+        self.status |= self.FLAGS6502_I
 
         self.addr_abs = 0xFFFA
         lo = self.read(self.addr_abs)
@@ -708,79 +720,81 @@ class Nes6502:
         addr = start;
         mapLines = {}
 
+        while addr <= stop:
+            mapLines[addr], addr = self.disassembleInstruction(addr)
+
+        return mapLines
+
+    def disassembleInstruction(self, addr):
+        # text of the instruction at addr, and the address of the next one
         hex = lambda x,y:'{word:0{padding}X}'.format(word=x if x >=0 else x+256, padding=y)
 
-        while addr <= stop:
-            line_addr = addr
+        inst = "$" + hex(addr, 4) + ": "
 
-            inst = "$" + hex(addr, 4) + ": "
+        opcode = self.bus.cpuRead(addr, True)
+        addr += 1
+        inst += self.lookup[opcode].name + " "
 
-            opcode = self.bus.cpuRead(addr, True)
+        if self.lookup[opcode].addrmode == self.IMP:
+            inst += " {IMP}"
+        elif self.lookup[opcode].addrmode == self.IMM:
+            value = self.bus.cpuRead(addr, True)
+            addr += 1
+            inst += "#$" + hex(value, 2) + " {IMM}"
+        elif self.lookup[opcode].addrmode == self.ZP0:
+            lo = self.bus.cpuRead(addr, True)
+            addr += 1
+            hi = 0x00;
+            inst += "$" + hex(lo, 2) + " {ZP0}"
+        elif self.lookup[opcode].addrmode == self.ZPX:
+            lo = self.bus.cpuRead(addr, True)
+            addr += 1
+            hi = 0x00
+            inst += "$" + hex(lo, 2) + ", X {ZPX}"
+        elif self.lookup[opcode].addrmode == self.ZPY:
+            lo = self.bus.cpuRead(addr, True)
+            addr += 1
+            hi = 0x00
+            inst += "$" + hex(lo, 2) + ", Y {ZPY}"
+        elif self.lookup[opcode].addrmode == self.IZX:
+            lo = self.bus.cpuRead(addr, True)
+            addr += 1
+            hi = 0x00
+            inst += "($" + hex(lo, 2) + ", X) {IZX}"
+        elif self.lookup[opcode].addrmode == self.IZY:
+            lo = self.bus.cpuRead(addr, True)
+            addr += 1
+            hi = 0x00
+            inst += "($" + hex(lo, 2) + "), Y {IZY}"
+        elif self.lookup[opcode].addrmode == self.ABS:
+            lo = self.bus.cpuRead(addr, True)
             addr += 1
-            inst += self.lookup[opcode].name + " "
-
-            if self.lookup[opcode].addrmode == self.IMP:
-                inst += " {IMP}"
-            elif self.lookup[opcode].addrmode == self.IMM:
-                value = self.bus.cpuRead(addr, True)
-                addr += 1
-                inst += "#$" + hex(value, 2) + " {IMM}"
-            elif self.lookup[opcode].addrmode == self.ZP0:
-                lo = self.bus.cpuRead(addr, True)
-                addr += 1
-                hi = 0x00;
-                inst += "$" + hex(lo, 2) + " {ZP0}"
-            elif self.lookup[opcode].addrmode == self.ZPX:
-                lo = self.bus.cpuRead(addr, True)
-                addr += 1
-                hi = 0x00
-                inst += "$" + hex(lo, 2) + ", X {ZPX}"
-            elif self.lookup[opcode].addrmode == self.ZPY:
-                lo = self.bus.cpuRead(addr, True)
-                addr += 1
-                hi = 0x00
-                inst += "$" + hex(lo, 2) + ", Y {ZPY}"
-            elif self.lookup[opcode].addrmode == self.IZX:
-                lo = self.bus.cpuRead(addr, True)
-                addr += 1
-                hi = 0x00
-                inst += "($" + hex(lo, 2) + ", X) {IZX}"
-            elif self.lookup[opcode].addrmode == self.IZY:
-                lo = self.bus.cpuRead(addr, True)
-                addr += 1
-                hi = 0x00
-                inst += "($" + hex(lo, 2) + "), Y {IZY}"
-            elif self.lookup[opcode].addrmode == self.ABS:
-                lo = self.bus.cpuRead(addr, True)
-                addr += 1
-                hi = self.bus.cpuRead(addr, True)
-                addr += 1
-                inst += "$" + hex((hi << 8) | lo, 4) + " {ABS}"
-            elif self.lookup[opcode].addrmode == self.ABX:
-                lo = self.bus.cpuRead(addr, True)
-                addr += 1
-                hi = self.bus.cpuRead(addr, True)
-                addr += 1
-                inst += "$" + hex((hi << 8) | lo, 4) + ", X {ABX}"
-            elif self.lookup[opcode].addrmode == self.ABY:
-                lo = self.bus.cpuRead(addr, True)
-                addr += 1
-                hi = self.bus.cpuRead(addr, True)
-                addr += 1
-                inst += "$" + hex((hi << 8) | lo, 4) + ", Y {ABY}"
-            elif self.lookup[opcode].addrmode == self.IND:
-                lo = self.bus.cpuRead(addr, True)
-                addr += 1
-                hi = self.bus.cpuRead(addr, True)
-                addr += 1
-                inst += "($" + hex((hi << 8) | lo, 4) + ") {IND}"
-            elif self.lookup[opcode].addrmode == self.REL:
-                value = self.bus.cpuRead(addr, True)
-                if value & 0x80 > 0:
-                    value = value - 256
-                addr += 1
-                inst += "$" + hex(value, 2) + " [$" + hex(addr + value, 4) + "] {REL}"
-
-            mapLines[line_addr] = inst
+            hi = self.bus.cpuRead(addr, True)
+            addr += 1
+            inst += "$" + hex((hi << 8) | lo, 4) + " {ABS}"
+        elif self.lookup[opcode].addrmode == self.ABX:
+            lo = self.bus.cpuRead(addr, True)
+            addr += 1
+            hi = self.bus.cpuRead(addr, True)
+            addr += 1
+            inst += "$" + hex((hi << 8) | lo, 4) + ", X {ABX}"
+        elif self.lookup[opcode].addrmode == self.ABY:
+            lo = self.bus.cpuRead(addr, True)
+            addr += 1
+            hi = self.bus.cpuRead(addr, True)
+            addr += 1
+            inst += "$" + hex((hi << 8) | lo, 4) + ", Y {ABY}"
+        elif self.lookup[opcode].addrmode == self.IND:
+            lo = self.bus.cpuRead(addr, True)
+            addr += 1
+            hi = self.bus.cpuRead(addr, True)
+            addr += 1
+            inst += "($" + hex((hi << 8) | lo, 4) + ") {IND}"
+        elif self.lookup[opcode].addrmode == self.REL:
+            value = self.bus.cpuRead(addr, True)
+            if value & 0x80 > 0:
+                value = value - 256
+            addr += 1
+            inst += "$" + hex(value, 2) + " [$" + hex(addr + value, 4) + "] {REL}"
 
-        return mapLines
+        return inst, addr
@@ -0,0 +1,305 @@
+from Nes6502Codegen import OPERAND_BYTES, BRANCH_CONDITIONS, operation
+
+# Basic block translator for the Nes6502. A straight run of instructions in prg
+# rom, up to and including the first jump, branch, call or return, is compiled
+# into one Python function with the operands decoded at translation time:
+# immediates and static addresses become constants and accesses to memory
+# backed pages index the memory directly. Running a block costs one call and
+# one ppu catch-up instead of one of each per instruction.
+#
+# Only code in read-only pages (prg rom) is translated, so a block can never
+# be overwritten. A block remembers the pages its code and static addresses
+# are on, and is put aside when the mapper switches the bank of one of them
+# (InvalidatePages), to be taken back once the same banks are mapped there
+# again. Code running from ram is stepped as before.
+#
+# Results are the same as stepping instruction by instruction:
+# - an instruction with a static address on a page with side effects (ppu and
+#   io registers, mapper registers) ends the block before it, and one whose
+#   address is only known at run time checks the page tables first and leaves
+#   the block without executing when it lands on such a page, so every
+#   register access is still made by Nes6502.step with the ppu caught up
+# - a block ends after CLI or PLP, where a pending apu irq may be taken
+# - a block is only run when it cannot reach the dot that raises nmi or ends
+#   the frame, so interrupts and frame boundaries fall between the same
+#   instructions
+
+# operations by what they do with the effective address
+READ_OPS = ("LDA", "LDX", "LDY", "AND", "ORA", "EOR", "ADC", "SBC", "CMP", "CPX", "CPY", "BIT")
+WRITE_OPS = ("STA", "STX", "STY")
+MODIFY_OPS = ("ASL", "LSR", "ROL", "ROR", "INC", "DEC")
+# operations that end a block
+EXIT_OPS = ("JMP", "JSR", "RTS", "RTI", "BRK") + tuple(BRANCH_CONDITIONS)
+# operations that may clear the interrupt disable flag also end a block, an irq
+# already pending is then taken right after them
+UNMASK_OPS = ("CLI", "PLP")
+
+MAX_INSTRUCTIONS = 32
+# times a pc has to be reached before a block is translated for it, so code
+# that runs once (start up, level loading) is not compiled
+HOT_VISITS = 4
+
+class BlockCache:
+    def __init__(self, bus):
+        self.bus = bus
+        self.cpu = bus.cpu
+        self.table = tuple((i.operate.__name__, i.addrmode.__name__, i.cycles) for i in self.cpu.lookup)
+        # pc -> (block function, most cycles it can take), function is None
+        # where no block can start
+        self.blocks = {}
+        self.visits = {}
+        # cpu page -> pcs of the blocks translated from it, pc -> (pages, their
+        # mapping) for the blocks in use, and pc -> [(pages, mapping, entry)]
+        # for blocks whose pages have been switched to other banks
+        self.pageBlocks = [set() for page in range(257)]
+        self.dependencies = {}
+        self.shelved = {}
+        # blocks compiled so far, for checking the cache is in use
+        self.translated = 0
+
+    def Invalidate(self):
+        self.blocks.clear()
+        self.visits.clear()
+        for pcs in self.pageBlocks:
+            pcs.clear()
+        self.dependencies.clear()
+        self.shelved.clear()
+
+    def InvalidatePages(self, first, last):
+        # the page tables changed for pages first..last
+        blocks = self.blocks
+        for page in range(first, last + 1):
+            pcs = self.pageBlocks[page]
+            for pc in pcs:
+                entry = blocks.pop(pc, None)
+                if entry is not None:
+                    pages, mapping = self.dependencies.pop(pc)
+                    self.shelved.setdefault(pc, []).append((pages, mapping, entry))
+            pcs.clear()
+
+    def Mapping(self, pages):
+        # what pages are mapped to, memories compared by identity
+        readMap = self.bus.cpuReadMap
+        writeMap = self.bus.cpuWriteMap
+        return tuple((id(readMap[page][0]), readMap[page][1], id(writeMap[page][0]), writeMap[page][1]) for page in pages)
+
+    def Keep(self, pc, pages, mapping, entry):
+        self.blocks[pc] = entry
+        self.dependencies[pc] = (pages, mapping)
+        for page in pages:
+            self.pageBlocks[page].add(pc)
+
+    def Unshelve(self, pc):
+        # the block put aside for pc that was translated with the banks now
+        # mapped, if any
+        candidates = self.shelved.get(pc)
+        if candidates:
+            for i, (pages, mapping, entry) in enumerate(candidates):
+                if self.Mapping(pages) == mapping:
+                    del candidates[i]
+                    self.Keep(pc, pages, mapping, entry)
+                    return entry
+        return None
+
+    def step(self):
+        # Drop-in for Nes6502.step: runs the block at pc, or one instruction
+        # where there is none or it could run into a ppu event. Returns cycles.
+        cpu = self.cpu
+        pc = cpu.pc
+        entry = self.blocks.get(pc)
+        if entry is None and pc in self.shelved:
+            entry = self.Unshelve(pc)
+        if entry is None:
+            visits = self.visits.get(pc, 0) + 1
+            self.visits[pc] = visits
+            if visits < HOT_VISITS:
+                return cpu.step()
+            entry = self.Translate(pc)
+
+        block, maxCycles = entry
+        bus = self.bus
+        if block is None or (cpu.cycles + maxCycles) * 3 > bus.ppuEventClock - bus.systemClockCounter:
+            return cpu.step()
+        cycles = block()
+        if cycles == 0:
+            # the first instruction touches a register page
+            return cpu.step()
+        cycles += cpu.cycles
+        cpu.cycles = 0
+        cpu.clock_count += cycles
+        return cycles
+
+    def IsRom(self, addr):
+        return self.bus.cpuRomPages[(addr & 0xFFFF) >> 8]
+
+    def Translate(self, start):
+        bus = self.bus
+        cpu = self.cpu
+        readMap = bus.cpuReadMap
+        writeMap = bus.cpuWriteMap
+        namespace = {"cpu": cpu, "read": cpu.read, "write": cpu.write, "NZ": cpu.NZ_FLAGS,
+                     "readMap": readMap, "writeMap": writeMap}
+        memories = []
+        # pages the block is translated from, the block is only valid while
+        # they stay mapped as they are
+        pages = {start >> 8}
+
+        def memory_name(memory):
+            for i, known in enumerate(memories):
+                if known is memory:
+                    return "M%d" % i
+            memories.append(memory)
+            namespace["M%d" % (len(memories) - 1)] = memory
+            return "M%d" % (len(memories) - 1)
+
+        def static(pageMap, addr):
+            # expression for the byte at a fixed address, None for a register page
+            pages.add(addr >> 8)
+            memory, offset = pageMap[addr >> 8]
+            if memory is None:
+                return None
+            return "%s[0x%04X]" % (memory_name(memory), offset + (addr & 0xFF))
+
+        def zero_page(pageMap, index):
+            memory, offset = pageMap[0]
+            if memory is None:
+                return None
+            return "%s[0x%04X + %s]" % (memory_name(memory), offset, index) if offset else "%s[%s]" % (memory_name(memory), index)
+
+        body = ["c = 0"]
+        cycles = 0          # cycles of the instructions so far, without extras
+        maxCycles = 0
+        count = 0
+        pc = start
+        previous = None     # opcode of the previous instruction
+        ended = None        # the operation that ended the block, if any
+        while count < MAX_INSTRUCTIONS:
+            opcode = bus.cpuRead(pc, True)
+            op, mode, base = self.table[opcode]
+            size = OPERAND_BYTES[mode]
+            if not all(self.IsRom(pc + i) for i in range(size + 1)):
+                break
+            pages.add(pc >> 8)
+            pages.add(((pc + size) & 0xFFFF) >> 8)
+            lo = bus.cpuRead((pc + 1) & 0xFFFF, True) if size > 0 else 0
+            hi = bus.cpuRead((pc + 2) & 0xFFFF, True) if size > 1 else 0
+            following = (pc + 1 + size) & 0xFFFF
+            access = "read" if op in READ_OPS else "write" if op in WRITE_OPS else "modify" if op in MODIFY_OPS and mode != "IMP" else None
+
+            if previous is None:
+                leave = ["return 0"]
+            else:
+                leave = ["cpu.pc = 0x%04X" % pc, "cpu.opcode = 0x%02X" % previous, "return %d + c" % cycles]
+            lines = []
+            value = result = None
+            crossed = None
+            dynamic = False
+
+            if mode == "IMM":
+                value = "0x%02X" % lo
+            elif mode in ("ZP0", "ABS"):
+                addr = lo | (hi << 8)
+                if op in ("JMP", "JSR"):
+                    lines.append("addr = 0x%04X" % addr)
+                else:
+                    value = static(readMap, addr)
+                    result = static(writeMap, addr)
+                    if (access in ("read", "modify") and value is None) or (access in ("write", "modify") and result is None):
+                        break
+            elif mode in ("ZPX", "ZPY"):
+                lines.append("addr = (0x%02X + cpu.%s) & 0xFF" % (lo, mode[2].lower()))
+                value = zero_page(readMap, "addr")
+                result = zero_page(writeMap, "addr")
+                if value is None or result is None:
+                    break
+            elif mode in ("ABX", "ABY"):
+                lines.append("addr = (0x%04X + cpu.%s) & 0xFFFF" % (lo | (hi << 8), mode[2].lower()))
+                crossed = "(addr & 0xFF00) != 0x%04X" % ((lo | (hi << 8)) & 0xFF00)
+                dynamic = True
+            elif mode == "IZX":
+                pointer = zero_page(readMap, "(t & 0xFF)")
+                if pointer is None:
+                    break
+                lines += ["t = 0x%02X + cpu.x" % lo,
+                          "addr = %s | (%s << 8)" % (pointer, zero_page(readMap, "((t + 1) & 0xFF)"))]
+                dynamic = True
+            elif mode == "IZY":
+                low, high = static(readMap, lo), static(readMap, (lo + 1) & 0xFF)
+                if low is None:
+                    break
+                lines += ["lo = %s" % low, "hi = %s" % high,
+                          "addr = (((hi << 8) | lo) + cpu.y) & 0xFFFF"]
+                crossed = "(addr & 0xFF00) != (hi << 8)"
+                dynamic = True
+            elif mode == "IND":
+                # the pointer never leaves its page, see Nes6502.IND
+                ptr = lo | (hi << 8)
+                low = static(readMap, ptr)
+                high = static(readMap, (ptr & 0xFF00) | ((ptr + 1) & 0xFF))
+                if low is None:
+                    break
+                lines.append("addr = (%s << 8) | %s" % (high, low))
+
+            if dynamic and access is not None:
+                # the page is only known now, leave the block if it has side effects
+                if access in ("read", "modify"):
+                    lines.append("rm, ro = readMap[addr >> 8]")
+                    value = "rm[ro + (addr & 0xFF)]"
+                if access in ("write", "modify"):
+                    lines.append("wm, wo = writeMap[addr >> 8]")
+                    result = "wm[wo + (addr & 0xFF)]"
+                test = {"read": "rm is None", "write": "wm is None", "modify": "rm is None or wm is None"}[access]
+                lines.append("if %s:" % test)
+                lines += ["    " + line for line in leave]
+            if result is not None:
+                result += " = %s"
+
+            count += 1
+            cycles += base
+            if op in BRANCH_CONDITIONS:
+                target = following + (lo - 256 if lo & 0x80 else lo)
+                taken = base + (2 if (target & 0xFF00) != (following & 0xFF00) else 1)
+                lines += ["if %s:" % BRANCH_CONDITIONS[op],
+                          "    cpu.pc = 0x%04X" % target,
+                          "    cpu.opcode = 0x%02X" % opcode,
+                          "    return %d + c" % (cycles - base + taken)]
+                maxCycles += taken
+                body += lines
+                previous = opcode
+                pc = following
+                ended = op
+                break
+
+            op_lines, extra = operation(op, mode, opcode, value, result)
+            if op in ("JSR", "BRK"):
+                lines.append("pc = 0x%04X" % following)
+            lines += op_lines
+            maxCycles += base
+            if extra and crossed is not None:
+                lines += ["if %s:" % crossed, "    c += 1"]
+                maxCycles += 1
+            body += lines
+            previous = opcode
+            pc = following
+            if op in EXIT_OPS:
+                ended = op
+                break
+            if op in UNMASK_OPS:
+                break
+
+        pages = tuple(sorted(pages))
+        mapping = self.Mapping(pages)
+        if count == 0:
+            self.Keep(start, pages, mapping, (None, 0))
+            return None, 0
+        if ended is None or ended in BRANCH_CONDITIONS:
+            # jumps and returns have set the pc themselves
+            body.append("cpu.pc = 0x%04X" % pc)
+        body += ["cpu.opcode = 0x%02X" % previous, "return %d + c" % cycles]
+
+        source = "def block():\n" + "".join("    " + line + "\n" for line in body)
+        exec(compile(source, "<block $%04X>" % start, "exec"), namespace)
+        self.translated += 1
+        entry = (namespace["block"], maxCycles)
+        self.Keep(start, pages, mapping, entry)
+        return entry
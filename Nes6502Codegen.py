@@ -0,0 +1,239 @@
+# Generates one specialized Python function per opcode from the Nes6502
+# lookup table, with the addressing mode inlined into the operation and the
+# extra cycle rules resolved at generation time. Nes6502.lookup stays the
+# single source of truth: the generator only reads the name of each entry's
+# operate/addrmode method and its cycle count.
+#
+# The generated source is compiled once per process into a factory; each cpu
+# instance calls it to get 256 closures bound to its own read/write.
+
+# operand bytes following the opcode, per addressing mode
+OPERAND_BYTES = {
+    "IMP": 0, "IMM": 1, "ZP0": 1, "ZPX": 1, "ZPY": 1, "REL": 1,
+    "ABS": 2, "ABX": 2, "ABY": 2, "IND": 2, "IZX": 1, "IZY": 1,
+}
+
+BRANCH_CONDITIONS = {
+    "BCC": "not (cpu.status & 0x01)", "BCS": "cpu.status & 0x01",
+    "BNE": "not (cpu.status & 0x02)", "BEQ": "cpu.status & 0x02",
+    "BVC": "not (cpu.status & 0x40)", "BVS": "cpu.status & 0x40",
+    "BPL": "not (cpu.status & 0x80)", "BMI": "cpu.status & 0x80",
+}
+
+FLAG_OPS = {
+    "CLC": "cpu.status &= ~0x01", "SEC": "cpu.status |= 0x01",
+    "CLI": "cpu.status &= ~0x04", "SEI": "cpu.status |= 0x04",
+    "CLD": "cpu.status &= ~0x08", "SED": "cpu.status |= 0x08",
+    "CLV": "cpu.status &= ~0x40",
+}
+
+TRANSFER_OPS = {
+    "TAX": ("x", "cpu.a"), "TAY": ("y", "cpu.a"), "TSX": ("x", "cpu.stkp"),
+    "TXA": ("a", "cpu.x"), "TYA": ("a", "cpu.y"),
+}
+
+
+def addressing(mode):
+    # Lines that leave the effective address in 'addr' (or the branch offset
+    # in 'rel') with 'pc' pointing at the operand, and the expression telling
+    # whether a page was crossed. Reads happen in the same order as in the
+    # Nes6502 addressing mode methods.
+    if mode == "IMP":
+        return [], None
+    if mode == "IMM":
+        return ["addr = pc"], None
+    if mode == "ZP0":
+        return ["addr = read(pc) & 0x00FF"], None
+    if mode == "ZPX":
+        return ["addr = (read(pc) + cpu.x) & 0x00FF"], None
+    if mode == "ZPY":
+        return ["addr = (read(pc) + cpu.y) & 0x00FF"], None
+    if mode == "REL":
+        return ["rel = read(pc)", "if rel & 0x80:", "    rel -= 256"], None
+    if mode == "ABS":
+        return ["addr = read(pc) | (read((pc + 1) & 0xFFFF) << 8)"], None
+    if mode in ("ABX", "ABY"):
+        reg = "cpu.x" if mode == "ABX" else "cpu.y"
+        return ["base = read(pc) | (read((pc + 1) & 0xFFFF) << 8)",
+                "addr = (base + %s) & 0xFFFF" % reg], "(addr & 0xFF00) != (base & 0xFF00)"
+    if mode == "IND":
+        return ["ptr = read(pc) | (read((pc + 1) & 0xFFFF) << 8)",
+                "if (ptr & 0x00FF) == 0x00FF:",
+                "    addr = (read(ptr & 0xFF00) << 8) | read(ptr)",
+                "else:",
+                "    addr = (read(ptr + 1) << 8) | read(ptr)"], None
+    if mode == "IZX":
+        return ["t = read(pc) + cpu.x",
+                "addr = read(t & 0x00FF) | (read((t + 1) & 0x00FF) << 8)"], None
+    if mode == "IZY":
+        return ["t = read(pc)",
+                "lo = read(t & 0x00FF)",
+                "hi = read((t + 1) & 0x00FF)",
+                "addr = (((hi << 8) | lo) + cpu.y) & 0xFFFF"], "(addr & 0xFF00) != (hi << 8)"
+    raise ValueError("unknown addressing mode " + mode)
+
+
+def operation(op, mode, opcode, value=None, result=None):
+    # Lines for the operation itself. 'value' is what fetch() would return:
+    # the accumulator in implied mode, otherwise a read of the effective
+    # address, and 'result' stores to the same place. The block translator
+    # passes its own expressions for both. Returns (lines, extra cycle possible).
+    if value is None:
+        value = "cpu.a" if mode == "IMP" else "read(addr)"
+    if result is None:
+        result = "cpu.a = %s" if mode == "IMP" else "write(addr, %s)"
+
+    if op in ("LDA", "LDX", "LDY"):
+        reg = op[2].lower()
+        return ["v = %s & 0xFF" % value, "cpu.%s = v" % reg,
+                "cpu.status = (cpu.status & ~0x82) | NZ[v]"], False
+    if op in ("STA", "STX", "STY"):
+        return [result % ("cpu." + op[2].lower())], False
+    if op in ("AND", "ORA", "EOR"):
+        symbol = {"AND": "&", "ORA": "|", "EOR": "^"}[op]
+        return ["v = cpu.a %s %s" % (symbol, value), "cpu.a = v",
+                "cpu.status = (cpu.status & ~0x82) | NZ[v & 0xFF]"], op == "AND"
+    if op == "ADC":
+        return ["v = %s" % value, "a = cpu.a", "s = cpu.status",
+                "temp = a + v + (s & 0x01)",
+                "cpu.status = ((s & ~0xC3) | (temp >> 8) | NZ[temp & 0xFF]"
+                " | ((~(a ^ v) & (a ^ temp) & 0x0080) >> 1))",
+                "cpu.a = temp & 0xFF"], True
+    if op == "SBC":
+        return ["v = %s ^ 0x00FF" % value, "a = cpu.a", "s = cpu.status",
+                "temp = a + v + (s & 0x01)",
+                "cpu.status = ((s & ~0xC3) | (temp >> 8) | NZ[temp & 0xFF]"
+                " | (((a ^ temp) & (v ^ temp) & 0x0080) >> 1))",
+                "cpu.a = temp & 0xFF"], True
+    if op in ("CMP", "CPX", "CPY"):
+        reg = {"CMP": "a", "CPX": "x", "CPY": "y"}[op]
+        return ["temp = cpu.%s - %s" % (reg, value),
+                "cpu.status = (cpu.status & ~0x83) | ((temp >> 8) + 1) | NZ[temp & 0xFF]"], True
+    if op == "BIT":
+        return ["v = %s" % value,
+                "cpu.status = (cpu.status & ~0xC2) | (NZ[cpu.a & v] & 0x02) | (v & 0xC0)"], False
+    if op in ("ASL", "ROL"):
+        carry_in = " | (cpu.status & 0x01)" if op == "ROL" else ""
+        return ["temp = (%s << 1)%s" % (value, carry_in),
+                "cpu.status = (cpu.status & ~0x83) | (temp >> 8) | NZ[temp & 0xFF]",
+                result % "temp & 0x00FF"], False
+    if op in ("LSR", "ROR"):
+        carry_in = "((cpu.status & 0x01) << 7) | " if op == "ROR" else ""
+        return ["v = %s" % value, "temp = %s(v >> 1)" % carry_in,
+                "cpu.status = (cpu.status & ~0x83) | (v & 0x01) | NZ[temp & 0xFF]",
+                result % "temp & 0x00FF"], False
+    if op == "INC":
+        return ["temp = %s + 1" % value, result % "temp & 0x00FF",
+                "cpu.status = (cpu.status & ~0x82) | NZ[temp & 0xFF]"], False
+    if op == "DEC":
+        return ["temp = %s - 1" % value, result % "temp & 0x00FF",
+                "cpu.status = (cpu.status & ~0x82) | NZ[temp & 0xFF]"], False
+    if op in ("INX", "INY", "DEX", "DEY"):
+        reg = op[2].lower()
+        delta = "+" if op[0] == "I" else "-"
+        return ["v = (cpu.%s %s 1) & 0xFF" % (reg, delta), "cpu.%s = v" % reg,
+                "cpu.status = (cpu.status & ~0x82) | NZ[v]"], False
+    if op in TRANSFER_OPS:
+        reg, source = TRANSFER_OPS[op]
+        return ["v = %s & 0xFF" % source, "cpu.%s = v" % reg,
+                "cpu.status = (cpu.status & ~0x82) | NZ[v]"], False
+    if op == "TXS":
+        return ["cpu.stkp = cpu.x"], False
+    if op in FLAG_OPS:
+        return [FLAG_OPS[op]], False
+    if op == "PHA":
+        return ["stkp = cpu.stkp", "write(0x0100 + stkp, cpu.a)",
+                "cpu.stkp = (stkp - 1) & 0xFF"], False
+    if op == "PHP":
+        return ["stkp = cpu.stkp", "write(0x0100 + stkp, cpu.status | 0x30)",
+                "cpu.stkp = (stkp - 1) & 0xFF"], False
+    if op == "PLA":
+        return ["stkp = (cpu.stkp + 1) & 0xFF", "cpu.stkp = stkp",
+                "v = read(0x0100 + stkp)", "cpu.a = v",
+                "cpu.status = (cpu.status & ~0x82) | NZ[v & 0xFF]"], False
+    if op == "PLP":
+        return ["stkp = (cpu.stkp + 1) & 0xFF", "cpu.stkp = stkp",
+                "cpu.status = (read(0x0100 + stkp) & ~0x10) | 0x20"], False
+    if op == "JMP":
+        return ["cpu.pc = addr"], False
+    if op == "JSR":
+        return ["pc = (pc - 1) & 0xFFFF", "stkp = cpu.stkp",
+                "write(0x0100 + stkp, (pc >> 8) & 0x00FF)",
+                "write(0x0100 + ((stkp - 1) & 0xFF), pc & 0x00FF)",
+                "cpu.stkp = (stkp - 2) & 0xFF", "cpu.pc = addr"], False
+    if op == "RTS":
+        return ["stkp = cpu.stkp", "lo = read(0x0100 + ((stkp + 1) & 0xFF))",
+                "stkp = (stkp + 2) & 0xFF", "hi = read(0x0100 + stkp)", "cpu.stkp = stkp",
+                "cpu.pc = (((hi << 8) | lo) + 1) & 0xFFFF"], False
+    if op == "RTI":
+        return ["stkp = (cpu.stkp + 1) & 0xFF", "cpu.status = (read(0x0100 + stkp) & ~0x10) | 0x20",
+                "lo = read(0x0100 + ((stkp + 1) & 0xFF))",
+                "stkp = (stkp + 2) & 0xFF", "hi = read(0x0100 + stkp)", "cpu.stkp = stkp",
+                "cpu.pc = (hi << 8) | lo"], False
+    if op == "BRK":
+        return ["pc = (pc + 1) & 0xFFFF", "s = cpu.status", "stkp = cpu.stkp",
+                "write(0x0100 + stkp, (pc >> 8) & 0x00FF)",
+                "write(0x0100 + ((stkp - 1) & 0xFF), pc & 0x00FF)",
+                "write(0x0100 + ((stkp - 2) & 0xFF), s | 0x30)",
+                "cpu.status = (s & ~0x10) | 0x04", "cpu.stkp = (stkp - 3) & 0xFF",
+                "cpu.pc = read(0xFFFE) | (read(0xFFFF) << 8)"], False
+    if op == "NOP":
+        return [], opcode in (0x1C, 0x3C, 0x5C, 0x7C, 0xDC, 0xFC)
+    if op == "XXX":
+        return [], False
+    raise ValueError("no code template for " + op)
+
+
+def handler_name(op, mode, opcode):
+    return "%s_%s_%02X" % (op, mode, opcode)
+
+
+def generate(table):
+    # table: 256 (operation name, addressing mode name, cycles) tuples
+    lines = ["def factory(cpu, read, write, NZ):"]
+    names = []
+    for opcode, (op, mode, cycles) in enumerate(table):
+        name = handler_name(op, mode, opcode)
+        names.append(name)
+        body = ["pc = cpu.pc"] if mode != "IMP" else []
+        address_lines, page_crossed = addressing(mode)
+        body += address_lines
+        if OPERAND_BYTES[mode]:
+            body.append("pc = (pc + %d) & 0xFFFF" % OPERAND_BYTES[mode])
+            body.append("cpu.pc = pc")
+
+        if op in BRANCH_CONDITIONS:
+            body += ["if %s:" % BRANCH_CONDITIONS[op],
+                     "    target = pc + rel",
+                     "    cpu.pc = target",
+                     "    if (target & 0xFF00) != (pc & 0xFF00):",
+                     "        return %d" % (cycles + 2),
+                     "    return %d" % (cycles + 1),
+                     "return %d" % cycles]
+        else:
+            op_lines, extra = operation(op, mode, opcode)
+            body += op_lines
+            if extra and page_crossed is not None:
+                body.append("return %d if %s else %d" % (cycles + 1, page_crossed, cycles))
+            else:
+                body.append("return %d" % cycles)
+
+        lines.append("    def %s():" % name)
+        lines += ["        " + line for line in body]
+    lines.append("    return [%s]" % ", ".join(names))
+    return "\n".join(lines) + "\n"
+
+
+_factories = {}
+
+def build(cpu):
+    # Returns the 256 opcode handlers for this cpu. Each one executes a whole
+    # instruction (the opcode byte already consumed) and returns its cycles.
+    table = tuple((i.operate.__name__, i.addrmode.__name__, i.cycles) for i in cpu.lookup)
+    factory = _factories.get(table)
+    if factory is None:
+        namespace = {}
+        exec(compile(generate(table), "<Nes6502Codegen>", "exec"), namespace)
+        factory = namespace["factory"]
+        _factories[table] = factory
+    return factory(cpu, cpu.read, cpu.write, cpu.NZ_FLAGS)
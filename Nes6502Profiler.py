@@ -0,0 +1,182 @@
+import array
+
+# Profiler for the guest program. While running it replaces the cpu's opcode
+# handlers with wrappers that count instructions and cycles per pc and per
+# opcode, so a cpu that is not being profiled runs exactly the same code as
+# before. Per addressing mode figures are summed from the opcode counts.
+#
+# Calls are followed with JSR/RTS, and interrupts with nmi()/irq()/BRK and RTI,
+# to attribute cycles to call stacks for flame graphs. A frame is left when the
+# stack pointer gets back above where it was on entry, which also copes with
+# code dropping return addresses or jumping through pushed addresses.
+#
+# Translated blocks and skipped idle loops do not go through the handlers, so
+# both are turned off on the bus while profiling.
+
+JSR = 0x20
+RTS = 0x60
+RTI = 0x40
+BRK = 0x00
+
+class Profiler:
+    def __init__(self, cpu):
+        self.cpu = cpu
+        self.pcCount = array.array('Q', bytes(8 * 65536))
+        self.pcCycles = array.array('Q', bytes(8 * 65536))
+        self.opcodeCount = array.array('Q', bytes(8 * 256))
+        self.opcodeCycles = array.array('Q', bytes(8 * 256))
+        # collapsed call stack -> cycles
+        self.stackCycles = {}
+        # (stack pointer before the call, name) of the calls being executed
+        self.frames = []
+        self.stack = "main"
+        self.running = False
+
+    def Start(self):
+        cpu = self.cpu
+        if self.running:
+            return
+        self.running = True
+        self.handlers = cpu.handlers
+        cpu.handlers = [self.Wrap(opcode, handler) for opcode, handler in enumerate(self.handlers)]
+        self.nmi = cpu.nmi
+        self.irq = cpu.irq
+        cpu.nmi = lambda: self.Interrupt(self.nmi, "NMI")
+        cpu.irq = lambda: self.Interrupt(self.irq, "IRQ")
+        bus = getattr(cpu, 'bus', None)
+        if bus is not None:
+            self.busSettings = (bus.blockCache, bus.skipIdleLoops)
+            bus.blockCache = None
+            bus.skipIdleLoops = False
+
+    def Stop(self):
+        cpu = self.cpu
+        if not self.running:
+            return
+        self.running = False
+        cpu.handlers = self.handlers
+        del cpu.nmi
+        del cpu.irq
+        bus = getattr(cpu, 'bus', None)
+        if bus is not None:
+            bus.blockCache, bus.skipIdleLoops = self.busSettings
+
+    def Enter(self, stkp, name):
+        # frames at or below this stack pointer have been abandoned
+        frames = self.frames
+        while frames and frames[-1][0] <= stkp:
+            frames.pop()
+        frames.append((stkp, name))
+        self.stack = ";".join(["main"] + [frame[1] for frame in frames])
+
+    def Leave(self, stkp):
+        frames = self.frames
+        if frames and frames[-1][0] <= stkp:
+            while frames and frames[-1][0] <= stkp:
+                frames.pop()
+            self.stack = ";".join(["main"] + [frame[1] for frame in frames])
+
+    def Interrupt(self, interrupt, name):
+        cpu = self.cpu
+        stkp = cpu.stkp
+        pending = cpu.cycles
+        interrupt()
+        if cpu.stkp != stkp:
+            # taken, the entry cycles count towards the handler
+            self.Enter(stkp, name)
+            self.stackCycles[self.stack] = self.stackCycles.get(self.stack, 0) + cpu.cycles - pending
+
+    def Wrap(self, opcode, handler):
+        cpu = self.cpu
+        pcCount = self.pcCount
+        pcCycles = self.pcCycles
+        opcodeCount = self.opcodeCount
+        opcodeCycles = self.opcodeCycles
+        stackCycles = self.stackCycles
+
+        def count(pc, cycles):
+            pcCount[pc] += 1
+            pcCycles[pc] += cycles
+            opcodeCount[opcode] += 1
+            opcodeCycles[opcode] += cycles
+            stack = self.stack
+            stackCycles[stack] = stackCycles.get(stack, 0) + cycles
+
+        if opcode in (JSR, BRK):
+            name = "sub_%04X" if opcode == JSR else "BRK"
+            def profiled():
+                pc = (cpu.pc - 1) & 0xFFFF
+                stkp = cpu.stkp
+                cycles = handler()
+                count(pc, cycles)
+                self.Enter(stkp, name % cpu.pc if opcode == JSR else name)
+                return cycles
+        elif opcode in (RTS, RTI):
+            def profiled():
+                pc = (cpu.pc - 1) & 0xFFFF
+                cycles = handler()
+                count(pc, cycles)
+                self.Leave(cpu.stkp)
+                return cycles
+        else:
+            def profiled():
+                pc = (cpu.pc - 1) & 0xFFFF
+                cycles = handler()
+                pcCount[pc] += 1
+                pcCycles[pc] += cycles
+                opcodeCount[opcode] += 1
+                opcodeCycles[opcode] += cycles
+                stack = self.stack
+                stackCycles[stack] = stackCycles.get(stack, 0) + cycles
+                return cycles
+        return profiled
+
+    def Reset(self):
+        for table in (self.pcCount, self.pcCycles, self.opcodeCount, self.opcodeCycles):
+            for i in range(len(table)):
+                table[i] = 0
+        self.stackCycles.clear()
+
+    def ModeCounts(self):
+        # {addressing mode: (instructions, cycles)}
+        modes = {}
+        for opcode, instruction in enumerate(self.cpu.lookup):
+            mode = instruction.addrmode.__name__
+            count, cycles = modes.get(mode, (0, 0))
+            modes[mode] = (count + self.opcodeCount[opcode], cycles + self.opcodeCycles[opcode])
+        return modes
+
+    def WriteReport(self, f, by="pc"):
+        # Flat CSV report, by "pc", "opcode" or "mode", most cycles first
+        total = sum(self.opcodeCycles) or 1
+        lookup = self.cpu.lookup
+        if by == "pc":
+            f.write("pc,instructions,cycles,percent,instruction\n")
+            rows = [pc for pc in range(65536) if self.pcCount[pc]]
+            rows.sort(key=lambda pc: -self.pcCycles[pc])
+            for pc in rows:
+                text = self.cpu.disassembleInstruction(pc)[0].split(": ", 1)[1] if getattr(self.cpu, 'bus', None) else ""
+                f.write("$%04X,%d,%d,%.2f,%s\n" % (pc, self.pcCount[pc], self.pcCycles[pc],
+                    100.0 * self.pcCycles[pc] / total, text.strip()))
+        elif by == "opcode":
+            f.write("opcode,name,mode,instructions,cycles,percent\n")
+            rows = [opcode for opcode in range(256) if self.opcodeCount[opcode]]
+            rows.sort(key=lambda opcode: -self.opcodeCycles[opcode])
+            for opcode in rows:
+                f.write("$%02X,%s,%s,%d,%d,%.2f\n" % (opcode, lookup[opcode].name, lookup[opcode].addrmode.__name__,
+                    self.opcodeCount[opcode], self.opcodeCycles[opcode], 100.0 * self.opcodeCycles[opcode] / total))
+        elif by == "mode":
+            f.write("mode,instructions,cycles,percent\n")
+            modes = self.ModeCounts()
+            for mode in sorted(modes, key=lambda mode: -modes[mode][1]):
+                count, cycles = modes[mode]
+                if count:
+                    f.write("%s,%d,%d,%.2f\n" % (mode, count, cycles, 100.0 * cycles / total))
+        else:
+            raise ValueError("unknown report " + by)
+
+    def WriteCollapsed(self, f):
+        # one "frame;frame;frame cycles" line per call stack, the input format
+        # of flamegraph.pl and speedscope
+        for stack in sorted(self.stackCycles):
+            f.write("%s %d\n" % (stack, self.stackCycles[stack]))
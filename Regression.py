@@ -0,0 +1,368 @@
+import argparse
+import hashlib
+import itertools
+import os
+import random
+import re
+import sys
+import tempfile
+
+import Benchmark
+import Bus
+import Cartridge
+import Nes6502
+
+# Regression harness for checking optimizations of the cpu and ppu.
+#
+#   trace:  runs nestest.nes in automation mode (pc forced to $C000) and writes
+#           a per-instruction trace in the column format of nestest.log. With
+#           --golden the trace is compared against a golden log as it runs and
+#           stops at the first line that differs.
+#   frames: runs a rom for a number of frames and writes one sha1 of the frame
+#           buffer per frame, or compares them against a golden list.
+#   check:  self-checks that need no golden files, comparing the fast paths
+#           against the plain ones: the generated opcode handlers against the
+#           lookup table methods on random cpu states, every way of running
+#           frames against stepping with the ppu caught up after every
+#           instruction and dot rendering on the synthetic benchmark roms, and
+#           the oam dma stall through clock() and step().
+
+# addressing mode -> operand format, given the operand bytes and next pc
+OPERAND_FORMATS = {
+    "IMP": lambda lo, hi, pc: "",
+    "IMM": lambda lo, hi, pc: "#$%02X" % lo,
+    "ZP0": lambda lo, hi, pc: "$%02X" % lo,
+    "ZPX": lambda lo, hi, pc: "$%02X,X" % lo,
+    "ZPY": lambda lo, hi, pc: "$%02X,Y" % lo,
+    "REL": lambda lo, hi, pc: "$%04X" % ((pc + (lo - 256 if lo & 0x80 else lo)) & 0xFFFF),
+    "ABS": lambda lo, hi, pc: "$%04X" % ((hi << 8) | lo),
+    "ABX": lambda lo, hi, pc: "$%04X,X" % ((hi << 8) | lo),
+    "ABY": lambda lo, hi, pc: "$%04X,Y" % ((hi << 8) | lo),
+    "IND": lambda lo, hi, pc: "($%04X)" % ((hi << 8) | lo),
+    "IZX": lambda lo, hi, pc: "($%02X,X)" % lo,
+    "IZY": lambda lo, hi, pc: "($%02X),Y" % lo,
+}
+OPERAND_BYTES = {"IMP": 0, "IMM": 1, "ZP0": 1, "ZPX": 1, "ZPY": 1, "REL": 1, "IZX": 1, "IZY": 1,
+                 "ABS": 2, "ABX": 2, "ABY": 2, "IND": 2}
+# shifts and rotates of the accumulator are written "ASL A"
+ACCUMULATOR_OPCODES = (0x0A, 0x2A, 0x4A, 0x6A)
+
+TRACE_REGISTERS = re.compile(r'A:([0-9A-F]{2}) X:([0-9A-F]{2}) Y:([0-9A-F]{2}) P:([0-9A-F]{2}) SP:([0-9A-F]{2})')
+TRACE_PPU = re.compile(r'PPU:\s*(\d+),\s*(\d+)')
+TRACE_CYCLES = re.compile(r'CYC:(\d+)')
+
+def AddressingModeName(cpu, opcode):
+    mode = cpu.lookup[opcode].addrmode
+    for name in OPERAND_BYTES:
+        if mode == getattr(cpu, name):
+            return name
+
+def TraceLine(nes):
+    # the nestest.log line for the instruction at pc, before it executes
+    nes.SyncPpu()
+    cpu = nes.cpu
+    ppu = nes.ppu
+    pc = cpu.pc
+    opcode = nes.cpuRead(pc, True)
+    mode = AddressingModeName(cpu, opcode)
+    operands = [nes.cpuRead((pc + 1 + i) & 0xFFFF, True) for i in range(OPERAND_BYTES[mode])]
+    lo = operands[0] if len(operands) > 0 else 0
+    hi = operands[1] if len(operands) > 1 else 0
+    operand = "A" if opcode in ACCUMULATOR_OPCODES else OPERAND_FORMATS[mode](lo, hi, pc + 1 + len(operands))
+    return "%04X  %-8s  %-32sA:%02X X:%02X Y:%02X P:%02X SP:%02X PPU:%3d,%3d CYC:%d" % (
+        pc, " ".join("%02X" % b for b in [opcode] + operands), (cpu.lookup[opcode].name + " " + operand).rstrip(),
+        cpu.a, cpu.x, cpu.y, cpu.status, cpu.stkp, ppu.scanline, ppu.cycle, cpu.clock_count)
+
+def TraceFields(line, ppu):
+    # the parts of a trace line that are compared: pc, instruction bytes,
+    # registers, cycle count and optionally the ppu position. The disassembly
+    # text is left out, nestest.log annotates it with memory contents.
+    registers = TRACE_REGISTERS.search(line)
+    cycles = TRACE_CYCLES.search(line)
+    fields = (line[0:4], line[6:14].split(), registers.groups() if registers else None,
+        cycles.group(1) if cycles else None)
+    if ppu:
+        position = TRACE_PPU.search(line)
+        fields += (position.groups() if position else None,)
+    return fields
+
+def NesTestBus(filename):
+    # nestest in automation mode: starts at $C000 instead of the reset vector,
+    # with the state a real reset leaves (7 cycles in, 21 ppu dots)
+    nes = Bus.Bus()
+    nes.insertCartridge(Cartridge.Cartridge(filename))
+    nes.reset()
+    # every instruction is traced, none may be skipped
+    nes.skipIdleLoops = False
+    cpu = nes.cpu
+    cpu.pc = 0xC000
+    cpu.status = 0x24
+    cpu.cycles = 0
+    cpu.clock_count = 7
+    nes.ppu.run_dots(21)
+    return nes
+
+def RunTrace(filename, golden=None, output=None, lines=None, ppu=False):
+    # Returns the number of matching lines, and the first differing line
+    # number or None if the whole trace matched.
+    nes = NesTestBus(filename)
+    count = 0
+    for expected in (golden if golden is not None else itertools.repeat(None)):
+        if lines is not None and count >= lines:
+            break
+        line = TraceLine(nes)
+        if output is not None:
+            output.write(line + "\n")
+        if golden is not None:
+            expected = expected.rstrip("\r\n")
+            if TraceFields(line, ppu) != TraceFields(expected, ppu):
+                print("line %d differs" % (count + 1), file=sys.stderr)
+                print("  expected: %s" % expected, file=sys.stderr)
+                print("  got:      %s" % line, file=sys.stderr)
+                return count, count + 1
+        count += 1
+        nes.step()
+    if golden is not None and lines is not None and count < lines:
+        print("golden log ends before line %d" % (count + 1), file=sys.stderr)
+        return count, count + 1
+    return count, None
+
+def FrameBus(filename, scanline_render=True, block_cache=False, skip_idle=True):
+    nes = Bus.Bus()
+    nes.ppu.scanline_render = scanline_render
+    nes.insertCartridge(Cartridge.Cartridge(filename))
+    nes.reset()
+    nes.useBlockCache(block_cache)
+    nes.skipIdleLoops = skip_idle
+    return nes
+
+def FrameHashes(filename, frames, scanline_render=True, block_cache=False, skip_idle=True, nes=None):
+    # sha1 of the frame buffer after each frame
+    if nes is None:
+        nes = FrameBus(filename, scanline_render, block_cache, skip_idle)
+    for frame in range(frames):
+        nes.runFrame()
+        yield hashlib.sha1(nes.ppu.GetFrameBuffer()).hexdigest()
+
+def RunFrames(filename, frames, golden=None, output=None, scanline_render=True, block_cache=False):
+    count = 0
+    for frame, digest in enumerate(FrameHashes(filename, frames, scanline_render, block_cache)):
+        line = "%d %s" % (frame + 1, digest)
+        if output is not None:
+            output.write(line + "\n")
+        if golden is not None:
+            expected = golden.readline().strip()
+            if not expected:
+                # a truncated or stale golden file must not pass unchecked frames
+                print("golden file ends before frame %d" % (frame + 1), file=sys.stderr)
+                return count, frame + 1
+            if expected != line:
+                print("frame %d differs" % (frame + 1), file=sys.stderr)
+                print("  expected: %s" % expected, file=sys.stderr)
+                print("  got:      %s" % line, file=sys.stderr)
+                return count, frame + 1
+        count += 1
+    return count, None
+
+class RecordingBus:
+    # 64KB of flat memory that records every cpu access in order
+    def __init__(self):
+        self.memory = bytearray(65536)
+        self.accesses = []
+
+    def cpuRead(self, addr, readOnly=False):
+        self.accesses.append((addr,))
+        return self.memory[addr]
+
+    def cpuWrite(self, addr, data):
+        self.accesses.append((addr, data))
+        self.memory[addr] = data
+
+def ReferenceInstruction(cpu):
+    # one instruction through the lookup table, as clock() used to run it
+    cpu.opcode = cpu.read(cpu.pc)
+    cpu.pc = (cpu.pc + 1) & 0xFFFF
+    instruction = cpu.lookup[cpu.opcode]
+    cpu.cycles = instruction.cycles
+    additional_cycle1 = instruction.addrmode()
+    additional_cycle2 = instruction.operate()
+    if additional_cycle1 and additional_cycle2:
+        cpu.cycles += 1
+    return cpu.cycles
+
+def GeneratedInstruction(cpu):
+    cpu.opcode = cpu.read(cpu.pc)
+    cpu.pc = (cpu.pc + 1) & 0xFFFF
+    return cpu.handlers[cpu.opcode]()
+
+def InstructionResult(cpu, bus, run, memory, registers):
+    bus.memory[:] = memory
+    bus.accesses.clear()
+    cpu.a, cpu.x, cpu.y, cpu.stkp, cpu.pc, cpu.status = registers
+    cpu.cycles = 0
+    cycles = run(cpu)
+    cpu.cycles = 0
+    return (cpu.a, cpu.x, cpu.y, cpu.stkp, cpu.pc, cpu.status, cycles, bytes(bus.memory), bus.accesses[:])
+
+def CheckOpcodes(trials=32, seed=6502):
+    # every opcode through the generated handler and through its lookup table
+    # addrmode/operate methods, on random registers and memory; registers,
+    # flags, cycles, memory and the order of bus accesses must all match
+    rnd = random.Random(seed)
+    bus = RecordingBus()
+    cpu = Nes6502.Nes6502()
+    cpu.ConnectBus(bus)
+    for opcode in range(256):
+        for trial in range(trials):
+            memory = bytearray(rnd.randbytes(65536))
+            registers = (rnd.randrange(256), rnd.randrange(256), rnd.randrange(256),
+                rnd.randrange(256), rnd.randrange(65536), rnd.randrange(256))
+            memory[registers[4]] = opcode
+            expected = InstructionResult(cpu, bus, ReferenceInstruction, memory, registers)
+            got = InstructionResult(cpu, bus, GeneratedInstruction, memory, registers)
+            if got != expected:
+                names = ("a", "x", "y", "stkp", "pc", "status", "cycles", "memory", "bus accesses")
+                differs = [name for name, e, g in zip(names, expected, got) if e != g]
+                print("opcode $%02X (%s) differs in %s, a=$%02X x=$%02X y=$%02X sp=$%02X pc=$%04X p=$%02X" % (
+                    (opcode, cpu.lookup[opcode].name, ", ".join(differs)) + registers), file=sys.stderr)
+                return False
+    return True
+
+def EagerFrameHashes(filename, frames):
+    # FrameHashes with dot rendering and the ppu caught up after every
+    # instruction, so nothing depends on predicting when its next event (or a
+    # mapper irq) comes
+    nes = FrameBus(filename, scanline_render=False, block_cache=False, skip_idle=False)
+    for frame in range(frames):
+        while not nes.ppu.frame_complete:
+            nes.step()
+            nes.SyncPpu()
+        nes.ppu.frame_complete = False
+        yield hashlib.sha1(nes.ppu.GetFrameBuffer()).hexdigest()
+
+# ways of running frames that must render exactly what EagerFrameHashes does:
+# keyword arguments of FrameHashes
+FRAME_MODES = {
+    "lazy ppu": dict(scanline_render=False, block_cache=False, skip_idle=False),
+    "scanline": dict(scanline_render=True, block_cache=False, skip_idle=False),
+    "blocks": dict(scanline_render=False, block_cache=True, skip_idle=False),
+    "idle skip": dict(scanline_render=False, block_cache=False, skip_idle=True),
+    "all": dict(scanline_render=True, block_cache=True, skip_idle=True),
+}
+
+def CheckFrames(filename, frames=30):
+    expected = list(EagerFrameHashes(filename, frames))
+    for mode, settings in FRAME_MODES.items():
+        nes = FrameBus(filename, **settings)
+        for frame, digest in enumerate(FrameHashes(filename, frames, nes=nes)):
+            if digest != expected[frame]:
+                print("%s: frame %d differs with %s" % (os.path.basename(filename), frame + 1, mode), file=sys.stderr)
+                return False
+        # matching frames prove nothing if the fast path never ran
+        if nes.blockCache is not None and nes.blockCache.translated == 0:
+            print("%s: no block was translated with %s" % (os.path.basename(filename), mode), file=sys.stderr)
+            return False
+        # every synthetic rom waits for vertical blank in a loop at start up
+        if nes.skipIdleLoops and nes.idleCyclesSkipped == 0:
+            print("%s: no idle loop was skipped with %s" % (os.path.basename(filename), mode), file=sys.stderr)
+            return False
+    return True
+
+def OamDmaCycles(filename, dot_clock):
+    # cpu cycles of one STA $4014 from ram, run through Bus.clock() or
+    # Bus.step(); both must include the 513 cycle dma stall
+    nes = Bus.Bus()
+    nes.insertCartridge(Cartridge.Cartridge(filename))
+    nes.reset()
+    nes.skipIdleLoops = False
+    cpu = nes.cpu
+    nes.cpuRam[0x0200:0x0203] = bytes([0x8D, 0x14, 0x40])   # STA $4014
+    cpu.pc = 0x0200
+    cpu.a = 0x03
+    cpu.cycles = 0
+    cpu.clock_count = 0
+    if not dot_clock:
+        return nes.step()
+    nes.clock()
+    while cpu.cycles > 0:
+        nes.clock()
+    return cpu.clock_count
+
+def CheckOamDma(filename):
+    clocked = OamDmaCycles(filename, True)
+    stepped = OamDmaCycles(filename, False)
+    if clocked != stepped:
+        print("oam dma: %d cycles through clock(), %d through step()" % (clocked, stepped), file=sys.stderr)
+        return False
+    return True
+
+def RunChecks():
+    # Returns the number of checks that passed and the name of the first one
+    # that failed, or None.
+    count = 0
+    with tempfile.TemporaryDirectory() as tmp:
+        files = {}
+        for name, settings in Benchmark.SYNTHETIC_ROMS.items():
+            files[name] = os.path.join(tmp, name + ".nes")
+            with open(files[name], 'wb') as f:
+                f.write(Benchmark.SyntheticRom(**settings))
+
+        checks = [("opcodes", CheckOpcodes)]
+        checks += [(name + " frames", lambda filename=filename: CheckFrames(filename)) for name, filename in files.items()]
+        checks += [("oam dma", lambda: CheckOamDma(files["synthetic-render"]))]
+        for name, check in checks:
+            if not check():
+                return count, name
+            count += 1
+    return count, None
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Trace and frame hash regression checks")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    trace = commands.add_parser("trace", help="nestest cpu trace in nestest.log format")
+    trace.add_argument("rom", help="nestest.nes")
+    trace.add_argument("--golden", metavar="LOG", help="golden log to compare against (nestest.log)")
+    trace.add_argument("--output", metavar="FILE", help="write the trace to FILE ('-' for stdout)")
+    trace.add_argument("--lines", type=int, help="stop after this many instructions")
+    trace.add_argument("--ppu", action="store_true", help="compare the PPU: column too")
+
+    frames = commands.add_parser("frames", help="per-frame hashes of the frame buffer")
+    frames.add_argument("rom")
+    frames.add_argument("--frames", type=int, default=60, help="number of frames (default 60)")
+    frames.add_argument("--golden", metavar="FILE", help="hash list to compare against")
+    frames.add_argument("--output", metavar="FILE", help="write the hashes to FILE ('-' for stdout)")
+    frames.add_argument("--dot", action="store_true", help="render dot by dot instead of by scanline")
+    frames.add_argument("--blocks", action="store_true", help="run with the basic block cache")
+
+    check = commands.add_parser("check", help="compare the fast paths against the plain ones")
+
+    args = parser.parse_args()
+    if args.command == "check":
+        count, failed = RunChecks()
+        print("%d checks pass" % count if failed is None else "%s check failed" % failed, file=sys.stderr)
+        sys.exit(1 if failed is not None else 0)
+
+    if args.golden is None and args.output is None:
+        args.output = "-"
+    output = None
+    if args.output == "-":
+        output = sys.stdout
+    elif args.output is not None:
+        output = open(args.output, 'w')
+    golden = open(args.golden) if args.golden is not None else None
+
+    if args.command == "trace":
+        lines = args.lines
+        if golden is None and lines is None:
+            lines = 8991    # length of nestest.log
+        count, failed = RunTrace(args.rom, golden, output, lines, args.ppu)
+        what = "lines"
+    else:
+        count, failed = RunFrames(args.rom, args.frames, golden, output, not args.dot, args.blocks)
+        what = "frames"
+
+    if golden is not None:
+        print("%d %s match" % (count, what), file=sys.stderr)
+    sys.exit(1 if failed is not None else 0)
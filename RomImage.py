@@ -0,0 +1,84 @@
+import hashlib
+import mmap
+import os
+
+# A parsed iNES or NES 2.0 file. prg and chr are copied out of the file data
+# into immutable bytes, so a cached image does not change or fault if the file
+# is later rewritten or truncated.
+class RomImage:
+    FILETYPE_ARCHAIC = 0    # iNES from before bytes 7-15 were defined
+    FILETYPE_INES    = 1
+    FILETYPE_NES20   = 2
+
+    def __init__(self, data, name="ROM"):
+        if len(data) < 16 or data[0:4] != b'NES\x1a':
+            raise ValueError("%s: not an iNES file" % name)
+        header = bytes(data[0:16])
+
+        if (header[7] & 0x0C) == 0x08:
+            self.fileType = self.FILETYPE_NES20
+        elif (header[7] & 0x0C) == 0x00 and header[12:16] == b'\x00\x00\x00\x00':
+            self.fileType = self.FILETYPE_INES
+        else:
+            # byte 7 onwards is likely garbage ("DiskDude!"), only trust flags 6
+            self.fileType = self.FILETYPE_ARCHAIC
+
+        self.mapperID = header[6] >> 4
+        self.prgBanks = header[4]
+        self.chrBanks = header[5]
+        if self.fileType != self.FILETYPE_ARCHAIC:
+            self.mapperID |= header[7] & 0xF0
+        if self.fileType == self.FILETYPE_NES20:
+            # an msb nibble of $F gives the size in exponent-multiplier notation
+            if (header[9] & 0x0F) == 0x0F or (header[9] & 0xF0) == 0xF0:
+                raise ValueError("%s: NES 2.0 exponent-multiplier rom sizes are not supported" % name)
+            self.mapperID |= (header[8] & 0x0F) << 8
+            self.prgBanks |= (header[9] & 0x0F) << 8
+            self.chrBanks |= (header[9] & 0xF0) << 4
+
+        self.verticalMirror = (header[6] & 0x01) > 0
+        self.fourScreen = (header[6] & 0x08) > 0
+        self.battery = (header[6] & 0x02) > 0
+
+        offset = 16
+        if header[6] & 0x04 > 0:
+            offset += 512   # trainer
+        prgSize = self.prgBanks * 16384
+        chrSize = self.chrBanks * 8192
+        if offset + prgSize + chrSize > len(data):
+            raise ValueError("%s: file is shorter than its header says (%d prg, %d chr banks)" % (name, self.prgBanks, self.chrBanks))
+
+        view = memoryview(data)
+        self.prg = bytes(view[offset:offset + prgSize])
+        self.chr = bytes(view[offset + prgSize:offset + prgSize + chrSize])
+        view.release()
+
+
+# parsed images by sha1 of the file contents, shared by every cartridge loaded
+# from the same rom, and the digest last seen for a path so an unchanged file
+# is not hashed again
+romImages = {}
+romDigests = {}
+
+def Load(filename):
+    info = os.stat(filename)
+    key = (os.path.realpath(filename), info.st_size, info.st_mtime_ns)
+    digest = romDigests.get(key)
+    if digest is not None and digest in romImages:
+        return romImages[digest]
+
+    with open(filename, 'rb') as f:
+        if info.st_size == 0:
+            raise ValueError("%s: not an iNES file" % filename)
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    # the map is only used to hash and parse the file, the image keeps copies
+    try:
+        digest = hashlib.sha1(data).hexdigest()
+        image = romImages.get(digest)
+        if image is None:
+            image = romImages[digest] = RomImage(data, filename)
+        romDigests[key] = digest
+    finally:
+        data.close()
+    return image
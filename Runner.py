@@ -0,0 +1,123 @@
+import argparse
+import collections
+import hashlib
+import json
+import multiprocessing
+import os
+import sys
+import time
+
+import Headless
+import Input
+
+# Runs many headless emulator instances at once over a pool of worker
+# processes. Each job is a rom, a number of frames, an optional input script
+# and the frames to keep the frame buffer of. Results are streamed back as
+# each job finishes.
+#
+# An input script is either the name of a file with one byte per frame (see
+# Input.InputScript) or a list with a pad 1 state, or [pad 1, pad 2] states,
+# per frame.
+#
+# Each worker keeps its parsed rom images (and generated cpu code) across
+# jobs, so a rom is only read and parsed once per worker.
+
+Job = collections.namedtuple('Job', ['rom', 'frames', 'inputs', 'checkpoints', 'scanline'], defaults=(None, (), True))
+
+def RunJob(job):
+    # Runs one job to completion in the current process, returns a result dict.
+    # Frame buffers are 256x240 palette indices (see Nes2C02.GetFrameBuffer).
+    start = time.perf_counter()
+    try:
+        inputs = None
+        if isinstance(job.inputs, str):
+            inputs = Input.InputScript.Load(job.inputs)
+        elif job.inputs:
+            inputs = Input.InputScript.FromList(job.inputs)
+        headless = Headless.Headless(job.rom, scanline_render=job.scanline, inputs=inputs)
+        checkpoints = {}
+        wanted = set(job.checkpoints)
+        for frame in range(1, job.frames + 1):
+            headless.run_frames(1)
+            if frame in wanted:
+                checkpoints[frame] = bytes(headless.nes.ppu.GetFrameBuffer())
+    except Exception as e:
+        return {
+            "rom": job.rom,
+            "frames": job.frames,
+            "error": "%s: %s" % (type(e).__name__, e),
+            "seconds": time.perf_counter() - start,
+            "pid": os.getpid(),
+        }
+
+    nes = headless.nes
+    return {
+        "rom": job.rom,
+        "frames": job.frames,
+        "state_hash": hashlib.sha1(nes.save_state()).hexdigest(),
+        "frame_hash": hashlib.sha1(nes.ppu.GetFrameBuffer()).hexdigest(),
+        "checkpoints": checkpoints,
+        "cpu_cycles": nes.cpu.clock_count,
+        "seconds": time.perf_counter() - start,
+        "pid": os.getpid(),
+    }
+
+def IndexedRunJob(item):
+    index, job = item
+    return index, RunJob(job)
+
+def Run(jobs, processes=None):
+    # Yields (index into jobs, result) as jobs finish, in completion order.
+    # Jobs are handed out sorted by rom so a worker tends to keep running the
+    # rom it already has loaded.
+    jobs = list(jobs)
+    order = sorted(range(len(jobs)), key=lambda i: jobs[i].rom)
+    if processes == 1:
+        for i in order:
+            yield i, RunJob(jobs[i])
+        return
+    with multiprocessing.Pool(processes) as pool:
+        for index, result in pool.imap_unordered(IndexedRunJob, [(i, jobs[i]) for i in order]):
+            yield index, result
+
+def LoadJobs(filename):
+    # a json list of {"rom": ..., "frames": ..., "inputs": ..., "checkpoints": [...], "scanline": ...}
+    with open(filename) as f:
+        specs = json.load(f)
+    return [Job(spec["rom"], spec["frames"], spec.get("inputs"), tuple(spec.get("checkpoints", ())),
+        spec.get("scanline", True)) for spec in specs]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run many headless emulator jobs across processes")
+    parser.add_argument("roms", nargs="*", help="roms to run for --frames frames each")
+    parser.add_argument("--jobs", metavar="FILE", help="json file with a list of jobs")
+    parser.add_argument("--frames", type=int, default=60, help="frames per rom given on the command line (default 60)")
+    parser.add_argument("--checkpoint", type=int, action="append", default=[], help="keep the frame buffer after this frame (repeatable)")
+    parser.add_argument("--processes", type=int, help="worker processes (default: one per core)")
+    parser.add_argument("--dump-dir", metavar="DIR", help="write checkpoint frame buffers to DIR as raw 256x240 palette indices")
+    args = parser.parse_args()
+
+    jobs = LoadJobs(args.jobs) if args.jobs is not None else []
+    jobs += [Job(rom, args.frames, None, tuple(args.checkpoint)) for rom in args.roms]
+    if not jobs:
+        parser.error("no jobs given")
+
+    # one json line per finished job, checkpoint frame buffers are replaced by their hash
+    start = time.perf_counter()
+    failed = 0
+    for index, result in Run(jobs, args.processes):
+        checkpoints = result.pop("checkpoints", {})
+        result["job"] = index
+        result["checkpoints"] = {str(frame): hashlib.sha1(data).hexdigest() for frame, data in checkpoints.items()}
+        if args.dump_dir is not None:
+            os.makedirs(args.dump_dir, exist_ok=True)
+            for frame, data in checkpoints.items():
+                with open(os.path.join(args.dump_dir, "job%d_frame%d.raw" % (index, frame)), 'wb') as f:
+                    f.write(data)
+        if "error" in result:
+            failed += 1
+        print(json.dumps(result, sort_keys=True))
+        sys.stdout.flush()
+    print("%d jobs, %d failed, %.2fs" % (len(jobs), failed, time.perf_counter() - start), file=sys.stderr)
+    sys.exit(1 if failed else 0)